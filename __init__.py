@@ -1,15 +1,79 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+import asyncio
+import os
+import queue
+from flask import Flask, render_template, request, redirect, url_for, flash, session, Response, jsonify
 from werkzeug.security import generate_password_hash, check_password_hash
 from login import UserLoginIn
 from createAccount import createAccount
 from database import DataBase
+from async_database import AsyncDataBase
+from archival import DataArchiver
+from avatars import AvatarPipeline, AvatarTooLarge, PLACEHOLDER_URL
+from traffic import TrafficRecorder
+from admission import AdmissionController
+from http_cache import HttpCache, ResponseCompressor
+from batch_api import BatchExecutor, parse_batch
+from analytics import AGE_GROUPS
+from notification_hub import format_sse
+from username_index import fold_case
 from classes import User, Post, Event, Badge, Following, FollowRequest, PostPrompt, Comment, UserAction
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-here' 
 
-# Initialize database helper
-db = DataBase()
+# Initialize database helper. BONDBUDDIES_DB picks another database file (e.g. a copy
+# for traffic replay), BONDBUDDIES_REPLICATION_DIR turns on change shipping to read
+# replicas, BONDBUDDIES_REPLICA points reads at a local replica file. BONDBUDDIES_SHARDS
+# splits a new database's user-owned tables across that many files (see sharding.py).
+db = DataBase(os.environ.get('BONDBUDDIES_DB', 'BondBuddies.db'),
+              replication_dir=os.environ.get('BONDBUDDIES_REPLICATION_DIR'),
+              replica_name=os.environ.get('BONDBUDDIES_REPLICA'),
+              shard_count=int(os.environ.get('BONDBUDDIES_SHARDS', 0)) or None)
+async_db = AsyncDataBase(db)
+
+# Old activity is rolled up and archived by the scheduler process (python scheduler.py),
+# the routes only read archived notifications back
+archiver = DataArchiver(db)
+
+# Drop or patch in-process caches as other workers write, via change_log
+db.change_subscriber.start()
+
+# Checkpoint decayed trending scores to the database every minute
+db.trending.start()
+
+# Deleted users and posts are only tombstoned here; the scheduler process purges their data
+
+# Resize avatar uploads on a process pool, stored under static/avatars
+avatar_pipeline = AvatarPipeline(db, static_dir=app.static_folder)
+# Werkzeug refuses larger bodies before spooling them; the headroom is for the multipart framing
+app.config['MAX_CONTENT_LENGTH'] = avatar_pipeline.get_max_bytes() + 64 * 1024
+
+# Daily backups and engagement rollups are made by the same scheduler process, not by
+# every web worker (or by backup.py / analytics.py from cron). The routes only read the
+# analytics results.
+
+# Usernames allowed to read the analytics rollups, e.g. BONDBUDDIES_ADMINS=alice,bob
+ADMIN_USERNAMES = {fold_case(name.strip()) for name in os.environ.get('BONDBUDDIES_ADMINS', '').split(',')
+                   if name.strip()}
+
+# With BONDBUDDIES_REPLICATION_DIR set, row changes are logged here and shipped to the
+# replication directory by the scheduler process, started with the same --replication-dir
+
+# Record anonymized request traces for traffic.py to replay, when BONDBUDDIES_TRACE is set
+traffic_recorder = None
+if os.environ.get('BONDBUDDIES_TRACE'):
+    traffic_recorder = TrafficRecorder(app, db, os.environ['BONDBUDDIES_TRACE'], key=app.config['SECRET_KEY'])
+
+# gzip/brotli for larger HTML and JSON bodies, then ETags from per-user versions:
+# a revalidation that still matches is answered 304 before admission or the database
+compressor = ResponseCompressor(app)
+http_cache = HttpCache(app, db)
+
+# Concurrency limits per route class; past their latency budget requests get a fast 503
+admission = AdmissionController(app)
+
+# Several read queries in one request, for clients on slow networks
+batch_executor = BatchExecutor(db)
 
 #Login Page
 @app.route('/', methods=['GET', 'POST'])
@@ -44,9 +108,8 @@ def accountCreation():
     create_account_form = createAccount(request.form)
     if request.method == 'POST' and create_account_form.validate():
         try:
-            # Check if username already exists
-            existing_user = db.get_user_by_username(create_account_form.username.data)
-            if existing_user:
+            # Names the index already knows are taken skip the password hashing
+            if not db.username_index.is_available(create_account_form.username.data):
                 flash('Username already exists!', 'danger')
                 return render_template('createAccount.html', form=create_account_form)
             
@@ -57,11 +120,15 @@ def accountCreation():
                 salt_length=16
             )
 
+            # The unique index decides, insert_user returns None if the name was taken meanwhile
             user_id = db.insert_user(
                 username=create_account_form.username.data,
                 password=hashed_password,
                 user_type=create_account_form.user_type.data
             )
+            if user_id is None:
+                flash('Username already exists!', 'danger')
+                return render_template('createAccount.html', form=create_account_form)
 
             flash('Account created successfully! Please login.', 'success')
             return redirect(url_for('login'))
@@ -72,8 +139,18 @@ def accountCreation():
 
     return render_template('createAccount.html', form=create_account_form)
 
+# Live username check for the signup form, answered from memory
+@app.route('/api/username-available')
+@http_cache.cached('users', per_user=False)
+def username_available():
+    username = request.args.get('username', '').strip()
+    if not 1 <= len(username) <= 100:
+        return jsonify({'error': 'Username must be 1 to 100 characters'}), 400
+    return jsonify({'username': username, 'available': db.username_index.is_available(username)})
+
 # Home Page
 @app.route('/home')
+@http_cache.cached()
 def home():
     # Check if user is logged in
     if 'user_id' not in session or 'logged_in' not in session:
@@ -96,5 +173,331 @@ def home():
     # Pass only the current user to template
     return render_template('home.html', current_user=current_user)
 
+# =============== AVATAR ROUTES ===============
+
+# Upload a new avatar, resized in the background while a placeholder is shown
+@app.route('/api/avatar', methods=['POST'])
+def upload_avatar():
+    if 'user_id' not in session or 'logged_in' not in session:
+        return jsonify({'error': 'Please login first'}), 401
+    
+    upload = request.files.get('avatar')
+    if upload is None:
+        return jsonify({'error': 'No avatar file uploaded'}), 400
+    
+    try:
+        status, avatar_url = avatar_pipeline.save_upload(session['user_id'], upload.stream)
+    except AvatarTooLarge as e:
+        return jsonify({'error': str(e)}), 413
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify({
+        'status': status,
+        'avatar_url': avatar_url,
+        'status_url': url_for('avatar_status')
+    }), 200 if status == 'ready' else 202
+
+# Bodies over MAX_CONTENT_LENGTH, rejected by Werkzeug before the view runs
+@app.errorhandler(413)
+def request_too_large(e):
+    return jsonify({'error': f'Upload is larger than {avatar_pipeline.get_max_bytes()} bytes'}), 413
+
+# Polled by the page to swap the placeholder for the finished avatar
+@app.route('/api/avatar/status')
+def avatar_status():
+    if 'user_id' not in session or 'logged_in' not in session:
+        return jsonify({'error': 'Please login first'}), 401
+    
+    job = avatar_pipeline.get_status(session['user_id'])
+    status, avatar_url = job if job is not None else ('ready', None)
+    if avatar_url is None:
+        # No upload in flight, or it failed: the stored avatar stays
+        user_data = db.get_user_by_id(session['user_id'])
+        avatar_url = (user_data[8] if user_data else None) or PLACEHOLDER_URL
+    return jsonify({'status': status, 'avatar_url': avatar_url})
+
+# =============== EVENT ROUTES ===============
+
+# Nearest upcoming events to a point (?lat=&lon=) or a known place (?location=)
+@app.route('/api/events/nearby')
+def nearby_events():
+    if 'user_id' not in session or 'logged_in' not in session:
+        return jsonify({'error': 'Please login first'}), 401
+    
+    try:
+        if request.args.get('location'):
+            coordinates = db.gazetteer.geocode(request.args['location'])
+            if coordinates is None:
+                return jsonify({'error': 'Unknown location'}), 404
+            latitude, longitude = coordinates
+        else:
+            latitude = float(request.args['lat'])
+            longitude = float(request.args['lon'])
+        radius_km = float(request.args['radius_km']) if request.args.get('radius_km') else None
+        limit = min(int(request.args.get('limit', 20)), 100)
+    except (KeyError, ValueError):
+        return jsonify({'error': 'Give lat and lon, or a location'}), 400
+    
+    events = db.get_nearby_events(latitude, longitude, radius_km=radius_km,
+                                  game_type=request.args.get('game_type'), limit=limit)
+    return jsonify({'events': [{
+        'event_id': event[0],
+        'event_name': event[1],
+        'event_date': event[4],
+        'location': event[5],
+        'max_participants': event[6],
+        'game_type': event[8],
+        'participant_count': event[11],
+        'latitude': event[12],
+        'longitude': event[13],
+        'organizer': event[14],
+        'distance_km': round(event[15], 2)
+    } for event in events]})
+
+# =============== TRENDING ROUTES ===============
+
+# What is popular right now: posts, prompts and event game types by decayed score
+@app.route('/api/trending')
+def trending():
+    if 'user_id' not in session or 'logged_in' not in session:
+        return jsonify({'error': 'Please login first'}), 401
+    
+    try:
+        limit = min(int(request.args.get('limit', 10)), 50)
+    except ValueError:
+        return jsonify({'error': 'limit must be a number'}), 400
+    
+    return jsonify({
+        'posts': [{
+            'post_id': post[0],
+            'content': post[1],
+            'username': post[-1],
+            'likes': post[4],
+            'comment_count': post[7],
+            'score': round(score, 3)
+        } for post, score in db.get_trending_posts(limit)],
+        'prompts': [{
+            'prompt_id': prompt[0],
+            'prompt_text': prompt[1],
+            'category': prompt[2],
+            'score': round(score, 3)
+        } for prompt, score in db.get_trending_prompts(limit)],
+        'game_types': [{'game_type': game_type, 'score': round(score, 3)}
+                       for game_type, score in db.get_trending_game_types(limit)]
+    })
+
+# =============== BATCH ROUTES ===============
+
+# Run several whitelisted read queries (see batch_api.BATCH_QUERIES) in one round-trip:
+# {"queries": [{"id": "feed", "query": "feed", "params": {"limit": 10}, "fields": ["post_id", "content"]}]}
+@app.route('/api/batch', methods=['POST'])
+def batch():
+    if 'user_id' not in session or 'logged_in' not in session:
+        return jsonify({'error': 'Please login first'}), 401
+    
+    try:
+        queries = parse_batch(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify({'results': batch_executor.run(session['user_id'], queries)})
+
+# =============== ANALYTICS ROUTES ===============
+
+# Engagement rollups from the latest analytics run: active users, cross-age
+# interactions, retention cohorts and badge funnels (?age_group=youth|senior|all)
+@app.route('/api/analytics')
+def analytics():
+    if 'user_id' not in session or 'logged_in' not in session:
+        return jsonify({'error': 'Please login first'}), 401
+    
+    user_data = db.get_user_by_id(session['user_id'])
+    if not user_data or fold_case(User.from_database_row(user_data).get_username()) not in ADMIN_USERNAMES:
+        return jsonify({'error': 'Only admins can view analytics'}), 403
+    
+    age_group = request.args.get('age_group', 'all')
+    if age_group != 'all' and age_group not in AGE_GROUPS:
+        return jsonify({'error': 'Unknown age group'}), 400
+    try:
+        days = min(int(request.args.get('days', 30)), 90)
+    except ValueError:
+        return jsonify({'error': 'days must be a number'}), 400
+    
+    run = db.get_last_analytics_run()
+    interactions = {}
+    for interaction, from_age_group, to_age_group, count in db.get_interaction_matrix():
+        interactions.setdefault(interaction, {}).setdefault(from_age_group, {})[to_age_group] = count
+    
+    return jsonify({
+        'computed_at': run[2] if run else None,
+        'activity': [{'day': day, 'dau': dau, 'wau': wau}
+                     for day, dau, wau in db.get_activity_rollup(days, age_group)],
+        'interactions': interactions,
+        'retention': [{
+            'cohort_week': cohort_week,
+            'weeks_since': weeks_since,
+            'cohort_size': cohort_size,
+            'active_users': active_users,
+            'rate': round(active_users / cohort_size, 3) if cohort_size else None
+        } for cohort_week, weeks_since, cohort_size, active_users in db.get_retention_cohorts(age_group)],
+        'badge_funnel': [{
+            'badge_id': badge_id,
+            'badge_name': badge_name,
+            'started': started,
+            'halfway': halfway,
+            'earned': earned
+        } for badge_id, badge_name, started, halfway, earned in db.get_badge_funnel(age_group)]
+    })
+
+# =============== NOTIFICATION ROUTES ===============
+
+@app.route('/notifications/unread-count')
+@http_cache.cached()
+def notification_unread_count():
+    if 'user_id' not in session or 'logged_in' not in session:
+        return jsonify({'error': 'Please login first'}), 401
+    return jsonify({'unread_count': db.get_unread_notification_count(session['user_id'])})
+
+# Server-Sent Events stream of a user's notifications and unread count
+@app.route('/notifications/stream')
+def notification_stream():
+    if 'user_id' not in session or 'logged_in' not in session:
+        return jsonify({'error': 'Please login first'}), 401
+    
+    user_id = session['user_id']
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    
+    def stream():
+        subscription = db.notification_hub.subscribe(user_id)
+        try:
+            # On reconnect, replay whatever arrived while the client was away
+            if last_event_id is not None:
+                missed = db.get_notifications(user_id, after_id=last_event_id, limit=100)
+                for row in reversed(missed):
+                    yield format_sse({'type': 'notification', 'notification': db.notification_to_dict(row)}, row[0])
+            yield format_sse({'type': 'unread_count',
+                              'unread_count': db.get_unread_notification_count(user_id)})
+            
+            while True:
+                try:
+                    event = subscription.get(timeout=15)
+                except queue.Empty:
+                    # Comment line keeps proxies from closing an idle connection
+                    yield ': keep-alive\n\n'
+                    continue
+                event_id = event['notification']['notification_id'] if event['type'] == 'notification' else None
+                yield format_sse(event, event_id)
+        finally:
+            db.notification_hub.unsubscribe(user_id, subscription)
+    
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# =============== METRICS ROUTES ===============
+
+# How far behind the primary the read replica is, null when there is none
+@app.route('/metrics/replication')
+def replication_metrics():
+    lag = db.get_replica_lag()
+    return jsonify({'replica_configured': db.replica_router is not None,
+                    'replica_lag_seconds': round(lag, 3) if lag is not None else None})
+
+# Queue depth, in-flight requests and shed counts of the admission controller
+@app.route('/metrics/admission')
+def admission_metrics():
+    return jsonify(admission.get_metrics())
+
+# =============== ASYNC ROUTES ===============
+# Same pages as above, but database work runs on AsyncDataBase's pool and
+# independent queries are awaited together instead of one after another.
+
+@app.route('/async/', methods=['GET', 'POST'])
+async def login_async():
+    user_login_form = UserLoginIn(request.form)
+    
+    if request.method == 'POST' and user_login_form.validate():
+        user_data = await async_db.get_user_by_username(user_login_form.username.data)
+
+        if user_data:
+            user = User.from_database_row(user_data)
+            
+            # PBKDF2 is CPU bound, keep it off the event loop
+            if await async_db.run(check_password_hash, user.get_password(), user_login_form.password.data):
+                session['user_id'] = user.get_user_id()
+                session['username'] = user.get_username()
+                session['user_type'] = user.get_user_type()
+                session['logged_in'] = True
+                
+                return redirect(url_for('home_async'))
+            else:
+                flash('Invalid username or password', 'danger')
+        else:
+            flash('Invalid username or password', 'danger')
+    
+    return render_template('login.html', form=user_login_form)
+
+@app.route('/async/createAccount', methods=['GET', 'POST'])
+async def accountCreation_async():
+    create_account_form = createAccount(request.form)
+    if request.method == 'POST' and create_account_form.validate():
+        try:
+            # Names the index already knows are taken skip the password hashing
+            if not db.username_index.is_available(create_account_form.username.data):
+                flash('Username already exists!', 'danger')
+                return render_template('createAccount.html', form=create_account_form)
+
+            hashed_password = await async_db.run(
+                generate_password_hash,
+                create_account_form.password.data,
+                method='pbkdf2:sha256',
+                salt_length=16
+            )
+
+            # The unique index decides, insert_user returns None if the name was taken meanwhile
+            user_id = await async_db.insert_user(
+                username=create_account_form.username.data,
+                password=hashed_password,
+                user_type=create_account_form.user_type.data
+            )
+            if user_id is None:
+                flash('Username already exists!', 'danger')
+                return render_template('createAccount.html', form=create_account_form)
+
+            flash('Account created successfully! Please login.', 'success')
+            return redirect(url_for('login_async'))
+            
+        except Exception as e:
+            print(f"Error: {e}")
+            flash('An error occurred. Please try again.', 'danger')
+
+    return render_template('createAccount.html', form=create_account_form)
+
+@app.route('/async/home')
+@http_cache.cached()
+async def home_async():
+    if 'user_id' not in session or 'logged_in' not in session:
+        flash('Please login first', 'warning')
+        return redirect(url_for('login_async'))
+    
+    current_user_id = session['user_id']
+    
+    # Everything the home page needs, fetched concurrently
+    user_data, stats, badges, notifications = await asyncio.gather(
+        async_db.get_user_by_id(current_user_id),
+        async_db.get_user_stats(current_user_id),
+        async_db.get_user_badges(current_user_id),
+        async_db.get_notifications(current_user_id, unread_only=True)
+    )
+    
+    if not user_data:
+        flash('User not found', 'danger')
+        return redirect(url_for('login_async'))
+    
+    current_user = User.from_database_row(user_data)
+    
+    return render_template('home.html', current_user=current_user, stats=stats,
+                           badges=badges, notifications=notifications)
+
 if __name__ == '__main__':
     app.run(debug=True)
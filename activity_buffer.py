@@ -0,0 +1,273 @@
+import atexit
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows
+    import msvcrt
+
+
+def lock_file(handle):
+    """Lock an open file without waiting, returns False if another open file holds the lock"""
+    try:
+        if fcntl is not None:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(handle.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+
+class ActivityBuffer:
+    """Write-behind buffer for user_actions rows.
+
+    Actions are appended to an in-memory list (and, when `log_path` is set,
+    to an append-only log file so a crashed process can replay them) and
+    written to user_actions in one executemany once
+    `flush_size` records pile up or `flush_interval` seconds pass. Anything
+    that needs exact counts, like badge checks, calls flush() first.
+
+    Each process logs to segment files of its own, `<log_path>.<pid>.<n>`,
+    and keeps every segment open and locked until it is deleted. A flush
+    starts a new segment and deletes the old one once its actions have
+    committed. On start, a segment whose lock can be taken belongs to a
+    process that is gone, so it is replayed; segments of running processes
+    are left alone.
+
+    Actions tracked inside a unit of work are held for that unit rather than
+    queued: a flush made inside it writes them on the unit's connection, so
+    they commit or roll back with the rest of its work. Whatever the unit has
+    not flushed joins the queue when it commits, and is dropped if it rolls
+    back. Queued actions a unit flushed go back on the queue if it rolls back.
+
+    Delivery is at-least-once: a crash between a batch committing and its log
+    segment being removed replays that batch on the next start.
+    """
+
+    def __init__(self, database, flush_size=500, flush_interval=2.0, log_path=None):
+        self.__database = database
+        self.__flush_size = flush_size
+        self.__flush_interval = flush_interval
+        self.__log_path = log_path
+        self.__lock = threading.Lock()        # Guards the pending list and the log file
+        self.__flush_lock = threading.Lock()  # Only one flush writes at a time
+        self.__pending = []
+        self.__held = {}  # unit of work -> actions tracked inside it, not yet committed
+        self.__log = None  # (file, path) of the segment appends go to
+        self.__segment_count = 0
+        self.__wake = threading.Event()
+        self.__stop = threading.Event()
+
+        if log_path is not None:
+            self.__recover()
+            self.__log = self.__open_segment()
+
+        self.__thread = threading.Thread(target=self.__run, name='activity-buffer', daemon=True)
+        self.__thread.start()
+        atexit.register(self.close)
+
+    def append(self, user_id, action_type, target_id=None, action_data=None, unit=None):
+        """Queue one user action, or hold it for `unit` until that unit of work commits"""
+        record = (user_id, action_type, target_id, action_data,
+                  datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'))
+        if unit is None:
+            self.__queue([record])
+            return
+        with self.__lock:
+            self.__held.setdefault(unit, []).append(record)
+        unit.after_commit(lambda: self.__release(unit, record))
+        unit.after_rollback(lambda: self.__take_held(unit, record))
+
+    def get_pending_count(self):
+        return len(self.__pending)
+
+    def flush(self, unit=None):
+        """Write every queued action to the database, returns how many were written.
+
+        Called inside a unit of work, pass it as `unit`: the write then goes
+        through the unit's connection, rather than a second connection that
+        would wait on the write lock the unit holds, and includes the actions
+        held for it.
+        """
+        # A flush already running may be waiting on the write lock the unit holds, so don't queue behind it
+        locked = self.__flush_lock.acquire(blocking=unit is None)
+        try:
+            with self.__lock:
+                records, self.__pending = self.__pending, []
+                held = self.__held.pop(unit, []) if unit is not None else []
+                segment = self.__rotate_log() if records else None
+            if not records and not held:
+                return 0
+
+            try:
+                self.__write(records + held)
+            except sqlite3.Error:
+                self.__restore(unit, records, held, segment)
+                raise
+            if unit is None:
+                self.__remove_segment(segment)
+            else:
+                unit.after_commit(lambda: self.__remove_segment(segment))
+                unit.after_rollback(lambda: self.__restore(unit, records, held, segment))
+            return len(records) + len(held)
+        finally:
+            if locked:
+                self.__flush_lock.release()
+
+    def close(self):
+        """Stop the background thread and flush what is left"""
+        self.__stop.set()
+        self.__wake.set()
+        if self.__thread.is_alive() and self.__thread is not threading.current_thread():
+            self.__thread.join()
+        self.flush()
+        with self.__lock:
+            segment, self.__log = self.__log, None
+            flushed = not self.__pending
+        if segment is not None:
+            if flushed:
+                self.__remove_segment(segment)
+            else:
+                segment[0].close()  # Replayed by the next process to start
+
+    def __run(self):
+        while not self.__stop.is_set():
+            self.__wake.wait(self.__flush_interval)
+            self.__wake.clear()
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                print(f"Activity buffer flush failed: {e}")
+
+    def __queue(self, records):
+        with self.__lock:
+            self.__pending.extend(records)
+            self.__write_log(records)
+            full = len(self.__pending) >= self.__flush_size
+        if full:
+            self.__wake.set()
+
+    def __take_held(self, unit, record):
+        """Remove an action held for a unit of work, returns False if it was already written"""
+        with self.__lock:
+            records = self.__held.get(unit, [])
+            for i, held in enumerate(records):
+                if held is record:
+                    del records[i]
+                    if not records:
+                        del self.__held[unit]
+                    return True
+        return False
+
+    def __release(self, unit, record):
+        # The unit committed without flushing this action, so it is queued like any other
+        if self.__take_held(unit, record):
+            self.__queue([record])
+
+    def __restore(self, unit, records, held, segment):
+        """Put back what a failed or rolled back flush had taken"""
+        with self.__lock:
+            self.__pending[:0] = records
+            if held:
+                self.__held.setdefault(unit, [])[:0] = held
+            # Logged again in the current segment, so the old one can go
+            self.__write_log(records)
+        self.__remove_segment(segment)
+
+    def __write(self, records):
+        # Joins the calling thread's unit of work when there is one
+        conn = self.__database.get_connection()
+        try:
+            # Each user's rows go to their shard, all attached and locked before the first insert
+            by_shard = {}
+            for record in records:
+                by_shard.setdefault(self.__database.get_shard(conn, record[0]), []).append(record)
+            self.__database.lock_shards(conn, by_shard)
+            for shard, shard_records in by_shard.items():
+                conn.executemany(f'''
+                INSERT INTO {shard}.user_actions (user_id, action_type, target_id, action_data, performed_at)
+                VALUES (?, ?, ?, ?, ?)
+                ''', shard_records)
+            conn.commit()
+        finally:
+            conn.close()
+
+    # =============== LOG SEGMENTS ===============
+
+    def __write_log(self, records):
+        # Called with __lock held
+        if self.__log is not None and records:
+            self.__log[0].write(''.join(json.dumps(record) + '\n' for record in records))
+            self.__log[0].flush()
+
+    def __open_segment(self):
+        """Create and lock a new segment of this process's log, returns (file, path)"""
+        while True:
+            self.__segment_count += 1
+            path = f'{self.__log_path}.{os.getpid()}.{self.__segment_count}'
+            try:
+                handle = open(path, 'x', encoding='utf-8')
+            except FileExistsError:
+                continue  # Left by an earlier process with the same pid
+            if lock_file(handle):
+                return handle, path
+            handle.close()  # Another process's recovery got to it first
+
+    def __rotate_log(self):
+        """Start a new segment for appends, returns the old one"""
+        if self.__log is None:
+            return None
+        segment = self.__log
+        self.__log = self.__open_segment()
+        return segment
+
+    def __remove_segment(self, segment):
+        if segment is None:
+            return
+        handle, path = segment
+        if os.name == 'nt':
+            handle.close()  # Windows cannot delete an open file
+            os.remove(path)
+        else:
+            # Deleted while still locked, so no other process can start replaying it
+            os.remove(path)
+            handle.close()
+
+    def __recover(self):
+        """Replay the segments of processes that stopped without flushing them"""
+        directory = os.path.dirname(os.path.abspath(self.__log_path))
+        prefix = os.path.basename(self.__log_path) + '.'
+        for entry in sorted(os.listdir(directory)):
+            if not entry.startswith(prefix):
+                continue
+            path = os.path.join(directory, entry)
+            try:
+                handle = open(path, encoding='utf-8')
+            except FileNotFoundError:
+                continue
+            if not lock_file(handle) or not self.__is_current(handle, path):
+                handle.close()  # Still in use, or replayed by another process meanwhile
+                continue
+
+            records = []
+            for line in handle:
+                try:
+                    records.append(tuple(json.loads(line)))
+                except ValueError:
+                    pass  # Blank, or cut short by the crash
+            if records:
+                self.__write(records)
+            self.__remove_segment((handle, path))
+
+    def __is_current(self, handle, path):
+        """Whether `path` still names the file `handle` has open"""
+        try:
+            return os.path.samestat(os.fstat(handle.fileno()), os.stat(path))
+        except FileNotFoundError:
+            return False
@@ -0,0 +1,182 @@
+import math
+import threading
+import time
+
+# Route classes as name -> settings. Lower priority values are admitted first
+# when slots free up; `limit` caps how many of the class run at once,
+# `max_queue` how many may wait, and `max_wait` (seconds) is the latency
+# budget a request may spend queueing before it is turned away.
+ROUTE_CLASSES = {
+    'read': {'priority': 0, 'limit': 16, 'max_queue': 64, 'max_wait': 0.5},
+    'write': {'priority': 1, 'limit': 4, 'max_queue': 32, 'max_wait': 1.0},
+    'hash': {'priority': 2, 'limit': 2, 'max_queue': 16, 'max_wait': 2.0},
+}
+
+# Form posts to these hash a password (PBKDF2), the most expensive thing the app does
+HASH_ENDPOINTS = {'login', 'accountCreation', 'login_async', 'accountCreation_async'}
+
+# Posted to, but only read
+READ_ENDPOINTS = {'batch'}
+
+# Long-lived streams would hold a slot forever; metrics must answer under load
+EXEMPT_ENDPOINTS = {'static', 'notification_stream', 'replication_metrics', 'admission_metrics'}
+
+
+def classify(endpoint, method):
+    """Route class of a request"""
+    if endpoint in HASH_ENDPOINTS and method == 'POST':
+        return 'hash'
+    if method in ('GET', 'HEAD', 'OPTIONS') or endpoint in READ_ENDPOINTS:
+        return 'read'
+    return 'write'
+
+
+class AdmissionController:
+    """Concurrency limits and load shedding in front of the Flask routes.
+
+    Every request is classified as a cheap read, a write or a password hash
+    and must take a slot before its view runs: one of its class's `limit`
+    slots and one of `max_in_flight` slots overall. Without a free slot it
+    waits in a queue, and freed slots go to reads first, then writes, then
+    hashing, so a login burst cannot starve page loads.
+
+    A request is shed with a fast 503 and a Retry-After header instead of
+    queueing when its class's queue is full, or when the expected wait
+    (queue position times the class's average service time over its limit)
+    is already over the class's `max_wait` budget. A request that does queue
+    but is not admitted within `max_wait` is shed too.
+    """
+
+    def __init__(self, app=None, max_in_flight=16, classes=None, smoothing=0.2):
+        self.__max_in_flight = max_in_flight
+        self.__classes = classes or ROUTE_CLASSES
+        self.__smoothing = smoothing
+        self.__lock = threading.Lock()
+        self.__waiters = []  # [priority, seq, route_class, granted Event]
+        self.__seq = 0
+        self.__in_flight = 0
+        self.__stats = {name: {'in_flight': 0, 'queued': 0, 'admitted': 0, 'shed_queue_full': 0,
+                               'shed_over_budget': 0, 'shed_deadline': 0, 'service_ms': None}
+                        for name in self.__classes}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.before_request(self.__before_request)
+        app.teardown_request(self.__teardown_request)
+
+    # =============== SLOTS ===============
+
+    def acquire(self, route_class):
+        """Take a slot, waiting if needed. Returns None once admitted, else (reason, retry_after)"""
+        settings = self.__classes[route_class]
+        stats = self.__stats[route_class]
+        with self.__lock:
+            if not self.__waiters_ahead(settings['priority']) and self.__has_slot(route_class):
+                self.__admit(route_class)
+                return None
+
+            if stats['queued'] >= settings['max_queue']:
+                stats['shed_queue_full'] += 1
+                return 'queue_full', self.__retry_after(route_class)
+            expected_wait = self.__expected_wait(route_class)
+            if expected_wait > settings['max_wait']:
+                stats['shed_over_budget'] += 1
+                return 'over_budget', self.__retry_after(route_class)
+
+            granted = threading.Event()
+            waiter = [settings['priority'], self.__seq, route_class, granted]
+            self.__seq += 1
+            self.__waiters.append(waiter)
+            stats['queued'] += 1
+
+        if granted.wait(settings['max_wait']):
+            return None
+        with self.__lock:
+            if granted.is_set():
+                return None  # Admitted just as the deadline passed
+            self.__waiters.remove(waiter)
+            stats['queued'] -= 1
+            stats['shed_deadline'] += 1
+            return 'deadline', self.__retry_after(route_class)
+
+    def release(self, route_class, service_seconds):
+        """Give a slot back and hand it to the next waiter in priority order"""
+        stats = self.__stats[route_class]
+        with self.__lock:
+            self.__in_flight -= 1
+            stats['in_flight'] -= 1
+            service_ms = service_seconds * 1000
+            if stats['service_ms'] is None:
+                stats['service_ms'] = service_ms
+            else:
+                stats['service_ms'] += self.__smoothing * (service_ms - stats['service_ms'])
+
+            self.__waiters.sort(key=lambda waiter: (waiter[0], waiter[1]))
+            for waiter in list(self.__waiters):
+                if self.__in_flight >= self.__max_in_flight:
+                    break
+                if self.__has_slot(waiter[2]):
+                    self.__waiters.remove(waiter)
+                    self.__stats[waiter[2]]['queued'] -= 1
+                    self.__admit(waiter[2])
+                    waiter[3].set()
+
+    def get_metrics(self):
+        """Queue depth, in-flight requests and shed counts per route class"""
+        with self.__lock:
+            return {
+                'in_flight': self.__in_flight,
+                'max_in_flight': self.__max_in_flight,
+                'queued': len(self.__waiters),
+                'classes': {name: dict(stats, service_ms=round(stats['service_ms'], 2)
+                                       if stats['service_ms'] is not None else None)
+                            for name, stats in self.__stats.items()},
+            }
+
+    def __has_slot(self, route_class):
+        return (self.__in_flight < self.__max_in_flight
+                and self.__stats[route_class]['in_flight'] < self.__classes[route_class]['limit'])
+
+    def __waiters_ahead(self, priority):
+        # Someone of the same or a more urgent class is already waiting, queue behind them
+        return any(waiter[0] <= priority for waiter in self.__waiters)
+
+    def __admit(self, route_class):
+        self.__in_flight += 1
+        stats = self.__stats[route_class]
+        stats['in_flight'] += 1
+        stats['admitted'] += 1
+
+    def __expected_wait(self, route_class):
+        stats = self.__stats[route_class]
+        if stats['service_ms'] is None:
+            return 0.0
+        return (stats['queued'] + 1) * stats['service_ms'] / 1000 / self.__classes[route_class]['limit']
+
+    def __retry_after(self, route_class):
+        return max(1, math.ceil(self.__expected_wait(route_class)))
+
+    # =============== FLASK HOOKS ===============
+
+    def __before_request(self):
+        from flask import g, jsonify, request
+        if request.endpoint is None or request.endpoint in EXEMPT_ENDPOINTS:
+            return None
+        route_class = classify(request.endpoint, request.method)
+        shed = self.acquire(route_class)
+        if shed is not None:
+            reason, retry_after = shed
+            response = jsonify({'error': 'Server is busy, please try again shortly', 'reason': reason})
+            response.status_code = 503
+            response.headers['Retry-After'] = str(retry_after)
+            return response
+        g.admission_class = route_class
+        g.admission_started = time.perf_counter()
+        return None
+
+    def __teardown_request(self, exc):
+        from flask import g
+        route_class = g.pop('admission_class', None)
+        if route_class is not None:
+            self.release(route_class, time.perf_counter() - g.pop('admission_started'))
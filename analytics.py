@@ -0,0 +1,473 @@
+"""Engagement analytics: how youth and senior users use the app and each other.
+
+    python analytics.py run [--db BondBuddies.db] [--keep 3]
+    python analytics.py list
+
+scheduler.py runs the job every day; run that (or `run` from cron) in
+exactly one process, the web app only reads the results.
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+from backup import BackupManager
+from sharding import SHARDED_TABLES, read_shard_names
+
+AGE_GROUPS = ('youth', 'senior', 'unknown')
+ACTION_TYPES = ('create_post', 'like_post', 'comment_post', 'follow_user', 'create_event', 'participate_event')
+
+# Days since 1970-01-01 of a TIMESTAMP column; -1 for NULL
+EPOCH_DAY = "COALESCE(CAST(julianday({}) - 2440587.5 AS INTEGER), -1)"
+AGE_CODE = "CASE age_group WHEN 'youth' THEN 0 WHEN 'senior' THEN 1 ELSE 2 END"
+
+
+def action_code(column):
+    """SQL for the index of a column's action type in ACTION_TYPES, -1 for others"""
+    return (f'CASE {column} ' + ' '.join(f"WHEN '{name}' THEN {code}" for code, name in enumerate(ACTION_TYPES))
+            + ' ELSE -1 END')
+
+
+# Columns exported per table, as table -> (query, column names). Every column is an integer.
+SNAPSHOT_TABLES = {
+    'users': (f'SELECT user_id, {AGE_CODE}, {EPOCH_DAY.format("created_at")} FROM users',
+              ('user_id', 'age_group', 'created_day')),
+    'posts': ('SELECT post_id, user_id FROM posts', ('post_id', 'user_id')),
+    'following': (f'SELECT follower_id, followed_id, {EPOCH_DAY.format("follow_date")} FROM following',
+                  ('follower_id', 'followed_id', 'day')),
+    'event_participants': (f'SELECT event_id, user_id, {EPOCH_DAY.format("joined_at")} FROM event_participants',
+                           ('event_id', 'user_id', 'day')),
+    'badges': (f'SELECT badge_id, {action_code("criteria")}, COALESCE(progress_required, 1) FROM badges',
+               ('badge_id', 'action_type', 'progress_required')),
+    'user_badges': ('SELECT user_id, badge_id FROM user_badges', ('user_id', 'badge_id')),
+    'user_actions': (f'SELECT user_id, {action_code("action_type")}, COALESCE(target_id, -1), '
+                     f'{EPOCH_DAY.format("performed_at")}, 1 FROM user_actions',
+                     ('user_id', 'action_type', 'target_id', 'day', 'count')),
+    'user_action_daily': (f'SELECT user_id, {action_code("action_type")}, -1, '
+                          f'{EPOCH_DAY.format("action_day")}, action_count FROM user_action_daily',
+                          ('user_id', 'action_type', 'target_id', 'day', 'count')),
+}
+
+# Columns holding user ids, which index the per-user arrays
+USER_COLUMNS = (('users', 'user_id'), ('posts', 'user_id'), ('following', 'follower_id'),
+                ('following', 'followed_id'), ('event_participants', 'user_id'), ('user_badges', 'user_id'),
+                ('user_actions', 'user_id'), ('user_action_daily', 'user_id'))
+
+
+def install_rollup_tables(cursor):
+    """Create the tables analytics results are written to"""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS analytics_activity (
+        day DATE NOT NULL,
+        age_group TEXT NOT NULL,
+        dau INTEGER NOT NULL,
+        wau INTEGER NOT NULL,
+        PRIMARY KEY (day, age_group)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS analytics_interactions (
+        interaction TEXT NOT NULL,
+        from_age_group TEXT NOT NULL,
+        to_age_group TEXT NOT NULL,
+        interaction_count INTEGER NOT NULL,
+        PRIMARY KEY (interaction, from_age_group, to_age_group)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS analytics_retention (
+        cohort_week DATE NOT NULL,
+        age_group TEXT NOT NULL,
+        weeks_since INTEGER NOT NULL,
+        cohort_size INTEGER NOT NULL,
+        active_users INTEGER NOT NULL,
+        PRIMARY KEY (cohort_week, age_group, weeks_since)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS analytics_badge_funnel (
+        badge_id INTEGER NOT NULL,
+        age_group TEXT NOT NULL,
+        started INTEGER NOT NULL,
+        halfway INTEGER NOT NULL,
+        earned INTEGER NOT NULL,
+        PRIMARY KEY (badge_id, age_group)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS analytics_runs (
+        run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        snapshot TEXT NOT NULL,
+        finished_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        export_seconds REAL NOT NULL,
+        compute_seconds REAL NOT NULL
+    )
+    ''')
+
+
+def read_columns(conn, query, names, batch_size=100000):
+    """Run a query of integer columns into one NumPy array per column"""
+    cursor = conn.execute(query)
+    chunks = []
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        chunks.append(np.array(rows, dtype=np.int64).reshape(-1, len(names)))
+    data = np.concatenate(chunks) if chunks else np.empty((0, len(names)), dtype=np.int64)
+    return {name: data[:, column] for column, name in enumerate(names)}
+
+
+def day_to_date(day):
+    return (date(1970, 1, 1) + timedelta(days=int(day))).isoformat()
+
+
+def distinct(keys):
+    """Sorted unique values of an int64 array (sort and compare, quicker than np.unique here)"""
+    keys = np.sort(keys)
+    return keys[np.concatenate(([True], keys[1:] != keys[:-1]))] if len(keys) else keys
+
+
+def by_age(index, age, size, weights=None):
+    """Counts per (index, age group) as an array of shape (size, len(AGE_GROUPS))"""
+    groups = len(AGE_GROUPS)
+    return np.bincount(index * groups + age, weights=weights, minlength=size * groups).reshape(size, groups)
+
+
+class AnalyticsJob:
+    """Computes engagement rollups away from the live database.
+
+    Each run copies the database (and its shards) with the online
+    backup API, the same way BackupManager does, and exports the columns
+    the reports need to NumPy arrays on disk (one compressed .npz per table
+    under `snapshot_dir`). Everything is then computed from those arrays
+    with vectorised NumPy operations instead of GROUP BY queries on the
+    live tables:
+
+    - daily and 7-day active users per age group over `activity_days`
+    - cross-age interaction matrices: follows, likes and comments on each
+      other's posts, and joining the same events
+    - weekly signup cohorts and how many are active 0..`retention_weeks`
+      weeks later
+    - badge funnels: users who have started on a badge's action, are
+      halfway to it, and have earned it
+
+    The results replace the analytics_* rollup tables in one short
+    transaction, so a dashboard reads them instantly. Likes and comments
+    need each action's target, which rolled up actions no longer have, so
+    those matrices cover the archiver's retention window only.
+    """
+
+    def __init__(self, db_name, snapshot_dir=None, keep=3, activity_days=90, retention_weeks=12,
+                 pages_per_step=256):
+        self.__db_name = db_name
+        if snapshot_dir is None:
+            root, _ = os.path.splitext(db_name)
+            snapshot_dir = f'{root}_analytics'
+        self.__snapshot_dir = snapshot_dir
+        self.__keep = keep
+        self.__activity_days = activity_days
+        self.__retention_weeks = retention_weeks
+        self.__copier = BackupManager(db_name, pages_per_step=pages_per_step)
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def get_snapshot_dir(self):
+        return self.__snapshot_dir
+
+    # =============== BACKGROUND RUNNER ===============
+
+    def start(self, interval=86400):
+        """Run every `interval` seconds on a daemon thread"""
+        if self.__thread is not None and self.__thread.is_alive():
+            return
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run, args=(interval,), name='analytics', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def __run(self, interval):
+        # Without an earlier snapshot there are no results yet, so the first run is straight away
+        delay = interval if self.list_snapshots() else 0
+        while not self.__stop.wait(delay):
+            try:
+                self.run_once()
+            except (sqlite3.Error, OSError) as e:
+                print(f"Analytics error: {e}")
+            delay = interval
+
+    def run_once(self):
+        """Export a snapshot, compute the rollups and store them, returns the snapshot's name"""
+        started = time.perf_counter()
+        name = self.export_snapshot()
+        exported = time.perf_counter()
+        rollups = self.compute(name)
+        computed = time.perf_counter()
+        self.store(name, rollups, exported - started, computed - exported)
+        self.rotate()
+        return name
+
+    # =============== SNAPSHOTS ===============
+
+    def export_snapshot(self):
+        """Copy the database and write its columns as NumPy arrays, returns the snapshot's name"""
+        # sqlite3.connect() would quietly create an empty database in its place
+        if not os.path.exists(self.__db_name):
+            raise FileNotFoundError(f'No database at {self.__db_name}')
+        name = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        os.makedirs(self.__snapshot_dir, exist_ok=True)
+        partial_dir = os.path.join(self.__snapshot_dir, f'.{name}.partial')
+        os.makedirs(partial_dir)
+
+        try:
+            with tempfile.TemporaryDirectory(dir=self.__snapshot_dir) as copy_dir:
+                copy = os.path.join(copy_dir, os.path.basename(self.__db_name))
+                self.__copier.copy_database(self.__db_name, copy)
+                shard_copies = []
+                for shard_name in read_shard_names(self.__db_name):
+                    shard_copies.append(os.path.join(copy_dir, os.path.basename(shard_name)))
+                    self.__copier.copy_database(shard_name, shard_copies[-1])
+
+                counts = {}
+                conn = sqlite3.connect(copy)
+                if shard_copies:
+                    # TEMP views come first in name lookup, so the queries read every shard unchanged
+                    for index, shard_copy in enumerate(shard_copies):
+                        conn.execute(f'ATTACH DATABASE ? AS shard{index}', (shard_copy,))
+                    for table in SHARDED_TABLES:
+                        conn.execute(f'CREATE TEMP VIEW {table} AS ' + ' UNION ALL '.join(
+                            f'SELECT * FROM shard{index}.{table}' for index in range(len(shard_copies))))
+                for table, (query, names) in SNAPSHOT_TABLES.items():
+                    columns = read_columns(conn, query, names)
+                    np.savez_compressed(os.path.join(partial_dir, f'{table}.npz'), **columns)
+                    counts[table] = len(columns[names[0]])
+                conn.close()
+
+            with open(os.path.join(partial_dir, 'manifest.json'), 'w') as manifest:
+                json.dump({'created_at': datetime.now().isoformat(timespec='seconds'),
+                           'today': int(time.time() // 86400),  # UTC, like the stored timestamps
+                           'action_types': ACTION_TYPES, 'rows': counts}, manifest)
+            os.rename(partial_dir, os.path.join(self.__snapshot_dir, name))
+        except BaseException:
+            shutil.rmtree(partial_dir, ignore_errors=True)
+            raise
+        return name
+
+    def load_snapshot(self, name):
+        """The arrays of a snapshot as {table: {column: array}}, plus its manifest"""
+        path = os.path.join(self.__snapshot_dir, name)
+        with open(os.path.join(path, 'manifest.json')) as manifest:
+            info = json.load(manifest)
+        tables = {}
+        for table in SNAPSHOT_TABLES:
+            with np.load(os.path.join(path, f'{table}.npz')) as arrays:
+                tables[table] = {column: arrays[column] for column in arrays.files}
+        return tables, info
+
+    def list_snapshots(self):
+        """Names of the finished snapshots, oldest first"""
+        if not os.path.isdir(self.__snapshot_dir):
+            return []
+        return sorted(entry for entry in os.listdir(self.__snapshot_dir)
+                      if not entry.startswith('.')
+                      and os.path.exists(os.path.join(self.__snapshot_dir, entry, 'manifest.json')))
+
+    def rotate(self):
+        """Delete all but the newest `keep` snapshots, returns the names removed"""
+        removed = self.list_snapshots()[:-self.__keep] if self.__keep else []
+        for name in removed:
+            shutil.rmtree(os.path.join(self.__snapshot_dir, name))
+        return removed
+
+    # =============== ROLLUPS ===============
+
+    def compute(self, name):
+        """Compute every rollup from a snapshot, returns {rollup table: rows}"""
+        tables, info = self.load_snapshot(name)
+        users = tables['users']
+        size = max(int(tables[table][column].max(initial=0)) for table, column in USER_COLUMNS) + 1
+        # Age group code per user_id, 'unknown' for ids no longer in users
+        ages = np.full(size, AGE_GROUPS.index('unknown'), dtype=np.int64)
+        ages[users['user_id']] = users['age_group']
+
+        actions, daily = tables['user_actions'], tables['user_action_daily']
+        activity_users = np.concatenate([actions['user_id'], daily['user_id']])
+        activity_days = np.concatenate([actions['day'], daily['day']])
+        # Each (day, user) pair once, as one int64 key
+        active = distinct(activity_days * size + activity_users)
+
+        return {
+            'analytics_activity': self.__activity(active, size, ages, info['today']),
+            'analytics_interactions': self.__interactions(tables, ages),
+            'analytics_retention': self.__retention(active, size, users, ages, info['today']),
+            'analytics_badge_funnel': self.__badge_funnel(tables, size, ages),
+        }
+
+    def __activity(self, active, size, ages, today):
+        first_day = today - self.__activity_days + 1
+        days, user_ids = active // size, active % size
+        in_window = (days >= first_day - 6) & (days <= today)
+        days, user_ids = days[in_window], user_ids[in_window]
+        window = self.__activity_days
+
+        dau_mask = days >= first_day
+        dau = by_age(days[dau_mask] - first_day, ages[user_ids[dau_mask]], window)
+        # A user active on day d counts towards the WAU of days d to d + 6
+        shifted = distinct(np.concatenate([(days + offset) * size + user_ids for offset in range(7)]))
+        shifted_days, shifted_users = shifted // size, shifted % size
+        wau_mask = (shifted_days >= first_day) & (shifted_days <= today)
+        wau = by_age(shifted_days[wau_mask] - first_day, ages[shifted_users[wau_mask]], window)
+
+        rows = []
+        for offset in range(window):
+            day = day_to_date(first_day + offset)
+            rows.append((day, 'all', int(dau[offset].sum()), int(wau[offset].sum())))
+            rows.extend((day, age_group, int(dau[offset, code]), int(wau[offset, code]))
+                        for code, age_group in enumerate(AGE_GROUPS))
+        return rows
+
+    def __interactions(self, tables, ages):
+        groups = len(AGE_GROUPS)
+        matrices = {}
+
+        following = tables['following']
+        matrices['follow'] = np.bincount(ages[following['follower_id']] * groups + ages[following['followed_id']],
+                                         minlength=groups * groups).reshape(groups, groups)
+
+        posts, actions = tables['posts'], tables['user_actions']
+        # Post ids of a sharded database start high up per shard, so authors are looked up by binary search
+        order = np.argsort(posts['post_id'])
+        post_ids, authors = posts['post_id'][order], posts['user_id'][order]
+        for interaction, action_type in (('like', 'like_post'), ('comment', 'comment_post')):
+            mask = actions['action_type'] == ACTION_TYPES.index(action_type)
+            actors, target_ids = actions['user_id'][mask], actions['target_id'][mask]
+            found = np.searchsorted(post_ids, target_ids)
+            known = found < len(post_ids)
+            known[known] = post_ids[found[known]] == target_ids[known]
+            targets = np.full(len(target_ids), -1, dtype=np.int64)
+            targets[known] = authors[found[known]]
+            mask = (targets >= 0) & (targets != actors) & (targets < len(ages))
+            matrices[interaction] = np.bincount(ages[actors[mask]] * groups + ages[targets[mask]],
+                                                minlength=groups * groups).reshape(groups, groups)
+
+        # Participants per event and age group; M.T @ M counts pairs who joined the same event
+        participants = tables['event_participants']
+        _, event_index = np.unique(participants['event_id'], return_inverse=True)
+        members = by_age(event_index, ages[participants['user_id']], int(event_index.max(initial=-1)) + 1)
+        matrices['event'] = members.T @ members - np.diag(members.sum(axis=0))
+
+        return [(interaction, AGE_GROUPS[source], AGE_GROUPS[target], int(matrix[source, target]))
+                for interaction, matrix in matrices.items()
+                for source in range(groups) for target in range(groups)]
+
+    def __retention(self, active, size, users, ages, today):
+        weeks = self.__retention_weeks
+        # Weeks start on Monday; 1970-01-01 was a Thursday
+        this_week = (today + 3) // 7
+        first_cohort = this_week - weeks + 1
+        cohort_of = np.full(size, -1, dtype=np.int64)
+        cohort_of[users['user_id']] = np.where(users['created_day'] >= 0, (users['created_day'] + 3) // 7, -1)
+
+        in_cohorts = (cohort_of[users['user_id']] >= first_cohort) & (cohort_of[users['user_id']] <= this_week)
+        cohort_users = users['user_id'][in_cohorts]
+        sizes = by_age(cohort_of[cohort_users] - first_cohort, ages[cohort_users], weeks)
+
+        # Each (user, week) once, then weeks since the user's signup week
+        active_weeks = distinct((active // size + 3) // 7 * size + active % size)
+        week, user_ids = active_weeks // size, active_weeks % size
+        cohort = cohort_of[user_ids]
+        mask = (cohort >= first_cohort) & (cohort <= this_week) & (week >= cohort) & (week <= this_week)
+        cohort_index, since, user_ids = cohort[mask] - first_cohort, week[mask] - cohort[mask], user_ids[mask]
+        retained = by_age(cohort_index * weeks + since, ages[user_ids], weeks * weeks).reshape(weeks, weeks, -1)
+
+        rows = []
+        for index in range(weeks):
+            if not sizes[index].any():
+                continue  # Nobody signed up that week
+            cohort_week = day_to_date((first_cohort + index) * 7 - 3)
+            for since in range(weeks - index):
+                rows.append((cohort_week, 'all', since, int(sizes[index].sum()), int(retained[index, since].sum())))
+                rows.extend((cohort_week, age_group, since, int(sizes[index, code]), int(retained[index, since, code]))
+                            for code, age_group in enumerate(AGE_GROUPS) if sizes[index, code])
+        return rows
+
+    def __badge_funnel(self, tables, size, ages):
+        types = len(ACTION_TYPES)
+        actions, daily = tables['user_actions'], tables['user_action_daily']
+        user_ids = np.concatenate([actions['user_id'], daily['user_id']])
+        action_types = np.concatenate([actions['action_type'], daily['action_type']])
+        counts = np.concatenate([actions['count'], daily['count']])
+        known = action_types >= 0
+        # Actions per user and type, one row per user_id
+        totals = np.bincount(user_ids[known] * types + action_types[known], weights=counts[known],
+                             minlength=size * types).reshape(size, types)
+
+        existing = np.zeros(size, dtype=bool)
+        existing[tables['users']['user_id']] = True
+        earned_pairs = tables['user_badges']
+
+        rows = []
+        badges = tables['badges']
+        for badge_id, action_type, required in zip(badges['badge_id'], badges['action_type'],
+                                                   badges['progress_required']):
+            earned = np.zeros(size, dtype=bool)
+            earned[earned_pairs['user_id'][earned_pairs['badge_id'] == badge_id]] = True
+            if action_type >= 0:
+                started = (totals[:, action_type] > 0) | earned
+                halfway = (totals[:, action_type] * 2 >= required) | earned
+            else:
+                started = halfway = earned
+            stages = [np.bincount(ages[stage & existing], minlength=len(AGE_GROUPS))
+                      for stage in (started, halfway, earned)]
+            rows.append((int(badge_id), 'all', *(int(stage.sum()) for stage in stages)))
+            rows.extend((int(badge_id), age_group, *(int(stage[code]) for stage in stages))
+                        for code, age_group in enumerate(AGE_GROUPS))
+        return rows
+
+    def store(self, name, rollups, export_seconds, compute_seconds):
+        """Replace the rollup tables with a run's results in one transaction"""
+        conn = sqlite3.connect(self.__db_name)
+        cursor = conn.cursor()
+        install_rollup_tables(cursor)
+        for table, rows in rollups.items():
+            cursor.execute(f'DELETE FROM {table}')
+            if rows:
+                cursor.executemany(f'INSERT INTO {table} VALUES ({", ".join("?" for _ in rows[0])})', rows)
+        cursor.execute('''
+        INSERT INTO analytics_runs (snapshot, export_seconds, compute_seconds) VALUES (?, ?, ?)
+        ''', (name, export_seconds, compute_seconds))
+        conn.commit()
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute the BondBuddies engagement analytics')
+    parser.add_argument('command', choices=['run', 'list'])
+    parser.add_argument('--db', default='BondBuddies.db')
+    parser.add_argument('--snapshot-dir')
+    parser.add_argument('--keep', type=int, default=3)
+    args = parser.parse_args()
+
+    job = AnalyticsJob(args.db, snapshot_dir=args.snapshot_dir, keep=args.keep)
+
+    if args.command == 'run':
+        print(job.run_once())
+    else:
+        for name in job.list_snapshots():
+            print(name)
+
+
+if __name__ == '__main__':
+    main()
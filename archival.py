@@ -0,0 +1,259 @@
+"""Archival of old activity and notifications out of the hot database.
+
+    python archival.py enable-incremental-vacuum [--db BondBuddies.db]
+
+Databases created before incremental auto-vacuum was turned on need that
+one-time switch, a full VACUUM that rewrites the file under an exclusive
+lock, so run it while the app is stopped. Until then the archiver's vacuum
+step does nothing.
+"""
+import argparse
+import os
+import sqlite3
+import threading
+
+
+def get_archive_name(db_name):
+    """Where archived notifications of a database go unless told otherwise"""
+    root, ext = os.path.splitext(db_name)
+    return f'{root}_archive{ext or ".db"}'
+
+
+class DataArchiver:
+    """Keeps the hot database small by moving old rows out of it.
+
+    - user_actions older than `action_retention_days` are rolled up into
+      per-user daily counts in user_action_daily (badge checks read both).
+    - Read notifications older than `notification_retention_days` are moved
+      into a separate archive database file.
+    - Pages freed by the deletes are handed back with incremental vacuum,
+      on databases already in incremental auto-vacuum mode (see
+      enable_incremental_vacuum for older ones).
+
+    Each step runs over every shard of a sharded database in turn.
+
+    Work is done in small batches so no single transaction holds the writer
+    lock for long. Call start() to run it periodically on a background thread.
+    """
+
+    def __init__(self, database, action_retention_days=90, notification_retention_days=30,
+                 interval=3600, batch_size=2000, archive_name=None):
+        self.__database = database
+        self.__action_retention_days = action_retention_days
+        self.__notification_retention_days = notification_retention_days
+        self.__interval = interval
+        self.__batch_size = batch_size
+        self.__archive_name = archive_name or get_archive_name(database.db_name)
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def get_archive_name(self):
+        return self.__archive_name
+
+    # =============== BACKGROUND RUNNER ===============
+
+    def start(self):
+        """Run the archiver every `interval` seconds on a daemon thread"""
+        if self.__thread is not None and self.__thread.is_alive():
+            return
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run, name='data-archiver', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """Stop the background thread after its current batch"""
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def __run(self):
+        while not self.__stop.is_set():
+            try:
+                self.run_once()
+            except sqlite3.Error as e:
+                print(f"Archiver error: {e}")
+            self.__stop.wait(self.__interval)
+
+    def run_once(self):
+        """Run every archival step once, returns how many rows each step moved"""
+        return {
+            'actions_rolled_up': self.roll_up_actions(),
+            'notifications_archived': self.archive_notifications(),
+            'pages_vacuumed': self.vacuum(),
+        }
+
+    # =============== ARCHIVAL STEPS ===============
+
+    def roll_up_actions(self):
+        """Fold old user_actions rows into user_action_daily, returns rows removed"""
+        conn = self.__database.get_connection()
+        cursor = conn.cursor()
+        cutoff = f'-{self.__action_retention_days} days'
+        total = 0
+
+        for shard in self.__database.get_shards(conn):
+            while not self.__stop.is_set():
+                cursor.execute(f'''
+                SELECT MAX(action_id) FROM (
+                    SELECT action_id FROM {shard}.user_actions
+                    WHERE performed_at < datetime('now', ?)
+                    ORDER BY action_id
+                    LIMIT ?
+                )
+                ''', (cutoff, self.__batch_size))
+                last_id = cursor.fetchone()[0]
+                if last_id is None:
+                    break
+
+                cursor.execute(f'''
+                INSERT INTO {shard}.user_action_daily (user_id, action_type, action_day, action_count)
+                SELECT user_id, action_type, date(performed_at), COUNT(*)
+                FROM {shard}.user_actions
+                WHERE action_id <= ? AND performed_at < datetime('now', ?)
+                GROUP BY user_id, action_type, date(performed_at)
+                ON CONFLICT (user_id, action_type, action_day)
+                DO UPDATE SET action_count = action_count + excluded.action_count
+                ''', (last_id, cutoff))
+                cursor.execute(f'''
+                DELETE FROM {shard}.user_actions
+                WHERE action_id <= ? AND performed_at < datetime('now', ?)
+                ''', (last_id, cutoff))
+                total += cursor.rowcount
+                conn.commit()
+
+        conn.close()
+        return total
+
+    def archive_notifications(self):
+        """Move old read notifications into the archive database, returns rows moved"""
+        conn = self.__database.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('ATTACH DATABASE ? AS archive', (self.__archive_name,))
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archive.notifications (
+            notification_id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            notification_type TEXT NOT NULL,
+            message TEXT NOT NULL,
+            related_id INTEGER,
+            is_read INTEGER DEFAULT 1,
+            created_at TIMESTAMP
+        )
+        ''')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS archive.idx_archived_notifications_user
+        ON notifications(user_id, created_at)
+        ''')
+        conn.commit()
+
+        cutoff = f'-{self.__notification_retention_days} days'
+        total = 0
+        for shard in self.__database.get_shards(conn):
+            while not self.__stop.is_set():
+                cursor.execute(f'''
+                SELECT notification_id FROM {shard}.notifications
+                WHERE is_read = 1 AND created_at < datetime('now', ?)
+                ORDER BY notification_id
+                LIMIT ?
+                ''', (cutoff, self.__batch_size))
+                ids = [row[0] for row in cursor.fetchall()]
+                if not ids:
+                    break
+
+                placeholders = ', '.join('?' for _ in ids)
+                cursor.execute(f'''
+                INSERT OR REPLACE INTO archive.notifications
+                    (notification_id, user_id, notification_type, message, related_id, is_read, created_at)
+                SELECT notification_id, user_id, notification_type, message, related_id, is_read, created_at
+                FROM {shard}.notifications
+                WHERE notification_id IN ({placeholders})
+                ''', ids)
+                cursor.execute(f'DELETE FROM {shard}.notifications WHERE notification_id IN ({placeholders})', ids)
+                total += cursor.rowcount
+                conn.commit()
+
+        cursor.execute('DETACH DATABASE archive')
+        conn.close()
+        return total
+
+    def vacuum(self, max_pages=1000):
+        """Return free pages to the filesystem, returns the number of pages freed (per file at most max_pages)"""
+        conn = self.__database.get_connection()
+        cursor = conn.cursor()
+        freed = 0
+        for schema in self.__database.get_all_schemas(conn):
+            cursor.execute(f'PRAGMA {schema}.auto_vacuum')
+            if cursor.fetchone()[0] != 2:
+                # Switching modes means a full VACUUM, which is left to the offline command
+                continue
+            cursor.execute(f'PRAGMA {schema}.freelist_count')
+            free_pages = cursor.fetchone()[0]
+            # Each step of the pragma frees one page; execute() steps once, executescript() runs it to the end
+            cursor.executescript(f'PRAGMA {schema}.incremental_vacuum({int(max_pages)})')
+            freed += min(free_pages, max_pages)
+        conn.close()
+        return freed
+
+    # =============== ARCHIVE READS ===============
+
+    def get_archived_notifications(self, user_id, limit=50):
+        """Get a user's archived notifications, newest first"""
+        if not os.path.exists(self.__archive_name):
+            return []
+        conn = sqlite3.connect(self.__archive_name)
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT * FROM notifications
+        WHERE user_id = ?
+        ORDER BY created_at DESC
+        LIMIT ?
+        ''', (user_id, limit))
+        notifications = cursor.fetchall()
+        conn.close()
+        return notifications
+
+    def delete_archived_notifications(self, user_id):
+        """Remove a deleted user's archived notifications, returns rows removed"""
+        if not os.path.exists(self.__archive_name):
+            return 0
+        conn = sqlite3.connect(self.__archive_name)
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM notifications WHERE user_id = ?', (user_id,))
+        removed = cursor.rowcount
+        conn.commit()
+        conn.close()
+        return removed
+
+
+def enable_incremental_vacuum(db_name):
+    """Switch an existing database to incremental auto-vacuum, returns False if it already was.
+
+    This rewrites the whole file with VACUUM, holding an exclusive lock until
+    it finishes, so only run it with the app stopped.
+    """
+    conn = sqlite3.connect(db_name, isolation_level=None)
+    try:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+            return False
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+        return True
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline maintenance for the archiver')
+    parser.add_argument('command', choices=['enable-incremental-vacuum'])
+    parser.add_argument('--db', default='BondBuddies.db')
+    args = parser.parse_args()
+
+    if enable_incremental_vacuum(args.db):
+        print(f'{args.db} now uses incremental auto-vacuum')
+    else:
+        print(f'{args.db} already uses incremental auto-vacuum')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncDataBase:
+    """Asyncio front end for DataBase.
+
+    Every public DataBase method is available under the same name as a
+    coroutine, e.g. `await async_db.get_user_stats(user_id)`. Calls run on a
+    dedicated thread pool whose threads each keep their own pinned sqlite3
+    connection, so the event loop never blocks on disk and independent queries
+    can run together with asyncio.gather().
+    """
+
+    def __init__(self, database, max_workers=8):
+        self.__database = database
+        self.__executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix='async-db',
+            initializer=database.pin_connection
+        )
+        self.__methods = {}
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        method = self.__methods.get(name)
+        if method is None:
+            method = self.__wrap(name, getattr(self.__database, name))
+            self.__methods[name] = method
+        return method
+
+    def __wrap(self, name, attribute):
+        if not callable(attribute):
+            return attribute
+
+        @functools.wraps(attribute)
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            # Carry the caller's context variables (e.g. a request trace) onto the pool thread
+            context = contextvars.copy_context()
+            return await loop.run_in_executor(self.__executor,
+                                              functools.partial(context.run, attribute, *args, **kwargs))
+        return call
+
+    async def run(self, func, *args, **kwargs):
+        """Run any blocking callable (e.g. password hashing) on the database pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.__executor, functools.partial(func, *args, **kwargs))
+
+    def shutdown(self, wait=True):
+        self.__executor.shutdown(wait=wait)
@@ -0,0 +1,142 @@
+import hashlib
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps
+
+PLACEHOLDER_URL = '/static/img/avatar-placeholder.svg'
+
+
+def resize_avatar(source_path, target_dir, sizes):
+    """Write a square PNG thumbnail of every size into `target_dir` (runs in a worker process)"""
+    with Image.open(source_path) as image:
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+        os.makedirs(target_dir, exist_ok=True)
+        for size in sizes:
+            thumbnail = ImageOps.fit(image, (size, size), Image.LANCZOS)
+            # Written aside and renamed so a half-written file is never served
+            temp_path = os.path.join(target_dir, f'.{size}.{os.getpid()}.png')
+            thumbnail.save(temp_path, 'PNG', optimize=True)
+            os.replace(temp_path, os.path.join(target_dir, f'{size}.png'))
+    return target_dir
+
+
+class AvatarTooLarge(ValueError):
+    """The upload is over the pipeline's max_bytes"""
+
+
+class AvatarPipeline:
+    """Takes avatar uploads off the request thread.
+
+    save_upload() streams the upload to a temp file in `chunk_size` pieces,
+    hashing as it goes, and returns straight away. Resizing into every size in
+    `sizes` runs on a process pool, and the results are stored by content hash
+    under static/avatars/<ab>/<hash>/<size>.png, so the same picture uploaded twice
+    is stored and processed once. Until a user's avatar is ready the caller
+    shows PLACEHOLDER_URL; when it is, users.avatar_url is pointed at it.
+    """
+
+    def __init__(self, database, static_dir='static', sizes=(32, 64, 128, 256), display_size=128,
+                 max_workers=2, chunk_size=64 * 1024, max_bytes=5 * 1024 * 1024):
+        self.__database = database
+        self.__avatar_dir = os.path.join(static_dir, 'avatars')
+        self.__upload_dir = os.path.join(self.__avatar_dir, 'uploads')
+        self.__sizes = tuple(sizes)
+        self.__display_size = display_size
+        self.__max_workers = max_workers
+        self.__chunk_size = chunk_size
+        self.__max_bytes = max_bytes
+        self.__lock = threading.Lock()
+        self.__pool = None
+        self.__jobs = {}  # user_id -> (status, avatar_url)
+        self.__latest = {}  # user_id -> digest of their most recent upload
+        os.makedirs(self.__upload_dir, exist_ok=True)
+
+    def save_upload(self, user_id, stream):
+        """Store an uploaded image and queue it for resizing, returns (status, avatar_url)"""
+        digest, upload_path = self.__stream_to_disk(stream)
+        with self.__lock:
+            self.__latest[user_id] = digest
+        target_dir = os.path.join(self.__avatar_dir, digest[:2], digest)
+
+        # Already processed for someone (or an earlier upload), nothing left to do
+        if all(os.path.exists(os.path.join(target_dir, f'{size}.png')) for size in self.__sizes):
+            os.remove(upload_path)
+            avatar_url = self.get_avatar_url(digest)
+            self.__database.update_user(user_id, avatar_url=avatar_url)
+            self.__set_job(user_id, 'ready', avatar_url)
+            return 'ready', avatar_url
+
+        self.__set_job(user_id, 'processing', PLACEHOLDER_URL)
+        future = self.__get_pool().submit(resize_avatar, upload_path, target_dir, self.__sizes)
+        future.add_done_callback(lambda done: self.__finish(user_id, digest, upload_path, done))
+        return 'processing', PLACEHOLDER_URL
+
+    def get_status(self, user_id):
+        """Status of a user's latest upload as (status, avatar_url), None if there is none"""
+        return self.__jobs.get(user_id)
+
+    def get_max_bytes(self):
+        return self.__max_bytes
+
+    def get_avatar_url(self, digest, size=None):
+        """URL of one size of a stored avatar, the display size by default"""
+        return f'/static/avatars/{digest[:2]}/{digest}/{size or self.__display_size}.png'
+
+    def shutdown(self):
+        with self.__lock:
+            if self.__pool is not None:
+                self.__pool.shutdown(wait=True)
+                self.__pool = None
+
+    def __stream_to_disk(self, stream):
+        """Copy the upload to a temp file chunk by chunk, returns (sha256 hex digest, path)"""
+        digest = hashlib.sha256()
+        size = 0
+        descriptor, upload_path = tempfile.mkstemp(dir=self.__upload_dir)
+        try:
+            with os.fdopen(descriptor, 'wb') as upload:
+                while True:
+                    chunk = stream.read(self.__chunk_size)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > self.__max_bytes:
+                        raise AvatarTooLarge(f'Avatar is larger than {self.__max_bytes} bytes')
+                    digest.update(chunk)
+                    upload.write(chunk)
+        except BaseException:
+            os.remove(upload_path)
+            raise
+        if size == 0:
+            os.remove(upload_path)
+            raise ValueError('Avatar upload is empty')
+        return digest.hexdigest(), upload_path
+
+    def __finish(self, user_id, digest, upload_path, future):
+        os.remove(upload_path)
+        if self.__latest.get(user_id) != digest:
+            return  # A newer upload replaced this one while it was processing
+        if future.exception() is not None:
+            # Not an image Pillow can read, the previous avatar stays
+            print(f"Avatar processing failed for user {user_id}: {future.exception()}")
+            self.__set_job(user_id, 'failed', None)
+            return
+
+        avatar_url = self.get_avatar_url(digest)
+        self.__database.update_user(user_id, avatar_url=avatar_url)
+        self.__set_job(user_id, 'ready', avatar_url)
+
+    def __set_job(self, user_id, status, avatar_url):
+        with self.__lock:
+            self.__jobs[user_id] = (status, avatar_url)
+
+    def __get_pool(self):
+        # Started on first use so importing the app does not fork workers
+        with self.__lock:
+            if self.__pool is None:
+                self.__pool = ProcessPoolExecutor(max_workers=self.__max_workers)
+            return self.__pool
@@ -0,0 +1,278 @@
+"""Online backups of the BondBuddies database.
+
+    python backup.py backup [--db BondBuddies.db] [--no-compress] [--keep 7]
+    python backup.py list
+    python backup.py verify <snapshot>
+    python backup.py restore <snapshot> [--db BondBuddies.db]
+"""
+import argparse
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+from datetime import datetime
+
+from archival import get_archive_name
+from sharding import read_shard_names
+
+
+class BackupRestarted(Exception):
+    """The source changed too often for a backup with the current step size to finish"""
+
+
+class BackupManager:
+    """Point-in-time snapshots taken with SQLite's online backup API.
+
+    Pages are copied `pages_per_step` at a time with a `step_sleep` pause in
+    between, and the source is only read-locked during a step, so writers such
+    as like_post or insert_post wait at most one short step. A write from
+    another connection makes SQLite restart the copy; after `max_restarts`
+    restarts the step size is doubled (up to copying everything in one step)
+    so a busy database still gets backed up.
+
+    Each snapshot is a directory under `backup_dir` holding the database file,
+    its shard files if it has any and, once the archiver has created it, the
+    archive database of old notifications (all gzip-compressed unless
+    `compress` is off) plus a manifest.json. Only the newest `keep` snapshots
+    are kept. Every file is copied at its own point in time: a transaction
+    spanning the main database and a shard can be in one copy and not yet in
+    the other.
+    """
+
+    def __init__(self, db_name, backup_dir=None, archive_name=None, pages_per_step=256, step_sleep=0.005,
+                 max_restarts=5, compress=True, keep=7):
+        self.__db_name = db_name
+        self.__archive_name = archive_name or get_archive_name(db_name)
+        if backup_dir is None:
+            root, _ = os.path.splitext(db_name)
+            backup_dir = f'{root}_backups'
+        self.__backup_dir = backup_dir
+        self.__pages_per_step = pages_per_step
+        self.__step_sleep = step_sleep
+        self.__max_restarts = max_restarts
+        self.__compress = compress
+        self.__keep = keep
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def get_backup_dir(self):
+        return self.__backup_dir
+
+    # =============== BACKGROUND RUNNER ===============
+
+    def start(self, interval=86400):
+        """Take a snapshot every `interval` seconds on a daemon thread, the first one now if there is none"""
+        if self.__thread is not None and self.__thread.is_alive():
+            return
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run, args=(interval,), name='backup', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def __run(self, interval):
+        # A new install should not go a whole interval without any snapshot
+        delay = interval if self.list_snapshots() else 0
+        while not self.__stop.wait(delay):
+            try:
+                self.backup()
+            except (sqlite3.Error, OSError) as e:
+                print(f"Backup error: {e}")
+            delay = interval
+
+    # =============== BACKUP ===============
+
+    def backup(self):
+        """Take a snapshot of the database, its shards and its archive, returns the snapshot's name"""
+        name = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        os.makedirs(self.__backup_dir, exist_ok=True)
+        # Built under a temporary name so a half-written snapshot is never listed
+        partial_dir = os.path.join(self.__backup_dir, f'.{name}.partial')
+        os.makedirs(partial_dir)
+
+        try:
+            files = []
+            # The archiver moves notifications out of the database (or its shards) and into the archive
+            # in one transaction, so copying in this order can only catch a batch in both, never in neither
+            for source_name in (self.__db_name, *read_shard_names(self.__db_name), self.__archive_name):
+                if not os.path.exists(source_name):
+                    continue
+                file_name = os.path.basename(source_name)
+                target_path = os.path.join(partial_dir, file_name)
+                pages = self.copy_database(source_name, target_path)
+                if self.__compress:
+                    with open(target_path, 'rb') as raw, gzip.open(f'{target_path}.gz', 'wb') as packed:
+                        shutil.copyfileobj(raw, packed, 1024 * 1024)
+                    os.remove(target_path)
+                    file_name += '.gz'
+                files.append({'name': file_name, 'source': os.path.basename(source_name), 'pages': pages})
+
+            with open(os.path.join(partial_dir, 'manifest.json'), 'w') as manifest:
+                json.dump({'created_at': datetime.now().isoformat(timespec='seconds'), 'files': files}, manifest)
+            os.rename(partial_dir, os.path.join(self.__backup_dir, name))
+        except BaseException:
+            shutil.rmtree(partial_dir, ignore_errors=True)
+            raise
+
+        self.rotate()
+        return name
+
+    def copy_database(self, source_name, target_path):
+        """Copy one database file with the online backup API, returns its page count"""
+        pages_per_step = self.__pages_per_step
+        while True:
+            restarts = 0
+            last_remaining = None
+
+            def progress(status, remaining, total):
+                nonlocal restarts, last_remaining
+                # Remaining pages going back up means a write restarted the copy
+                if last_remaining is not None and remaining > last_remaining:
+                    restarts += 1
+                    if restarts > self.__max_restarts and pages_per_step > 0:
+                        raise BackupRestarted()
+                last_remaining = remaining
+
+            source = sqlite3.connect(source_name)
+            target = sqlite3.connect(target_path)
+            try:
+                source.backup(target, pages=pages_per_step, progress=progress, sleep=self.__step_sleep)
+                return target.execute('PRAGMA page_count').fetchone()[0]
+            except BackupRestarted:
+                # Bigger steps finish in fewer gaps for writers to land in
+                pages_per_step = pages_per_step * 2 if pages_per_step < 65536 else -1
+            finally:
+                target.close()
+                source.close()
+
+    def rotate(self):
+        """Delete all but the newest `keep` snapshots, returns the names removed"""
+        removed = self.list_snapshots()[:-self.__keep] if self.__keep else []
+        for name in removed:
+            shutil.rmtree(os.path.join(self.__backup_dir, name))
+        return removed
+
+    def list_snapshots(self):
+        """Names of the finished snapshots, oldest first"""
+        if not os.path.isdir(self.__backup_dir):
+            return []
+        return sorted(entry for entry in os.listdir(self.__backup_dir)
+                      if not entry.startswith('.')
+                      and os.path.exists(os.path.join(self.__backup_dir, entry, 'manifest.json')))
+
+    def get_manifest(self, name):
+        with open(os.path.join(self.__backup_dir, name, 'manifest.json')) as manifest:
+            return json.load(manifest)
+
+    # =============== VERIFY AND RESTORE ===============
+
+    def verify(self, name):
+        """Run PRAGMA integrity_check on every file of a snapshot, returns {file: result}"""
+        results = {}
+        for entry in self.get_manifest(name)['files']:
+            with self.__open_copy(name, entry) as path:
+                results[entry['name']] = self.__integrity_check(path)
+        return results
+
+    def restore(self, name):
+        """Verify a snapshot and copy it over the live database files, returns the files restored.
+
+        Pages are written through the backup API into the live files, so open
+        connections see the restored data on their next transaction.
+        """
+        manifest = self.get_manifest(name)
+        failed = {file: result for file, result in self.verify(name).items() if result != 'ok'}
+        if failed:
+            raise sqlite3.DatabaseError(f'Snapshot {name} failed integrity check: {failed}')
+
+        restored = []
+        for entry in manifest['files']:
+            if entry['source'] == os.path.basename(self.__archive_name):
+                target_name = self.__archive_name
+            elif entry['source'] == os.path.basename(self.__db_name):
+                target_name = self.__db_name
+            else:
+                # A shard, kept next to the database
+                target_name = os.path.join(os.path.dirname(self.__db_name), entry['source'])
+            with self.__open_copy(name, entry) as path:
+                source = sqlite3.connect(path)
+                target = sqlite3.connect(target_name)
+                try:
+                    source.backup(target)
+                finally:
+                    target.close()
+                    source.close()
+            restored.append(target_name)
+        return restored
+
+    def __open_copy(self, name, entry):
+        return _SnapshotFile(os.path.join(self.__backup_dir, name, entry['name']))
+
+    def __integrity_check(self, path):
+        conn = sqlite3.connect(path)
+        try:
+            rows = [row[0] for row in conn.execute('PRAGMA integrity_check')]
+        except sqlite3.DatabaseError as e:
+            return str(e)
+        finally:
+            conn.close()
+        return 'ok' if rows == ['ok'] else '; '.join(rows)
+
+
+class _SnapshotFile:
+    """Context manager giving a plain database path for a (possibly gzipped) snapshot file"""
+
+    def __init__(self, path):
+        self.__path = path
+        self.__temp_path = None
+
+    def __enter__(self):
+        if not self.__path.endswith('.gz'):
+            return self.__path
+        descriptor, self.__temp_path = tempfile.mkstemp(suffix='.db')
+        with os.fdopen(descriptor, 'wb') as raw, gzip.open(self.__path, 'rb') as packed:
+            shutil.copyfileobj(packed, raw, 1024 * 1024)
+        return self.__temp_path
+
+    def __exit__(self, *exc_info):
+        if self.__temp_path is not None:
+            os.remove(self.__temp_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Back up and restore the BondBuddies database')
+    parser.add_argument('command', choices=['backup', 'list', 'verify', 'restore'])
+    parser.add_argument('snapshot', nargs='?')
+    parser.add_argument('--db', default='BondBuddies.db')
+    parser.add_argument('--backup-dir')
+    parser.add_argument('--keep', type=int, default=7)
+    parser.add_argument('--no-compress', action='store_true')
+    args = parser.parse_args()
+
+    manager = BackupManager(args.db, backup_dir=args.backup_dir,
+                            compress=not args.no_compress, keep=args.keep)
+
+    if args.command == 'backup':
+        print(manager.backup())
+    elif args.command == 'list':
+        for name in manager.list_snapshots():
+            print(name)
+    elif args.snapshot is None:
+        parser.error(f'{args.command} needs a snapshot name')
+    elif args.command == 'verify':
+        for file_name, result in manager.verify(args.snapshot).items():
+            print(f'{file_name}: {result}')
+    else:
+        for target_name in manager.restore(args.snapshot):
+            print(f'restored {target_name}')
+
+
+if __name__ == '__main__':
+    main()
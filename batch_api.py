@@ -0,0 +1,117 @@
+import sqlite3
+
+MAX_QUERIES = 20
+
+# Never sent to a client, whatever fields are asked for
+HIDDEN_FIELDS = {'password', 'fingerprint'}
+
+# Queries a batch may run, as name -> settings. `method` is the DataBase
+# method, `user` whether the logged-in user's id is passed as its first
+# argument, and `params` the optional arguments a client may give, as
+# name -> (type, upper bound for numbers or None). `columns` names the fields
+# of methods that build plain tuples rather than returning query rows.
+BATCH_QUERIES = {
+    'user': {'method': 'get_user_by_id', 'user': True, 'params': {}},
+    'stats': {'method': 'get_user_stats', 'user': True, 'params': {}},
+    'badges': {'method': 'get_user_badges', 'user': True, 'params': {},
+               'columns': ('badge_id', 'badge_name', 'badge_description', 'badge_type', 'criteria',
+                           'progress_required', 'progress_type', 'created_at',
+                           'current_progress', 'earned_date', 'earned')},
+    'notifications': {'method': 'get_notifications', 'user': True,
+                      'params': {'unread_only': (bool, None), 'after_id': (int, None), 'limit': (int, 100)}},
+    'unread_count': {'method': 'get_unread_notification_count', 'user': True, 'params': {}},
+    'follow_requests': {'method': 'get_pending_follow_requests', 'user': True, 'params': {}},
+    'feed': {'method': 'get_ranked_feed', 'user': True, 'params': {'limit': (int, 50)}},
+    'my_posts': {'method': 'get_posts_by_user', 'user': True, 'params': {'category': (str, None)}},
+    'upcoming_events': {'method': 'get_upcoming_events', 'user': False,
+                        'params': {'game_type': (str, None), 'location': (str, None), 'limit': (int, 50)}},
+}
+
+
+def parse_batch(body):
+    """Validate a batch request body, returns [(id, query name, params, fields or None)].
+
+    The body is {"queries": [{"id": "feed", "query": "feed", "params": {"limit": 10},
+    "fields": ["post_id", "content"]}, ...]}; id defaults to the query name.
+    Raises ValueError describing the first problem found.
+    """
+    if not isinstance(body, dict) or not isinstance(body.get('queries'), list):
+        raise ValueError('Body must be a JSON object with a "queries" list')
+    queries = body['queries']
+    if not 1 <= len(queries) <= MAX_QUERIES:
+        raise ValueError(f'Give between 1 and {MAX_QUERIES} queries')
+
+    parsed = []
+    seen = set()
+    for query in queries:
+        if not isinstance(query, dict) or query.get('query') not in BATCH_QUERIES:
+            raise ValueError(f'Unknown query, expected one of: {", ".join(sorted(BATCH_QUERIES))}')
+        name = query['query']
+        query_id = str(query.get('id', name))
+        if query_id in seen:
+            raise ValueError(f'Duplicate query id {query_id!r}')
+        seen.add(query_id)
+
+        params = {}
+        allowed = BATCH_QUERIES[name]['params']
+        for param, value in (query.get('params') or {}).items():
+            if param not in allowed:
+                raise ValueError(f'{query_id}: unknown parameter {param!r}')
+            kind, upper = allowed[param]
+            if kind is int:
+                if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+                    raise ValueError(f'{query_id}: {param} must be a non-negative integer')
+                value = min(value, upper) if upper is not None else value
+            elif not isinstance(value, kind):
+                raise ValueError(f'{query_id}: {param} must be a {kind.__name__}')
+            params[param] = value
+
+        fields = query.get('fields')
+        if fields is not None and (not isinstance(fields, list) or not all(isinstance(f, str) for f in fields)):
+            raise ValueError(f'{query_id}: fields must be a list of names')
+        parsed.append((query_id, name, params, set(fields) if fields is not None else None))
+    return parsed
+
+
+def to_json(value, fields=None, columns=None):
+    """Rows as dicts of the selected fields, without HIDDEN_FIELDS"""
+    if isinstance(value, list):
+        return [to_json(item, fields, columns) for item in value]
+    if isinstance(value, sqlite3.Row):
+        value = dict(zip(value.keys(), value))
+    elif isinstance(value, tuple) and columns is not None:
+        value = dict(zip(columns, value))
+    if isinstance(value, dict):
+        return {key: item for key, item in value.items()
+                if key not in HIDDEN_FIELDS and (fields is None or key in fields)}
+    return value
+
+
+class BatchExecutor:
+    """Runs a batch of whitelisted read queries for one user in a single round-trip.
+
+    Every query in the batch shares one connection and one read transaction,
+    so they all see the same snapshot of the database, and rows come back
+    as sqlite3.Row so they can be returned by column name. A query that
+    fails is reported in its own result and does not stop the others.
+    """
+
+    def __init__(self, database):
+        self.__database = database
+
+    def run(self, user_id, queries):
+        """Run parsed queries, returns {id: {"data": ...} or {"error": ...}}"""
+        results = {}
+        with self.__database.unit_of_work(row_factory=sqlite3.Row):
+            for query_id, name, params, fields in queries:
+                settings = BATCH_QUERIES[name]
+                method = getattr(self.__database, settings['method'])
+                args = (user_id,) if settings['user'] else ()
+                try:
+                    data = method(*args, **params)
+                except sqlite3.Error as e:
+                    print(f"Batch query error: {e}")
+                    results[query_id] = {'error': 'Query failed'}
+                    continue
+                results[query_id] = {'data': to_json(data, fields, settings.get('columns'))}
+        return results
@@ -0,0 +1,115 @@
+"""Compare thread-per-request against asyncio for the home page's queries.
+
+Each simulated request loads what the home page needs: the user row, stats,
+badges and unread notifications. The threaded run does the four queries one
+after another per request on a pool of request threads; the async run awaits
+them together through AsyncDataBase.
+
+    python benchmarks/bench_async.py --users 200 --requests 2000 --concurrency 32
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from async_database import AsyncDataBase
+from database import DataBase
+
+
+def seed(db, users):
+    user_ids = []
+    with db.unit_of_work():
+        for i in range(users):
+            user_id = db.insert_user(f'user{i}', 'x', 'S' if i % 2 else 'Y',
+                                     age_group='senior' if i % 2 else 'youth')
+            user_ids.append(user_id)
+            for j in range(5):
+                db.insert_post(f'post {j} from user {i}', user_id)
+        for i, user_id in enumerate(user_ids):
+            db.like_post(i + 1, user_ids[(i + 1) % users])
+            db.insert_comment(i + 1, user_ids[(i + 2) % users], 'nice')
+    return user_ids
+
+
+def load_home_sync(db, user_id):
+    db.get_user_by_id(user_id)
+    db.get_user_stats(user_id)
+    db.get_user_badges(user_id)
+    db.get_notifications(user_id, unread_only=True)
+
+
+async def load_home_async(async_db, user_id):
+    await asyncio.gather(
+        async_db.get_user_by_id(user_id),
+        async_db.get_user_stats(user_id),
+        async_db.get_user_badges(user_id),
+        async_db.get_notifications(user_id, unread_only=True)
+    )
+
+
+def run_threaded(db, user_ids, requests, concurrency):
+    latencies = []
+
+    def one(i):
+        started = time.perf_counter()
+        load_home_sync(db, user_ids[i % len(user_ids)])
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(requests)))
+    return time.perf_counter() - started, latencies
+
+
+def run_async(db, user_ids, requests, concurrency, workers):
+    async_db = AsyncDataBase(db, max_workers=workers)
+    latencies = []
+
+    async def main():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one(i):
+            async with semaphore:
+                started = time.perf_counter()
+                await load_home_async(async_db, user_ids[i % len(user_ids)])
+                latencies.append(time.perf_counter() - started)
+
+        await asyncio.gather(*(one(i) for i in range(requests)))
+
+    started = time.perf_counter()
+    asyncio.run(main())
+    elapsed = time.perf_counter() - started
+    async_db.shutdown()
+    return elapsed, latencies
+
+
+def report(name, elapsed, latencies):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f'{name:<10} {len(latencies) / elapsed:8.0f} req/s   '
+          f'p50 {statistics.median(latencies) * 1000:7.2f} ms   p95 {p95 * 1000:7.2f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--workers', type=int, default=8, help='AsyncDataBase pool size')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DataBase(os.path.join(tmp, 'bench.db'))
+        user_ids = seed(db, args.users)
+        report('threaded', *run_threaded(db, user_ids, args.requests, args.concurrency))
+        report('async', *run_async(db, user_ids, args.requests, args.concurrency, args.workers))
+
+
+if __name__ == '__main__':
+    main()
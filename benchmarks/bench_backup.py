@@ -0,0 +1,100 @@
+"""Measure how much an online backup slows down foreground writes.
+
+A writer thread keeps liking and creating posts the way the routes do while
+a backup runs, and the latency of each call is recorded. Small steps keep
+each read lock short; a single-step backup holds the lock for the whole
+copy and writers queue behind it.
+
+    python benchmarks/bench_backup.py --posts 100000 --steps 64 1024 -1
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backup import BackupManager
+from database import DataBase
+
+
+def populate(db, posts):
+    user_id = db.insert_user('bench', 'x', 'S')
+    conn = sqlite3.connect(db.db_name)
+    conn.executemany('INSERT INTO posts (content, user_id) VALUES (?, ?)',
+                     (('x' * 500, user_id) for _ in range(posts)))
+    conn.commit()
+    conn.close()
+    return user_id
+
+
+def measure(db, user_id, posts, run_backup):
+    """Latencies of foreground writes while `run_backup` runs (or for 2 seconds)"""
+    latencies = []
+    errors = 0
+    done = threading.Event()
+
+    def writer():
+        nonlocal errors
+        rng = random.Random(1)
+        while not done.is_set():
+            started = time.perf_counter()
+            try:
+                if rng.random() < 0.8:
+                    db.like_post(rng.randint(1, posts), user_id)
+                else:
+                    db.insert_post('benchmark post', user_id)
+            except sqlite3.OperationalError:
+                errors += 1  # database is locked past the busy timeout
+            latencies.append(time.perf_counter() - started)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    started = time.perf_counter()
+    if run_backup is None:
+        time.sleep(2)
+    else:
+        run_backup()
+    elapsed = time.perf_counter() - started
+    done.set()
+    thread.join()
+    return elapsed, latencies, errors
+
+
+def report(label, elapsed, latencies, errors):
+    latencies = sorted(latencies)
+    p99 = latencies[int(len(latencies) * 0.99) - 1] if latencies else 0
+    print(f'{label:<18} {elapsed:6.2f}s  writes {len(latencies):6d}  '
+          f'p50 {statistics.median(latencies) * 1000:7.2f} ms  p99 {p99 * 1000:8.2f} ms  '
+          f'max {latencies[-1] * 1000:8.2f} ms  errors {errors}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--posts', type=int, default=100000)
+    parser.add_argument('--steps', type=int, nargs='+', default=[64, 1024, -1],
+                        help='pages per backup step, -1 copies everything in one step')
+    parser.add_argument('--compress', action='store_true')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DataBase(os.path.join(tmp, 'bench.db'))
+        user_id = populate(db, args.posts)
+        size_mb = os.path.getsize(db.db_name) / 1024 / 1024
+        print(f'database: {args.posts} posts, {size_mb:.0f} MB')
+
+        report('no backup', *measure(db, user_id, args.posts, None))
+        for pages in args.steps:
+            manager = BackupManager(db.db_name, backup_dir=os.path.join(tmp, f'backups{pages}'),
+                                    pages_per_step=pages, compress=args.compress)
+            report(f'backup step {pages}', *measure(db, user_id, args.posts, manager.backup))
+        db.activity_buffer.close()
+
+
+if __name__ == '__main__':
+    main()
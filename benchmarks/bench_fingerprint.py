@@ -0,0 +1,105 @@
+"""Measure what near-duplicate detection adds to insert_post().
+
+Fills a database with posts built from a small vocabulary (with a share of
+chain messages repeated with small edits), reindexes them with one worker
+and with a process pool, then times insert_post() with the SimHash stage
+enabled and disabled, and DuplicateDetector.find() on its own.
+
+    python benchmarks/bench_fingerprint.py --posts 100000 --inserts 2000 --workers 4
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import DataBase
+from fingerprint import simhash
+
+WORDS = ('today my grandson granddaughter visited and we played mahjong at the community centre '
+         'cooked dinner for family friends garden flowers morning walk park weather rain sunny '
+         'learned how to use video calls phone photos remember when I was young school kampung '
+         'market kopi tea breakfast bus train church temple song dance class exercise doctor').split()
+
+CHAIN = ('Forward this message to {n} friends and good luck will come to you within {d} days, '
+         'do not break the chain!')
+
+
+def make_post(rng):
+    if rng.random() < 0.05:
+        return CHAIN.format(n=rng.choice(['ten', '10', 'twelve']), d=rng.choice(['seven', '7']))
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(6, 40)))
+
+
+def populate(db, posts, seed=1):
+    rng = random.Random(seed)
+    user_id = db.insert_user('bench', 'x', 'S')
+    conn = sqlite3.connect(db.db_name)
+    batch = []
+    for i in range(posts):
+        batch.append((make_post(rng), user_id))
+        if len(batch) == 50000 or i == posts - 1:
+            conn.executemany('INSERT INTO posts (content, user_id) VALUES (?, ?)', batch)
+            conn.commit()
+            batch = []
+    conn.close()
+    return user_id
+
+
+def time_inserts(db, user_id, contents):
+    latencies = []
+    for content in contents:
+        started = time.perf_counter()
+        db.insert_post(content, user_id)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
+
+
+def report(label, latencies):
+    latencies = sorted(latencies)
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f'{label:<22} p50 {statistics.median(latencies):7.3f} ms   p99 {p99:7.3f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--posts', type=int, default=100000)
+    parser.add_argument('--inserts', type=int, default=2000)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_name = os.path.join(tmp, 'bench.db')
+        db = DataBase(db_name, buffer_actions=False)
+        user_id = populate(db, args.posts)
+        print(f'inserted {args.posts} posts')
+
+        for workers in (1, args.workers):
+            started = time.perf_counter()
+            db.reindex_duplicates(workers=workers)
+            print(f'reindex, {workers} worker(s): {time.perf_counter() - started:7.2f}s')
+        conn = sqlite3.connect(db_name)
+        flagged = conn.execute('SELECT COUNT(*) FROM posts WHERE duplicate_of IS NOT NULL').fetchone()[0]
+        conn.close()
+        print(f'{flagged} posts flagged as duplicates, {db.duplicate_detector.get_count()} indexed')
+
+        rng = random.Random(2)
+        contents = [make_post(rng) for _ in range(args.inserts)]
+        fingerprints = [simhash(content) for content in contents]
+        started = time.perf_counter()
+        for fingerprint in fingerprints:
+            db.duplicate_detector.find(fingerprint)
+        print(f'find():               {(time.perf_counter() - started) / len(fingerprints) * 1000:7.3f} ms/lookup')
+
+        report('insert, detection on', time_inserts(db, user_id, contents))
+        plain = DataBase(db_name, buffer_actions=False, detect_duplicates=False)
+        report('insert, detection off', time_inserts(plain, user_id, contents))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Compare nearest-event lookups through the R*Tree with a full scan of events.
+
+Fills a database with upcoming events at random points across Singapore,
+then times get_nearby_events() (expanding bounding boxes on event_locations)
+against fetching every upcoming event and sorting by distance in Python,
+which is what "events near me" cost without the index.
+
+    python benchmarks/bench_geo.py --events 1000000 --queries 20
+"""
+import argparse
+import heapq
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import DataBase
+from geo import distance_km
+
+# Roughly the extent of Singapore
+MIN_LAT, MAX_LAT = 1.22, 1.47
+MIN_LON, MAX_LON = 103.60, 104.05
+GAME_TYPES = ['mahjong', 'blackjack', 'big2', 'other']
+
+
+def populate(db, events, seed=1):
+    rng = random.Random(seed)
+    user_id = db.insert_user('bench', 'x', 'S')
+    conn = sqlite3.connect(db.db_name)
+    batch = []
+    for i in range(events):
+        batch.append((f'Event {i}', 60, '2099-01-01 10:00:00', 'Singapore', 8, user_id,
+                      rng.choice(GAME_TYPES), rng.uniform(MIN_LAT, MAX_LAT), rng.uniform(MIN_LON, MAX_LON)))
+        if len(batch) == 50000 or i == events - 1:
+            # The insert trigger adds each event to the R*Tree as well
+            conn.executemany('''
+            INSERT INTO events (event_name, event_duration, event_date, location, max_participants,
+                                user_id, game_type, latitude, longitude)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', batch)
+            conn.commit()
+            batch = []
+    conn.close()
+
+
+def full_scan(db, latitude, longitude, limit):
+    conn = sqlite3.connect(db.db_name)
+    rows = conn.execute('''
+    SELECT e.*, u.username FROM events e
+    JOIN users u ON e.user_id = u.user_id
+    WHERE e.event_date >= datetime('now') AND e.latitude IS NOT NULL AND u.deleted_at IS NULL
+    ''').fetchall()
+    conn.close()
+    return heapq.nsmallest(limit, rows, key=lambda row: distance_km(latitude, longitude, row[12], row[13]))
+
+
+def timed(function, points):
+    started = time.perf_counter()
+    results = [function(latitude, longitude) for latitude, longitude in points]
+    return (time.perf_counter() - started) / len(points), results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--events', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=20)
+    parser.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DataBase(os.path.join(tmp, 'bench.db'), buffer_actions=False)
+        started = time.perf_counter()
+        populate(db, args.events)
+        print(f'inserted {args.events} events in {time.perf_counter() - started:.1f}s')
+
+        rng = random.Random(2)
+        points = [(rng.uniform(MIN_LAT, MAX_LAT), rng.uniform(MIN_LON, MAX_LON)) for _ in range(args.queries)]
+
+        rtree_time, rtree_results = timed(lambda lat, lon: db.get_nearby_events(lat, lon, limit=args.limit), points)
+        scan_time, scan_results = timed(lambda lat, lon: full_scan(db, lat, lon, args.limit), points)
+
+        # Both must find the same events
+        for indexed, scanned in zip(rtree_results, scan_results):
+            assert [row[0] for row in indexed] == [row[0] for row in scanned]
+
+        print(f'R*Tree:    {rtree_time * 1000:9.2f} ms/query')
+        print(f'full scan: {scan_time * 1000:9.2f} ms/query  ({scan_time / rtree_time:.0f}x slower)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""Measure write throughput with the user-owned tables split across shard files.
+
+Worker processes (not threads, so the GIL stays out of the numbers) create
+and like posts for random users as fast as they can. Unsharded, every write
+queues for the one database's write lock; with N shards, writes for users on
+different shards commit side by side, and the lock waits that are left show
+up in the p99 latency. Actions are written unbuffered, inside each call's
+own transaction, so a like for another shard's post commits to two files.
+The cost of the scatter-gather reads is shown too: get_all_posts() merging
+the newest posts of every shard.
+
+Side-by-side commits need a core per worker (and gain most where commits
+wait on fsync). On fewer cores the workers take turns on the CPU anyway, and
+what is left to see is the price of sharding: more files per connection,
+two-file commits for cross-shard likes and a merge in every feed read.
+
+    python benchmarks/bench_sharding.py --workers 8 --seconds 5 --shards 0 2 4 8
+
+0 shards is the unsharded database.
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import DataBase
+
+
+def open_db(db_path, shard_count=None):
+    return DataBase(db_path, buffer_actions=False, detect_duplicates=False, shard_count=shard_count)
+
+
+def populate(db_path, shard_count, users, posts_per_user):
+    """Create the users and a first batch of posts to like, returns (user_ids, post_ids)"""
+    db = open_db(db_path, shard_count or None)
+    user_ids = [db.insert_user(f'user{i}', 'x', 'S') for i in range(users)]
+    post_ids = []
+    with db.unit_of_work():
+        for user_id in user_ids:
+            post_ids.extend(db.insert_post('first posts', user_id) for _ in range(posts_per_user))
+    db.prompt_selector.close()
+    return user_ids, post_ids
+
+
+def worker(db_path, user_ids, post_ids, seconds, seed, barrier, results):
+    db = open_db(db_path)
+    db.pin_connection()  # As AsyncDataBase's threads do, shards stay attached between calls
+    rng = random.Random(seed)
+    latencies = []
+    errors = 0
+    barrier.wait()
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        user_id = rng.choice(user_ids)
+        started = time.perf_counter()
+        try:
+            if rng.random() < 0.5:
+                db.insert_post('benchmark post', user_id)
+            else:
+                db.like_post(rng.choice(post_ids), user_id)
+        except sqlite3.OperationalError:
+            errors += 1  # database is locked past the busy timeout
+        latencies.append(time.perf_counter() - started)
+    db.prompt_selector.close()
+    results.put((latencies, errors))
+
+
+def measure(db_path, shard_count, args):
+    user_ids, post_ids = populate(db_path, shard_count, args.users, args.posts_per_user)
+    barrier = multiprocessing.Barrier(args.workers)
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=worker, args=(db_path, user_ids, post_ids, args.seconds, seed,
+                                                            barrier, results))
+               for seed in range(args.workers)]
+    for process in workers:
+        process.start()
+    outcomes = [results.get() for _ in workers]
+    for process in workers:
+        process.join()
+
+    latencies = sorted(latency for outcome in outcomes for latency in outcome[0])
+    errors = sum(outcome[1] for outcome in outcomes)
+
+    db = open_db(db_path)
+    started = time.perf_counter()
+    for _ in range(args.reads):
+        db.get_all_posts(limit=50)
+    read_ms = (time.perf_counter() - started) / args.reads * 1000
+    db.prompt_selector.close()
+    return len(latencies) / args.seconds, latencies, errors, read_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--shards', type=int, nargs='+', default=[0, 2, 4, 8])
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--users', type=int, default=256)
+    parser.add_argument('--posts-per-user', type=int, default=20)
+    parser.add_argument('--reads', type=int, default=200, help='get_all_posts calls to time afterwards')
+    parser.add_argument('--dir', help='where to create the databases (default: a temporary directory)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        for shard_count in args.shards:
+            db_path = os.path.join(tmp, f'bench{shard_count}.db')
+            per_second, latencies, errors, read_ms = measure(db_path, shard_count, args)
+            p50 = latencies[len(latencies) // 2] * 1000
+            p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+            label = f'{shard_count} shards' if shard_count else 'unsharded'
+            print(f'{label:<10} writes/s {per_second:8.0f}  p50 {p50:7.2f} ms  p99 {p99:8.2f} ms  '
+                  f'errors {errors}  get_all_posts {read_ms:6.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+import sqlite3
+import threading
+import time
+
+# Captured tables as table -> (user column, related column or None). Each change
+# is logged as (table_name, op, row_id, user_id, related_id): enough to find the
+# cached entries to drop or patch, without copying the row itself.
+CAPTURED_TABLES = {
+    'users': ('user_id', None),
+    'posts': ('user_id', None),
+    'following': ('follower_id', 'followed_id'),
+    'user_badges': ('user_id', 'badge_id'),
+    'events': ('user_id', None),
+    'notifications': ('user_id', None),
+}
+
+# Seconds since the epoch, with sub-second precision
+NOW = "((julianday('now') - 2440587.5) * 86400.0)"
+
+
+def install_change_capture(cursor, tables=None):
+    """Create change_log and the triggers that append to it, for every captured table or just `tables`"""
+    cursor.execute(f'''
+    CREATE TABLE IF NOT EXISTS change_log (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        table_name TEXT NOT NULL,
+        op TEXT NOT NULL CHECK(op IN ('I', 'U', 'R', 'D')),
+        row_id INTEGER NOT NULL,
+        user_id INTEGER,
+        related_id INTEGER,
+        changed_at REAL NOT NULL DEFAULT {NOW}
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_change_log_changed_at ON change_log(changed_at)')
+
+    for table in CAPTURED_TABLES if tables is None else tables:
+        user_column, related_column = CAPTURED_TABLES[table]
+        for event, op, row in (('INSERT', "'I'", 'NEW'), ('UPDATE', "'U'", 'NEW'), ('DELETE', "'D'", 'OLD')):
+            if table == 'users' and event == 'UPDATE':
+                # 'R' marks a rename, the username index has to drop the old name
+                op = "CASE WHEN OLD.username IS NOT NEW.username THEN 'R' ELSE 'U' END"
+            related = f'{row}.{related_column}' if related_column else 'NULL'
+            cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_cdc_{table}_{event.lower()} AFTER {event} ON {table}
+            BEGIN
+                INSERT INTO change_log (table_name, op, row_id, user_id, related_id)
+                VALUES ('{table}', {op}, {row}.rowid, {row}.{user_column}, {related});
+            END
+            ''')
+
+
+def remove_change_capture(cursor):
+    """Drop the change capture triggers (replicas apply changes without logging them)"""
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'trg\\_cdc\\_%' ESCAPE '\\'")
+    for (name,) in cursor.fetchall():
+        cursor.execute(f'DROP TRIGGER "{name}"')
+
+
+class ChangeSubscriber:
+    """Tails change_log so in-process caches follow writes made by any process.
+
+    Handlers are registered per table with subscribe() and called with the
+    list of new changes, each a (seq, table_name, op, row_id, user_id,
+    related_id) tuple, from a background thread. Every `poll_interval`
+    seconds the subscriber checks PRAGMA data_version on its own connection,
+    which only moves when another connection commits, so an idle database
+    costs no query. Changes made by this process come back too; handlers
+    must be safe to run twice.
+
+    Entries older than `retention` seconds are compacted away every
+    `compact_interval` seconds. A subscriber that finds a gap (it fell behind
+    compaction) runs the reset handlers instead, which reload from scratch.
+
+    A sharded database has a change_log in every shard file as well, each
+    tailed from its own position; changes are in order within a shard.
+    """
+
+    def __init__(self, database, poll_interval=0.05, batch_size=1000, retention=600, compact_interval=60):
+        self.__database = database
+        self.__poll_interval = poll_interval
+        self.__batch_size = batch_size
+        self.__retention = retention
+        self.__compact_interval = compact_interval
+        self.__handlers = {}  # table_name -> list of callables
+        self.__reset_handlers = []
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.__conn = None
+        self.__data_versions = {}  # schema -> PRAGMA data_version at the last poll
+        self.__last_seqs = {}  # schema -> last change_log seq dispatched
+        self.__compacted_at = time.monotonic()
+
+    def subscribe(self, table_name, handler):
+        """Call handler(changes) with every batch of new changes to a table"""
+        if table_name not in CAPTURED_TABLES:
+            raise ValueError(f'Changes to {table_name} are not captured')
+        self.__handlers.setdefault(table_name, []).append(handler)
+
+    def on_reset(self, handler):
+        """Call handler() when changes were missed and caches have to be rebuilt"""
+        self.__reset_handlers.append(handler)
+
+    def get_last_seq(self, schema='main'):
+        return self.__last_seqs.get(schema)
+
+    # =============== BACKGROUND RUNNER ===============
+
+    def start(self):
+        if self.__thread is not None and self.__thread.is_alive():
+            return
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run, name='change-subscriber', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        if self.__conn is not None:
+            self.__conn.close()
+            self.__conn = None
+
+    def __run(self):
+        while not self.__stop.is_set():
+            try:
+                self.poll()
+                if time.monotonic() - self.__compacted_at >= self.__compact_interval:
+                    self.compact()
+            except sqlite3.Error as e:
+                print(f"Change subscriber error: {e}")
+            self.__stop.wait(self.__poll_interval)
+
+    # =============== TAILING ===============
+
+    def poll(self):
+        """Dispatch every change committed since the last poll, returns how many"""
+        if self.__conn is None:
+            # Opened here so it belongs to the thread that polls
+            self.__conn = sqlite3.connect(self.__database.db_name, check_same_thread=False)
+        return sum(self.__poll_schema(schema) for schema in self.__database.get_all_schemas(self.__conn))
+
+    def __poll_schema(self, schema):
+        cursor = self.__conn.cursor()
+
+        if schema not in self.__last_seqs:
+            # Only changes from now on matter, caches were just loaded from the tables
+            cursor.execute(f'SELECT COALESCE(MAX(seq), 0) FROM {schema}.change_log')
+            self.__last_seqs[schema] = cursor.fetchone()[0]
+
+        data_version = cursor.execute(f'PRAGMA {schema}.data_version').fetchone()[0]
+        if data_version == self.__data_versions.get(schema):
+            return 0
+        self.__data_versions[schema] = data_version
+
+        dispatched = 0
+        while True:
+            last_seq = self.__last_seqs[schema]
+            cursor.execute(f'''
+            SELECT seq, table_name, op, row_id, user_id, related_id FROM {schema}.change_log
+            WHERE seq > ?
+            ORDER BY seq
+            LIMIT ?
+            ''', (last_seq, self.__batch_size))
+            changes = cursor.fetchall()
+            if not changes:
+                break
+
+            if changes[0][0] > last_seq + 1:
+                self.__reset()
+            else:
+                by_table = {}
+                for change in changes:
+                    by_table.setdefault(change[1], []).append(change)
+                for table_name, table_changes in by_table.items():
+                    for handler in self.__handlers.get(table_name, []):
+                        self.__call(handler, table_changes)
+            self.__last_seqs[schema] = changes[-1][0]
+            dispatched += len(changes)
+        return dispatched
+
+    def compact(self, batch_size=5000):
+        """Delete entries older than the retention period, returns how many"""
+        self.__compacted_at = time.monotonic()
+        conn = self.__database.get_connection()
+        cursor = conn.cursor()
+        removed = 0
+        for schema in self.__database.get_all_schemas(conn):
+            while True:
+                cursor.execute(f'''
+                DELETE FROM {schema}.change_log WHERE seq IN (
+                    SELECT seq FROM {schema}.change_log WHERE changed_at < {NOW} - ? ORDER BY seq LIMIT ?
+                )
+                ''', (self.__retention, batch_size))
+                conn.commit()
+                removed += cursor.rowcount
+                if cursor.rowcount < batch_size:
+                    break
+        conn.close()
+        return removed
+
+    def __reset(self):
+        for handler in self.__reset_handlers:
+            self.__call(handler)
+
+    def __call(self, handler, *args):
+        # One failing cache must not stop the others from hearing about the change
+        try:
+            handler(*args)
+        except Exception as e:
+            print(f"Change handler error: {e}")
@@ -110,7 +110,7 @@ class User:
 
 class Post:
     def __init__(self, post_id, content, user_id, timestamp, likes=0, 
-                 comments=None, post_category=None, post_prompt_id=None):
+                 comments=None, post_category=None, post_prompt_id=None, comment_count=0):
         self.__post_id = post_id
         self.__content = content
         self.__user_id = user_id
@@ -119,6 +119,7 @@ class Post:
         self.__comments = comments if comments is not None else []
         self.__post_category = post_category  # 'youth' or 'senior'
         self.__post_prompt_id = post_prompt_id  # ID of the prompt that inspired this post
+        self.__comment_count = comment_count  # Total comments, may exceed len(comments) when only a preview is loaded
         
     # Accessor methods
     def get_post_id(self):
@@ -137,6 +138,8 @@ class Post:
         return self.__post_category
     def get_post_prompt_id(self):
         return self.__post_prompt_id
+    def get_comment_count(self):
+        return self.__comment_count
     
     # Mutator methods
     def set_post_id(self, post_id):
@@ -160,6 +163,8 @@ class Post:
         self.__post_category = post_category
     def set_post_prompt_id(self, post_prompt_id):
         self.__post_prompt_id = post_prompt_id
+    def set_comment_count(self, comment_count):
+        self.__comment_count = comment_count
     
     @classmethod
     def from_database_row(cls, row_data):
@@ -171,14 +176,16 @@ class Post:
             timestamp=row_data[3],
             likes=row_data[4] if len(row_data) > 4 else 0,
             post_category=row_data[5] if len(row_data) > 5 else None,
-            post_prompt_id=row_data[6] if len(row_data) > 6 else None
+            post_prompt_id=row_data[6] if len(row_data) > 6 else None,
+            comment_count=row_data[7] if len(row_data) > 7 else 0
         )
 
 
 class Event:
     def __init__(self, event_id, event_name, event_itinerary, event_duration,
                  event_date, location, max_participants, user_id, 
-                 game_type=None, game_rules=None, participants=None):
+                 game_type=None, game_rules=None, participants=None, participant_count=0,
+                 latitude=None, longitude=None):
         self.__event_id = event_id
         self.__event_name = event_name
         self.__event_itinerary = event_itinerary
@@ -190,6 +197,9 @@ class Event:
         self.__game_type = game_type  # 'mahjong', 'blackjack', 'big2', 'other'
         self.__game_rules = game_rules
         self.__participants = participants if participants is not None else []
+        self.__participant_count = participant_count  # Stored count, avoids loading participants for event cards
+        self.__latitude = latitude  # Geocoded from location, None if it could not be placed
+        self.__longitude = longitude
         
     # Accessor methods
     def get_event_id(self):
@@ -214,6 +224,12 @@ class Event:
         return self.__game_rules
     def get_participants(self):
         return self.__participants
+    def get_participant_count(self):
+        return self.__participant_count
+    def get_latitude(self):
+        return self.__latitude
+    def get_longitude(self):
+        return self.__longitude
     
     # Mutator methods
     def set_event_id(self, event_id):
@@ -236,6 +252,11 @@ class Event:
         self.__game_type = game_type
     def set_game_rules(self, game_rules):
         self.__game_rules = game_rules
+    def set_participant_count(self, participant_count):
+        self.__participant_count = participant_count
+    def set_coordinates(self, latitude, longitude):
+        self.__latitude = latitude
+        self.__longitude = longitude
     def add_participant(self, user_id):
         if len(self.__participants) < self.__max_participants and user_id not in self.__participants:
             self.__participants.append(user_id)
@@ -260,7 +281,10 @@ class Event:
             max_participants=row_data[6],
             user_id=row_data[7],
             game_type=row_data[8] if len(row_data) > 8 else None,
-            game_rules=row_data[9] if len(row_data) > 9 else None
+            game_rules=row_data[9] if len(row_data) > 9 else None,
+            participant_count=row_data[11] if len(row_data) > 11 else 0,
+            latitude=row_data[12] if len(row_data) > 12 else None,
+            longitude=row_data[13] if len(row_data) > 13 else None
         )
 
 
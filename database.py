@@ -1,18 +1,267 @@
 import sqlite3
 import json
 import os 
+import calendar
+import heapq
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from prompt_selector import PromptSelector
+from reference_cache import ReferenceDataCache
+from unit_of_work import UnitOfWork, PersistentConnection, run_callbacks
+from notification_hub import NotificationHub
+from feed_ranking import FeedRanker
+from activity_buffer import ActivityBuffer
+from username_index import UsernameIndex, install_username_index, is_username_taken
+from geo import Gazetteer, bounding_box, distance_km
+from replication import ReplicaRouter, install_changelog
+from change_capture import CAPTURED_TABLES, ChangeSubscriber, install_change_capture
+from analytics import install_rollup_tables
+from fingerprint import DuplicateDetector, simhash, to_signed
+from sharding import ShardRouter, SHARDED_ID_TABLES, SHARDED_TABLES
+from trending import (TrendingEngine, POST_WEIGHT, LIKE_WEIGHT, COMMENT_WEIGHT, PROMPT_USE_WEIGHT,
+                      EVENT_WEIGHT, PARTICIPANT_WEIGHT)
 
 class DataBase:
-    def __init__(self, db_name='BondBuddies.db'):
+    def __init__(self, db_name='BondBuddies.db', buffer_actions=True,
+                 replication_dir=None, replica_name=None, max_staleness=5.0, detect_duplicates=True,
+                 shard_count=None):
         self.db_name = db_name
+        # User-owned rows are split across this many files when the database was created with shards
+        self.shards = self.init_shards(shard_count)
+        if self.shards is not None and (replication_dir or replica_name):
+            raise ValueError('Sharded databases do not support read replicas')
+        self.__fingerprints_added = False  # Set when posts.fingerprint is migrated in, existing posts need one
+        # Row changes are logged for a ChangeShipper to send to replicas in this directory
+        self.replication_dir = replication_dir
+        # Read-only methods use this replica while it is at most max_staleness seconds behind
+        self.replica_router = ReplicaRouter(replica_name, max_staleness) if replica_name else None
+        self.__local = threading.local()  # Holds the calling thread's unit of work and pinned connection
+        self.__calendar_cache = {}  # (year, month, game_type) -> (loaded_at, days)
+        self.notification_hub = NotificationHub()
+        self.__published_notifications = deque(maxlen=1024)  # Ids this process has pushed itself
+        self.gazetteer = Gazetteer()
         self.init_database()
         self.create_default_data()
+        self.geocode_events()
+        self.reference_cache = ReferenceDataCache(self)
+        self.username_index = UsernameIndex(self)
+        self.prompt_selector = PromptSelector(self)
+        self.feed_ranker = FeedRanker(self)
+        # SimHash near-duplicate lookups on the post write path
+        self.duplicate_detector = None
+        if detect_duplicates:
+            self.duplicate_detector = DuplicateDetector(self)
+            if self.__fingerprints_added:
+                self.duplicate_detector.reindex()
+        self.trending = TrendingEngine(self)
+        # Tracked actions are batched in memory (backed by per-process log files) and written behind
+        self.activity_buffer = None
+        if buffer_actions:
+            root, _ = os.path.splitext(db_name)
+            self.activity_buffer = ActivityBuffer(self, log_path=f'{root}_activity.log')
+        # Keeps the caches above in step with writes from other processes once started
+        self.change_subscriber = ChangeSubscriber(self)
+        self.change_subscriber.subscribe('users', self.username_index.apply_changes)
+        self.change_subscriber.subscribe('posts', self.feed_ranker.apply_changes)
+        if self.duplicate_detector is not None:
+            self.change_subscriber.subscribe('posts', self.duplicate_detector.apply_changes)
+            self.change_subscriber.on_reset(self.duplicate_detector.load)
+        self.change_subscriber.subscribe('events', lambda changes: self.clear_calendar_cache())
+        self.change_subscriber.subscribe('notifications', self.publish_notification_changes)
+        self.change_subscriber.on_reset(self.username_index.load)
+        self.change_subscriber.on_reset(self.feed_ranker.refresh)
+        self.change_subscriber.on_reset(self.clear_calendar_cache)
+
+    # =============== CONNECTION METHODS ===============
+
+    def get_connection(self):
+        """Open a connection, or join the calling thread's unit of work if one is active"""
+        unit = getattr(self.__local, 'unit_of_work', None)
+        if unit is not None:
+            return unit.join()
+        pinned = getattr(self.__local, 'connection', None)
+        if pinned is not None:
+            return pinned
+        return sqlite3.connect(self.db_name)
+
+    def pin_connection(self):
+        """Keep one connection open for every later call made on the calling thread"""
+        if getattr(self.__local, 'connection', None) is None:
+            self.__local.connection = PersistentConnection(self.db_name, attach=self.attach_shards)
+
+    @contextmanager
+    def unit_of_work(self, immediate=False, row_factory=None):
+        """Run several DataBase calls on one connection and commit them together.
+
+        with db.unit_of_work():
+            post_id = db.insert_post(content, user_id)
+            db.check_and_award_badges(user_id)
+
+        Everything commits once at the end of the block, or rolls back if it
+        raises. Nesting opens a savepoint, so an inner block that fails only
+        undoes its own work. Pass immediate=True to take the write lock up front
+        (on every shard too: do so for a unit writing for users on several
+        shards, whose methods cannot order their locks, see lock_shards),
+        and a row_factory (e.g. sqlite3.Row) to change what the outermost block's
+        queries return.
+        """
+        unit = getattr(self.__local, 'unit_of_work', None)
+        if unit is not None:
+            savepoint = unit.savepoint()
+            try:
+                yield self
+            except BaseException:
+                unit.rollback_to(savepoint)
+                raise
+            unit.release(savepoint)
+            return
+
+        unit = UnitOfWork(self.db_name, immediate, row_factory, attach=self.attach_shards)
+        self.__local.unit_of_work = unit
+        try:
+            yield self
+        except BaseException:
+            self.__local.unit_of_work = None
+            unit.rollback()
+            raise
+        self.__local.unit_of_work = None
+        unit.commit()
+
+    def get_read_connection(self):
+        """Open a connection for a read-only method, on the replica when it is fresh enough"""
+        # A unit of work has to see its own uncommitted writes
+        if self.replica_router is not None and getattr(self.__local, 'unit_of_work', None) is None:
+            conn = self.replica_router.connect()
+            if conn is not None:
+                return conn
+        return self.get_connection()
+
+    def get_replica_lag(self):
+        """Seconds the read replica is behind, None without a replica or before it has synced"""
+        if self.replica_router is None:
+            return None
+        return self.replica_router.get_lag()
+
+    def run_after_commit(self, callback):
+        """Run a callback now, or once the active unit of work commits"""
+        unit = getattr(self.__local, 'unit_of_work', None)
+        if unit is not None:
+            unit.after_commit(callback)
+        else:
+            run_callbacks([callback])
+
+    # =============== SHARD METHODS ===============
+
+    def init_shards(self, shard_count=None):
+        """Open the shards the database was created with, or give a new database shard_count of them.
+
+        Returns a ShardRouter, or None for an unsharded database. The shard
+        count is fixed when the database is created: asking for shards on an
+        existing unsharded database, or for a different number, raises
+        ValueError rather than hiding the rows already written.
+        """
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS shards (
+                shard_id INTEGER PRIMARY KEY,
+                file_name TEXT NOT NULL
+            )
+            ''')
+            cursor.execute('SELECT COUNT(*) FROM shards')
+            existing = cursor.fetchone()[0]
+            if existing and shard_count and shard_count != existing:
+                raise ValueError(f'{self.db_name} was created with {existing} shards, not {shard_count}')
+            if not existing and shard_count:
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'posts'")
+                if cursor.fetchone() is not None:
+                    raise ValueError(f'{self.db_name} already holds unsharded data, '
+                                     f'shards can only be set up on a new database')
+                router = ShardRouter(self.db_name, shard_count)
+                cursor.executemany('INSERT INTO shards (shard_id, file_name) VALUES (?, ?)',
+                                   [(index, os.path.basename(name)) for index, name in enumerate(router.shard_names)])
+                conn.commit()
+                return router
+            return ShardRouter(self.db_name, existing) if existing else None
+        finally:
+            conn.close()
+
+    def attach_shards(self, conn):
+        """ATTACH every shard to a connection, before it starts a transaction"""
+        if self.shards is not None:
+            self.shards.attach(conn)
+
+    def get_shard(self, conn, user_id):
+        """Schema of the connection holding a user's posts, actions, notifications and badges.
+
+        Attaches the user's shard when needed, so call it before the method's
+        first write. 'main' when the database has no shards.
+        """
+        if self.shards is None:
+            return 'main'
+        index = self.shards.shard_for_user(user_id)
+        self.shards.attach(conn, [index])
+        return self.shards.get_schema(index)
+
+    def get_row_shard(self, conn, row_id):
+        """Schema holding a post, action, notification or user badge by its id, see get_shard"""
+        if self.shards is None:
+            return 'main'
+        index = self.shards.shard_for_id(row_id)
+        self.shards.attach(conn, [index])
+        return self.shards.get_schema(index)
+
+    def lock_shards(self, conn, schemas):
+        """Take the write locks of every schema a write is about to span, main first then by shard.
+
+        Two transactions writing to the same two files, but locking them in
+        opposite orders, would each hold the lock the other waits for until
+        the busy timeout runs out. Locking up front in one order means a
+        writer only ever waits for one that is already further along. Call
+        it after attaching the schemas and before the first write; None
+        entries are skipped, a single schema needs no ordering.
+        """
+        schemas = sorted({schema for schema in schemas if schema is not None},
+                         key=lambda schema: (schema != 'main', schema))
+        if len(schemas) > 1:
+            for schema in schemas:
+                # Writes nothing, but starts a write transaction on the schema's file
+                conn.execute(f'DELETE FROM {schema}.change_log WHERE 0')
+
+    def get_shards(self, conn):
+        """Every schema holding sharded tables, attaching them all"""
+        if self.shards is None:
+            return ['main']
+        self.shards.attach(conn)
+        return self.shards.get_schemas()
+
+    def get_all_schemas(self, conn):
+        """Schemas of every database file, main first, attaching the shards"""
+        return ['main'] + [schema for schema in self.get_shards(conn) if schema != 'main']
+
+    def union_shards(self, conn, table):
+        """A sharded table across every shard, to select FROM (WHERE and ORDER BY go to each shard's indexes)"""
+        schemas = self.get_shards(conn)
+        if len(schemas) == 1:
+            return f'{schemas[0]}.{table}'
+        return '(' + ' UNION ALL '.join(f'SELECT * FROM {schema}.{table}' for schema in schemas) + ')'
+
+    def get_database_files(self):
+        """The main database file followed by its shard files"""
+        return [self.db_name] + (self.shards.shard_names if self.shards is not None else [])
 
     def init_database(self):
         """Initialize the database and create tables if they don't exist"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_connection()
         cursor = conn.cursor()
 
+        # Only takes effect on a new database, see archival.py for converting older ones
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+
         # Create users table with extended fields
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -25,22 +274,8 @@ class DataBase:
             age_group TEXT CHECK(age_group IN ('youth', 'senior')),
             bio TEXT,
             avatar_url TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        ''')
-
-        # Create posts table with category
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS posts (
-            post_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            content TEXT NOT NULL,
-            user_id INTEGER NOT NULL,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            likes INTEGER DEFAULT 0,
-            post_category TEXT CHECK(post_category IN ('youth', 'senior')),
-            post_prompt_id INTEGER,
-            FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE,
-            FOREIGN KEY (post_prompt_id) REFERENCES post_prompts(prompt_id)
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            deleted_at TIMESTAMP
         )
         ''')
 
@@ -58,6 +293,9 @@ class DataBase:
             game_type TEXT,
             game_rules TEXT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            participant_count INTEGER DEFAULT 0,
+            latitude REAL,
+            longitude REAL,
             FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
         )
         ''')
@@ -89,20 +327,6 @@ class DataBase:
         )
         ''')
 
-        # Create user_badges table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS user_badges (
-            user_badge_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            badge_id INTEGER NOT NULL,
-            current_progress INTEGER DEFAULT 0,
-            earned_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE,
-            FOREIGN KEY (badge_id) REFERENCES badges(badge_id) ON DELETE CASCADE,
-            UNIQUE(user_id, badge_id)
-        )
-        ''')
-
         # Create following table for accepted follows
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS following (
@@ -158,6 +382,152 @@ class DataBase:
         )
         ''')
 
+        # Create trending_scores table, checkpoints of the decayed trending scores
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS trending_scores (
+            kind TEXT NOT NULL CHECK(kind IN ('post', 'prompt', 'game_type')),
+            item_key TEXT NOT NULL,
+            score REAL NOT NULL,
+            scored_at REAL NOT NULL,
+            UNIQUE(kind, item_key)
+        )
+        ''')
+
+        # Create deletion_jobs table, progress of purging tombstoned users and posts
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS deletion_jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            entity_type TEXT NOT NULL CHECK(entity_type IN ('user', 'post')),
+            entity_id INTEGER NOT NULL,
+            status TEXT DEFAULT 'pending' CHECK(status IN ('pending', 'running', 'done')),
+            current_step TEXT,
+            rows_deleted INTEGER DEFAULT 0,
+            requested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            UNIQUE(entity_type, entity_id)
+        )
+        ''')
+
+        # User-owned tables go in the main database, or in each shard when there are shards
+        if self.shards is None:
+            self.init_shard_tables(cursor)
+        else:
+            self.init_shard_files()
+
+        # Columns added after the first release need migrating on existing databases
+        if self.add_column_if_missing(cursor, 'events', 'participant_count', 'INTEGER DEFAULT 0'):
+            cursor.execute('''
+            UPDATE events
+            SET participant_count = (SELECT COUNT(*) FROM event_participants ep WHERE ep.event_id = events.event_id)
+            ''')
+        self.add_column_if_missing(cursor, 'users', 'deleted_at', 'TIMESTAMP')
+        self.add_column_if_missing(cursor, 'events', 'latitude', 'REAL')
+        self.add_column_if_missing(cursor, 'events', 'longitude', 'REAL')
+
+        # Indexes for comment lookups by post
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_comments_post_id ON comments(post_id)')
+
+        # Indexes for date range queries on events
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_events_date ON events(event_date)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_events_game_type_date ON events(game_type, event_date)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_events_location_date ON events(location, event_date)')
+
+        # Index for the deletion worker's queue
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_deletion_jobs_status ON deletion_jobs(status, job_id)')
+
+        # Create event_locations R*Tree, a point per geocoded event kept in step by triggers
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'event_locations'")
+        locations_exist = cursor.fetchone() is not None
+        cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS event_locations USING rtree(
+            event_id, min_lat, max_lat, min_lon, max_lon
+        )
+        ''')
+        if not locations_exist:
+            cursor.execute('''
+            INSERT INTO event_locations (event_id, min_lat, max_lat, min_lon, max_lon)
+            SELECT event_id, latitude, latitude, longitude, longitude
+            FROM events WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+            ''')
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_events_location_insert
+        AFTER INSERT ON events WHEN NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL
+        BEGIN
+            INSERT INTO event_locations (event_id, min_lat, max_lat, min_lon, max_lon)
+            VALUES (NEW.event_id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude);
+        END
+        ''')
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_events_location_update
+        AFTER UPDATE OF latitude, longitude ON events
+        BEGIN
+            DELETE FROM event_locations WHERE event_id = OLD.event_id;
+            INSERT INTO event_locations (event_id, min_lat, max_lat, min_lon, max_lon)
+            SELECT NEW.event_id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude
+            WHERE NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL;
+        END
+        ''')
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_events_location_delete
+        AFTER DELETE ON events
+        BEGIN
+            DELETE FROM event_locations WHERE event_id = OLD.event_id;
+        END
+        ''')
+
+        # Usernames are unique regardless of case, matching the availability check
+        if not install_username_index(cursor):
+            print(f"Usernames in {self.db_name} differ only by case, so they are not yet unique regardless "
+                  f"of case; run: python username_index.py rename-case-clashes --db {self.db_name}")
+
+        # Rollup tables written by the analytics job, read by the dashboard
+        install_rollup_tables(cursor)
+
+        # Compact change records for cache invalidation across processes (the shards log their own)
+        install_change_capture(cursor, [table for table in CAPTURED_TABLES
+                                        if self.shards is None or table not in SHARDED_TABLES])
+
+        # Changelog triggers go last, they list every column of the finished schema
+        if self.replication_dir:
+            install_changelog(cursor)
+
+        conn.commit()
+        conn.close()
+
+    def init_shard_tables(self, cursor):
+        """Create the user-owned tables (see sharding.py) on a cursor of the main database or of a shard"""
+        # Create posts table with category
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS posts (
+            post_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            content TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            likes INTEGER DEFAULT 0,
+            post_category TEXT CHECK(post_category IN ('youth', 'senior')),
+            post_prompt_id INTEGER,
+            comment_count INTEGER DEFAULT 0,
+            deleted_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE,
+            FOREIGN KEY (post_prompt_id) REFERENCES post_prompts(prompt_id)
+        )
+        ''')
+
+        # Create user_badges table
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_badges (
+            user_badge_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            badge_id INTEGER NOT NULL,
+            current_progress INTEGER DEFAULT 0,
+            earned_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE,
+            FOREIGN KEY (badge_id) REFERENCES badges(badge_id) ON DELETE CASCADE,
+            UNIQUE(user_id, badge_id)
+        )
+        ''')
+
         # Create user_actions table for tracking badge progress
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS user_actions (
@@ -171,6 +541,17 @@ class DataBase:
         )
         ''')
 
+        # Create user_action_daily table, old user_actions rolled up per user and day
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_action_daily (
+            user_id INTEGER NOT NULL,
+            action_type TEXT NOT NULL,
+            action_day DATE NOT NULL,
+            action_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, action_type, action_day)
+        ) WITHOUT ROWID
+        ''')
+
         # Create notifications table
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS notifications (
@@ -185,12 +566,101 @@ class DataBase:
         )
         ''')
 
-        conn.commit()
-        conn.close()
+        # Create notification_counters table, unread counts kept up to date by triggers
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'notification_counters'")
+        counters_exist = cursor.fetchone() is not None
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS notification_counters (
+            user_id INTEGER PRIMARY KEY,
+            unread_count INTEGER NOT NULL DEFAULT 0
+        )
+        ''')
+        if not counters_exist:
+            cursor.execute('''
+            INSERT INTO notification_counters (user_id, unread_count)
+            SELECT user_id, COUNT(*) FROM notifications WHERE is_read = 0 GROUP BY user_id
+            ''')
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_notifications_unread_insert
+        AFTER INSERT ON notifications WHEN NEW.is_read = 0
+        BEGIN
+            INSERT INTO notification_counters (user_id, unread_count) VALUES (NEW.user_id, 1)
+            ON CONFLICT (user_id) DO UPDATE SET unread_count = unread_count + 1;
+        END
+        ''')
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_notifications_unread_read
+        AFTER UPDATE OF is_read ON notifications WHEN OLD.is_read = 0 AND NEW.is_read != 0
+        BEGIN
+            UPDATE notification_counters SET unread_count = unread_count - 1 WHERE user_id = NEW.user_id;
+        END
+        ''')
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_notifications_unread_unread
+        AFTER UPDATE OF is_read ON notifications WHEN OLD.is_read != 0 AND NEW.is_read = 0
+        BEGIN
+            INSERT INTO notification_counters (user_id, unread_count) VALUES (NEW.user_id, 1)
+            ON CONFLICT (user_id) DO UPDATE SET unread_count = unread_count + 1;
+        END
+        ''')
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_notifications_unread_delete
+        AFTER DELETE ON notifications WHEN OLD.is_read = 0
+        BEGIN
+            UPDATE notification_counters SET unread_count = unread_count - 1 WHERE user_id = OLD.user_id;
+        END
+        ''')
+
+        # Columns added after the first release need migrating on existing databases
+        if self.add_column_if_missing(cursor, 'posts', 'comment_count', 'INTEGER DEFAULT 0'):
+            cursor.execute('''
+            UPDATE posts
+            SET comment_count = (SELECT COUNT(*) FROM comments c WHERE c.post_id = posts.post_id)
+            ''')
+        self.add_column_if_missing(cursor, 'posts', 'deleted_at', 'TIMESTAMP')
+        if self.add_column_if_missing(cursor, 'posts', 'fingerprint', 'INTEGER'):
+            cursor.execute('SELECT EXISTS (SELECT 1 FROM posts)')
+            self.__fingerprints_added = bool(cursor.fetchone()[0])
+        self.add_column_if_missing(cursor, 'posts', 'duplicate_of', 'INTEGER')
+
+        # Indexes for badge checks and archiving of user_actions
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_actions_user_type ON user_actions(user_id, action_type)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_actions_performed_at ON user_actions(performed_at)')
+
+        # Index for a user's notification list
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_notifications_user ON notifications(user_id, notification_id)')
+
+        # Index for the newest posts first, merged across shards when there are shards
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_posts_timestamp ON posts(timestamp)')
+
+    def init_shard_files(self):
+        """Create the user-owned tables in every shard file, ids starting at each shard's base"""
+        for index, shard_name in enumerate(self.shards.shard_names):
+            conn = sqlite3.connect(shard_name)
+            cursor = conn.cursor()
+            cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            self.init_shard_tables(cursor)
+            # Triggers only write to tables in their own file, so each shard keeps its own change_log
+            install_change_capture(cursor, [table for table in CAPTURED_TABLES if table in SHARDED_TABLES])
+            for table in SHARDED_ID_TABLES:
+                cursor.execute('''
+                INSERT INTO sqlite_sequence (name, seq)
+                SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)
+                ''', (table, self.shards.get_id_base(index), table))
+            conn.commit()
+            conn.close()
+
+    def add_column_if_missing(self, cursor, table, column, definition):
+        """Add a column to an existing table, returns True if it had to be added"""
+        cursor.execute(f'PRAGMA table_info({table})')
+        if column in [row[1] for row in cursor.fetchall()]:
+            return False
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+        return True
 
     def create_default_data(self):
         """Create default badges and prompts"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_connection()
         cursor = conn.cursor()
         
         # Check if badges already exist
@@ -250,61 +720,69 @@ class DataBase:
 
     def insert_user(self, username, password, user_type, email=None, 
                    birth_date=None, age_group=None, bio=None, avatar_url=None):
-        """Insert a new user into the database"""
-        conn = sqlite3.connect(self.db_name)
+        """Insert a new user into the database, returns None if the username is taken"""
+        conn = self.get_connection()
         cursor = conn.cursor()
-        cursor.execute('''
-        INSERT INTO users (username, password, user_type, email, birth_date, age_group, bio, avatar_url)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (username, password, user_type, email, birth_date, age_group, bio, avatar_url))
-        user_id = cursor.lastrowid
-        conn.commit()
+        try:
+            cursor.execute('''
+            INSERT INTO users (username, password, user_type, email, birth_date, age_group, bio, avatar_url)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (username, password, user_type, email, birth_date, age_group, bio, avatar_url))
+            user_id = cursor.lastrowid
+            conn.commit()
+        except sqlite3.IntegrityError as e:
+            if not is_username_taken(e):
+                conn.close()
+                raise
+            user_id = None
         conn.close()
+        if user_id is not None:
+            self.run_after_commit(lambda: self.username_index.add(username, user_id))
         return user_id
     
     def get_user_by_id(self, user_id):
         """Retrieve a specific user by ID"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_connection()
         cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
+        cursor.execute('SELECT * FROM users WHERE user_id = ? AND deleted_at IS NULL', (user_id,))
         user_data = cursor.fetchone()
         conn.close()
         return user_data
     
     def get_user_by_username(self, username):
         """Retrieve a specific user by Username"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_connection()
         cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
+        cursor.execute('SELECT * FROM users WHERE username = ? AND deleted_at IS NULL', (username,))
         user_data = cursor.fetchone()
         conn.close()
         return user_data
 
     def get_all_users(self):
         """Retrieve all users from the database"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_read_connection()
         cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users ORDER BY user_id')
+        cursor.execute('SELECT * FROM users WHERE deleted_at IS NULL ORDER BY user_id')
         users_data = cursor.fetchall()
         conn.close()
         return users_data
     
     def get_users_by_age_group(self, age_group):
         """Retrieve users by age group (youth/senior)"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_read_connection()
         cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE age_group = ? ORDER BY username', (age_group,))
+        cursor.execute('SELECT * FROM users WHERE age_group = ? AND deleted_at IS NULL ORDER BY username', (age_group,))
         users_data = cursor.fetchall()
         conn.close()
         return users_data
     
     def search_users(self, search_term):
         """Search users by username"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_read_connection()
         cursor = conn.cursor()
         cursor.execute('''
         SELECT * FROM users 
-        WHERE username LIKE ? 
+        WHERE username LIKE ? AND deleted_at IS NULL
         ORDER BY username
         ''', (f'%{search_term}%',))
         users_data = cursor.fetchall()
@@ -314,7 +792,7 @@ class DataBase:
     def update_user(self, user_id, username=None, password=None, email=None, 
                    bio=None, avatar_url=None):
         """Update user information"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_connection()
         cursor = conn.cursor()
         
         updates = []
@@ -337,60 +815,83 @@ class DataBase:
             params.append(avatar_url)
         
         if updates:
+            old_username = self.get_username_by_id(user_id, cursor) if username else None
             params.append(user_id)
             query = f"UPDATE users SET {', '.join(updates)} WHERE user_id = ?"
             cursor.execute(query, params)
             conn.commit()
+            
+            # Keep the availability index in step with renames
+            if old_username is not None and old_username != username:
+                def rename():
+                    self.username_index.remove(old_username)
+                    self.username_index.add(username)
+                self.run_after_commit(rename)
         
         conn.close()
     
     def delete_user(self, user_id):
-        """Delete a user from the database"""
-        conn = sqlite3.connect(self.db_name)
+        """Tombstone a user and queue the purge of their data, returns the deletion job id"""
+        conn = self.get_connection()
         cursor = conn.cursor()
-        cursor.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
+        cursor.execute('''
+        UPDATE users SET deleted_at = CURRENT_TIMESTAMP
+        WHERE user_id = ? AND deleted_at IS NULL
+        ''', (user_id,))
+        job_id = self.queue_deletion(cursor, 'user', user_id) if cursor.rowcount else None
         conn.commit()
         conn.close()
+        self.run_after_commit(self.__calendar_cache.clear)
+        return job_id
 
     # =============== POST METHODS ===============
 
     def insert_post(self, content, user_id, post_category=None, post_prompt_id=None):
-        """Insert a new post into the database"""
-        conn = sqlite3.connect(self.db_name)
+        """Insert a new post into the database, flagging it if it repeats an earlier post"""
+        fingerprint = duplicate_of = None
+        if self.duplicate_detector is not None:
+            fingerprint = simhash(content)
+            match = self.duplicate_detector.find(fingerprint)
+            duplicate_of = match[0] if match else None
+        
+        conn = self.get_connection()
         cursor = conn.cursor()
-        cursor.execute('''
-        INSERT INTO posts (content, user_id, post_category, post_prompt_id)
-        VALUES (?, ?, ?, ?)
-        ''', (content, user_id, post_category, post_prompt_id))
+        shard = self.get_shard(conn, user_id)
+        cursor.execute(f'''
+        INSERT INTO {shard}.posts (content, user_id, post_category, post_prompt_id, fingerprint, duplicate_of)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ''', (content, user_id, post_category, post_prompt_id,
+              to_signed(fingerprint) if fingerprint is not None else None, duplicate_of))
         post_id = cursor.lastrowid
         
-        # Increment prompt usage if used
-        if post_prompt_id:
-            cursor.execute('''
-            UPDATE post_prompts 
-            SET times_used = times_used + 1 
-            WHERE prompt_id = ?
-            ''', (post_prompt_id,))
-        
         # Track action for badges
-        cursor.execute('''
-        INSERT INTO user_actions (user_id, action_type, target_id)
-        VALUES (?, 'create_post', ?)
-        ''', (user_id, post_id))
+        self.track_action(user_id, 'create_post', post_id, cursor)
         
         conn.commit()
         conn.close()
+        
+        # Duplicates are kept for their author but collapsed out of shared feeds
+        if duplicate_of is None:
+            if fingerprint is not None:
+                self.run_after_commit(lambda: self.duplicate_detector.add(post_id, fingerprint))
+            self.run_after_commit(lambda: self.feed_ranker.record_post(post_id, user_id, post_category))
+            self.run_after_commit(lambda: self.trending.record('post', post_id, POST_WEIGHT))
+        
+        # Prompt usage is buffered and written back in batches
+        if post_prompt_id:
+            self.run_after_commit(lambda: self.prompt_selector.record_use(post_prompt_id))
+            self.run_after_commit(lambda: self.trending.record('prompt', post_prompt_id, PROMPT_USE_WEIGHT))
         return post_id
     
     def get_post_by_id(self, post_id):
         """Retrieve a specific post by ID"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_read_connection()
         cursor = conn.cursor()
-        cursor.execute('''
+        cursor.execute(f'''
         SELECT p.*, u.username 
-        FROM posts p
+        FROM {self.get_row_shard(conn, post_id)}.posts p
         JOIN users u ON p.user_id = u.user_id
-        WHERE p.post_id = ?
+        WHERE p.post_id = ? AND p.deleted_at IS NULL AND u.deleted_at IS NULL
         ''', (post_id,))
         post_data = cursor.fetchone()
         conn.close()
@@ -398,14 +899,14 @@ class DataBase:
     
     def get_posts_by_user(self, user_id, category=None):
         """Retrieve all posts by a specific user"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_read_connection()
         cursor = conn.cursor()
         
-        query = '''
+        query = f'''
         SELECT p.*, u.username 
-        FROM posts p
+        FROM {self.get_shard(conn, user_id)}.posts p
         JOIN users u ON p.user_id = u.user_id
-        WHERE p.user_id = ?
+        WHERE p.user_id = ? AND p.deleted_at IS NULL AND u.deleted_at IS NULL
         '''
         params = [user_id]
         
@@ -422,14 +923,14 @@ class DataBase:
     
     def get_all_posts(self, category=None, limit=50):
         """Retrieve all posts from the database"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_read_connection()
         cursor = conn.cursor()
         
-        query = '''
+        query = f'''
         SELECT p.*, u.username 
-        FROM posts p
+        FROM {self.union_shards(conn, 'posts')} p
         JOIN users u ON p.user_id = u.user_id
-        WHERE 1=1
+        WHERE p.deleted_at IS NULL AND u.deleted_at IS NULL AND p.duplicate_of IS NULL
         '''
         params = []
         
@@ -447,14 +948,14 @@ class DataBase:
     
     def get_followed_posts(self, user_id):
         """Retrieve posts from users that the current user follows"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_read_connection()
         cursor = conn.cursor()
-        cursor.execute('''
+        cursor.execute(f'''
         SELECT p.*, u.username 
-        FROM posts p
+        FROM {self.union_shards(conn, 'posts')} p
         JOIN users u ON p.user_id = u.user_id
         JOIN following f ON p.user_id = f.followed_id
-        WHERE f.follower_id = ?
+        WHERE f.follower_id = ? AND p.deleted_at IS NULL AND u.deleted_at IS NULL AND p.duplicate_of IS NULL
         ORDER BY p.timestamp DESC
         LIMIT 50
         ''', (user_id,))
@@ -462,36 +963,62 @@ class DataBase:
         conn.close()
         return posts_data
     
+    def get_posts_by_ids(self, post_ids):
+        """Retrieve several posts at once, in the order of `post_ids`"""
+        if not post_ids:
+            return []
+        conn = self.get_read_connection()
+        cursor = conn.cursor()
+        placeholders = ', '.join('?' for _ in post_ids)
+        cursor.execute(f'''
+        SELECT p.*, u.username 
+        FROM {self.union_shards(conn, 'posts')} p
+        JOIN users u ON p.user_id = u.user_id
+        WHERE p.post_id IN ({placeholders}) AND p.deleted_at IS NULL AND u.deleted_at IS NULL
+        ''', list(post_ids))
+        posts = {row[0]: row for row in cursor.fetchall()}
+        conn.close()
+        return [posts[post_id] for post_id in post_ids if post_id in posts]
+    
+    def get_ranked_feed(self, user_id, limit=20):
+        """Retrieve a "For You" feed ranked by engagement, recency, age group and follows"""
+        return self.get_posts_by_ids(self.feed_ranker.rank(user_id, limit))
+    
     def like_post(self, post_id, user_id):
         """Like a post"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_connection()
         cursor = conn.cursor()
+        # The post's shard holds its owner's notifications too
+        shard = self.get_row_shard(conn, post_id)
+        self.lock_shards(conn, [shard, self.prepare_track_action(conn, user_id)])
         
         # Increment like count
-        cursor.execute('UPDATE posts SET likes = likes + 1 WHERE post_id = ?', (post_id,))
+        cursor.execute(f'UPDATE {shard}.posts SET likes = likes + 1 WHERE post_id = ?', (post_id,))
         
         # Track action for badges
-        cursor.execute('''
-        INSERT INTO user_actions (user_id, action_type, target_id)
-        VALUES (?, 'like_post', ?)
-        ''', (user_id, post_id))
+        self.track_action(user_id, 'like_post', post_id, cursor)
         
         # Create notification for post owner
-        cursor.execute('SELECT user_id FROM posts WHERE post_id = ?', (post_id,))
+        notification = None
+        cursor.execute(f'SELECT user_id FROM {shard}.posts WHERE post_id = ?', (post_id,))
         post_owner = cursor.fetchone()
         if post_owner and post_owner[0] != user_id:
-            cursor.execute('''
-            INSERT INTO notifications (user_id, notification_type, message, related_id)
+            cursor.execute(f'''
+            INSERT INTO {shard}.notifications (user_id, notification_type, message, related_id)
             VALUES (?, 'like', ? || ' liked your post', ?)
-            ''', (post_owner[0], self.get_username_by_id(user_id), post_id))
+            ''', (post_owner[0], self.get_username_by_id(user_id, cursor), post_id))
+            notification = (post_owner[0], cursor.lastrowid)
         
         conn.commit()
         conn.close()
+        self.run_after_commit(lambda: self.feed_ranker.record_engagement(post_id, likes=1))
+        self.run_after_commit(lambda: self.trending.record('post', post_id, LIKE_WEIGHT))
+        self.publish_notification(notification)
         return True
     
     def update_post(self, post_id, content=None, likes=None):
         """Update post information"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_connection()
         cursor = conn.cursor()
         
         updates = []
@@ -506,55 +1033,91 @@ class DataBase:
         
         if updates:
             params.append(post_id)
-            query = f"UPDATE posts SET {', '.join(updates)} WHERE post_id = ?"
+            query = f"UPDATE {self.get_row_shard(conn, post_id)}.posts SET {', '.join(updates)} WHERE post_id = ?"
             cursor.execute(query, params)
             conn.commit()
         
         conn.close()
     
     def delete_post(self, post_id):
-        """Delete a post from the database"""
-        conn = sqlite3.connect(self.db_name)
+        """Tombstone a post and queue the purge of its comments, returns the deletion job id"""
+        conn = self.get_connection()
         cursor = conn.cursor()
-        cursor.execute('DELETE FROM posts WHERE post_id = ?', (post_id,))
+        shard = self.get_row_shard(conn, post_id)
+        self.lock_shards(conn, [shard, 'main'])
+        cursor.execute(f'''
+        UPDATE {shard}.posts SET deleted_at = CURRENT_TIMESTAMP
+        WHERE post_id = ? AND deleted_at IS NULL
+        ''', (post_id,))
+        job_id = self.queue_deletion(cursor, 'post', post_id) if cursor.rowcount else None
         conn.commit()
         conn.close()
+        self.run_after_commit(lambda: self.feed_ranker.remove_post(post_id))
+        self.run_after_commit(lambda: self.trending.remove('post', post_id))
+        if self.duplicate_detector is not None:
+            self.run_after_commit(lambda: self.duplicate_detector.remove(post_id))
+        return job_id
+    
+    def get_post_duplicates(self, post_id):
+        """Retrieve the posts flagged as near-duplicates of a post"""
+        conn = self.get_read_connection()
+        cursor = conn.cursor()
+        cursor.execute(f'''
+        SELECT p.*, u.username 
+        FROM {self.union_shards(conn, 'posts')} p
+        JOIN users u ON p.user_id = u.user_id
+        WHERE p.duplicate_of = ? AND p.deleted_at IS NULL AND u.deleted_at IS NULL
+        ORDER BY p.timestamp, p.post_id
+        ''', (post_id,))
+        posts_data = cursor.fetchall()
+        conn.close()
+        return posts_data
+    
+    def reindex_duplicates(self, workers=4):
+        """Fingerprint every post again on a process pool and redo duplicate flags, returns posts indexed"""
+        if self.duplicate_detector is None:
+            return 0
+        return self.duplicate_detector.reindex(workers)
 
     # =============== EVENT METHODS ===============
 
     def insert_event(self, event_name, event_itinerary, event_duration, 
                      event_date, location, max_participants, user_id,
-                     game_type=None, game_rules=None):
-        """Insert a new event into the database"""
-        conn = sqlite3.connect(self.db_name)
+                     game_type=None, game_rules=None, latitude=None, longitude=None):
+        """Insert a new event into the database, geocoding its location unless coordinates are given"""
+        if latitude is None or longitude is None:
+            latitude, longitude = self.gazetteer.geocode(location) or (None, None)
+        
+        conn = self.get_connection()
         cursor = conn.cursor()
+        self.lock_shards(conn, ['main', self.prepare_track_action(conn, user_id)])
         cursor.execute('''
         INSERT INTO events (event_name, event_itinerary, event_duration, 
-                           event_date, location, max_participants, user_id, game_type, game_rules)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                           event_date, location, max_participants, user_id, game_type, game_rules,
+                           latitude, longitude)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         ''', (event_name, event_itinerary, event_duration, event_date, 
-              location, max_participants, user_id, game_type, game_rules))
+              location, max_participants, user_id, game_type, game_rules, latitude, longitude))
         event_id = cursor.lastrowid
         
         # Track action for badges
-        cursor.execute('''
-        INSERT INTO user_actions (user_id, action_type, target_id)
-        VALUES (?, 'create_event', ?)
-        ''', (user_id, event_id))
+        self.track_action(user_id, 'create_event', event_id, cursor)
         
         conn.commit()
         conn.close()
+        self.run_after_commit(self.__calendar_cache.clear)
+        self.run_after_commit(lambda: self.trending.record('game_type', game_type, EVENT_WEIGHT))
         return event_id
     
     def get_event_by_id(self, event_id):
         """Retrieve a specific event by ID"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_read_connection()
         cursor = conn.cursor()
         cursor.execute('''
         SELECT e.*, u.username as organizer
         FROM events e
         JOIN users u ON e.user_id = u.user_id
-        WHERE e.event_id = ?
+        WHERE e.event_id = ? AND u.deleted_at IS NULL
         ''', (event_id,))
         event_data = cursor.fetchone()
         conn.close()
@@ -562,13 +1125,13 @@ class DataBase:
     
     def get_events_by_user(self, user_id):
         """Retrieve all events created by a specific user"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_read_connection()
         cursor = conn.cursor()
         cursor.execute('''
         SELECT e.*, u.username as organizer
         FROM events e
         JOIN users u ON e.user_id = u.user_id
-        WHERE e.user_id = ? 
+        WHERE e.user_id = ? AND u.deleted_at IS NULL
         ORDER BY e.event_date
         ''', (user_id,))
         events_data = cursor.fetchall()
@@ -577,14 +1140,14 @@ class DataBase:
     
     def get_all_events(self, game_type=None):
         """Retrieve all events from the database"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_read_connection()
         cursor = conn.cursor()
         
         query = '''
         SELECT e.*, u.username as organizer
         FROM events e
         JOIN users u ON e.user_id = u.user_id
-        WHERE 1=1
+        WHERE u.deleted_at IS NULL
         '''
         params = []
         
@@ -601,13 +1164,13 @@ class DataBase:
     
     def get_events_by_game_type(self, game_type):
         """Get events by specific game type"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_read_connection()
         cursor = conn.cursor()
         cursor.execute('''
         SELECT e.*, u.username as organizer
         FROM events e
         JOIN users u ON e.user_id = u.user_id
-        WHERE e.game_type = ?
+        WHERE e.game_type = ? AND u.deleted_at IS NULL
         ORDER BY e.event_date
         ''', (game_type,))
         events = cursor.fetchall()
@@ -616,122 +1179,390 @@ class DataBase:
     
     def add_event_participant(self, event_id, user_id):
         """Add a participant to an event"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_connection()
         cursor = conn.cursor()
+        notification = None
+        # The organizer is looked up first, their shard has to be attached before the first write
+        cursor.execute('SELECT user_id, game_type FROM events WHERE event_id = ?', (event_id,))
+        event_organizer = cursor.fetchone()
+        game_type = event_organizer[1] if event_organizer else None
+        shard = self.get_shard(conn, event_organizer[0]) if event_organizer else None
+        self.lock_shards(conn, ['main', shard, self.prepare_track_action(conn, user_id)])
         try:
             cursor.execute('''
             INSERT INTO event_participants (event_id, user_id)
             VALUES (?, ?)
             ''', (event_id, user_id))
+            cursor.execute('UPDATE events SET participant_count = participant_count + 1 WHERE event_id = ?',
+                         (event_id,))
             
             # Track action for badges
-            cursor.execute('''
-            INSERT INTO user_actions (user_id, action_type, target_id)
-            VALUES (?, 'participate_event', ?)
-            ''', (user_id, event_id))
+            self.track_action(user_id, 'participate_event', event_id, cursor)
             
             # Create notification for event organizer
-            cursor.execute('SELECT user_id FROM events WHERE event_id = ?', (event_id,))
-            event_organizer = cursor.fetchone()
             if event_organizer and event_organizer[0] != user_id:
-                cursor.execute('''
-                INSERT INTO notifications (user_id, notification_type, message, related_id)
+                cursor.execute(f'''
+                INSERT INTO {shard}.notifications (user_id, notification_type, message, related_id)
                 VALUES (?, 'event_join', ? || ' joined your event', ?)
-                ''', (event_organizer[0], self.get_username_by_id(user_id), event_id))
+                ''', (event_organizer[0], self.get_username_by_id(user_id, cursor), event_id))
+                notification = (event_organizer[0], cursor.lastrowid)
             
             conn.commit()
             success = True
         except sqlite3.IntegrityError:
             success = False  # User already registered or event doesn't exist
         conn.close()
+        if success:
+            self.run_after_commit(self.__calendar_cache.clear)
+            self.run_after_commit(lambda: self.trending.record('game_type', game_type, PARTICIPANT_WEIGHT))
+            self.publish_notification(notification)
         return success
     
     def get_event_participants(self, event_id):
         """Get all participants for an event"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_read_connection()
         cursor = conn.cursor()
         cursor.execute('''
         SELECT u.user_id, u.username, u.email, u.age_group, ep.joined_at
         FROM event_participants ep
         JOIN users u ON ep.user_id = u.user_id
-        WHERE ep.event_id = ?
+        WHERE ep.event_id = ? AND u.deleted_at IS NULL
         ORDER BY ep.joined_at
         ''', (event_id,))
         participants = cursor.fetchall()
         conn.close()
         return participants
+    
+    def get_upcoming_events(self, start=None, end=None, game_type=None, location=None, limit=50):
+        """Get events from `start` (default now) up to `end`, optionally by game type or location.
+        
+        Rows include the participant_count column so cards need no extra query.
+        """
+        if start is None:
+            start = datetime.now()
+        
+        conn = self.get_read_connection()
+        cursor = conn.cursor()
+        
+        query = '''
+        SELECT e.*, u.username as organizer
+        FROM events e
+        JOIN users u ON e.user_id = u.user_id
+        WHERE e.event_date >= ? AND u.deleted_at IS NULL
+        '''
+        params = [self.format_timestamp(start)]
+        
+        if end is not None:
+            query += ' AND e.event_date < ?'
+            params.append(self.format_timestamp(end))
+        if game_type:
+            query += ' AND e.game_type = ?'
+            params.append(game_type)
+        if location:
+            query += ' AND e.location = ?'
+            params.append(location)
+        
+        query += ' ORDER BY e.event_date LIMIT ?'
+        params.append(limit)
+        
+        cursor.execute(query, params)
+        events = cursor.fetchall()
+        conn.close()
+        return events
+    
+    def get_events_in_box(self, min_lat, max_lat, min_lon, max_lon, start=None, game_type=None, limit=None):
+        """Get upcoming events whose coordinates fall inside a bounding box, via the R*Tree"""
+        if start is None:
+            start = datetime.now()
+        
+        conn = self.get_read_connection()
+        cursor = conn.cursor()
+        
+        query = '''
+        SELECT e.*, u.username as organizer
+        FROM event_locations l
+        JOIN events e ON e.event_id = l.event_id
+        JOIN users u ON e.user_id = u.user_id
+        WHERE l.max_lat >= ? AND l.min_lat <= ? AND l.max_lon >= ? AND l.min_lon <= ?
+          AND e.event_date >= ? AND u.deleted_at IS NULL
+        '''
+        params = [min_lat, max_lat, min_lon, max_lon, self.format_timestamp(start)]
+        
+        if game_type:
+            query += ' AND e.game_type = ?'
+            params.append(game_type)
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
+        
+        cursor.execute(query, params)
+        events = cursor.fetchall()
+        conn.close()
+        return events
+    
+    def get_nearby_events(self, latitude, longitude, radius_km=None, game_type=None, limit=20,
+                          start=None, initial_radius_km=0.5, max_radius_km=50):
+        """Get the nearest upcoming events to a point, closest first, each row ending in distance_km.
+        
+        With `radius_km` only that radius is searched. Otherwise the search box
+        starts at `initial_radius_km` and doubles until `limit` events are found
+        or it reaches `max_radius_km`.
+        """
+        radius = radius_km or min(initial_radius_km, max_radius_km)
+        while True:
+            nearby = []
+            for event in self.get_events_in_box(*bounding_box(latitude, longitude, radius),
+                                                start=start, game_type=game_type):
+                distance = distance_km(latitude, longitude, event[12], event[13])
+                # The box's corners reach past the circle, only keep what is really within it
+                if distance <= radius:
+                    nearby.append(event + (distance,))
+            
+            if radius_km or len(nearby) >= limit or radius >= max_radius_km:
+                return heapq.nsmallest(limit, nearby, key=lambda event: event[-1])
+            radius = min(radius * 2, max_radius_km)
+    
+    def geocode_events(self, batch_size=500):
+        """Fill in coordinates for events whose location the gazetteer can place, returns how many"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT event_id, location FROM events
+        WHERE latitude IS NULL AND location IS NOT NULL
+        ''')
+        updates = []
+        for event_id, location in cursor.fetchall():
+            coordinates = self.gazetteer.geocode(location)
+            if coordinates is not None:
+                updates.append((*coordinates, event_id))
+        
+        for i in range(0, len(updates), batch_size):
+            cursor.executemany('UPDATE events SET latitude = ?, longitude = ? WHERE event_id = ?',
+                               updates[i:i + batch_size])
+            conn.commit()
+        conn.close()
+        return len(updates)
+    
+    def get_events_for_month(self, year, month, game_type=None, max_age=60):
+        """Get a month of events grouped by day of month, cached for `max_age` seconds"""
+        key = (year, month, game_type)
+        cached = self.__calendar_cache.get(key)
+        if cached and time.monotonic() - cached[0] < max_age:
+            return cached[1]
+        
+        days_in_month = calendar.monthrange(year, month)[1]
+        start = datetime(year, month, 1)
+        end = datetime(year + month // 12, month % 12 + 1, 1)
+        
+        days = {day: [] for day in range(1, days_in_month + 1)}
+        for event in self.get_upcoming_events(start, end, game_type=game_type, limit=-1):
+            days[int(event[4][8:10])].append(event)
+        
+        self.__calendar_cache[key] = (time.monotonic(), days)
+        return days
+
+    # =============== TRENDING METHODS ===============
+
+    def get_trending_posts(self, limit=10):
+        """Retrieve the posts with the highest decayed engagement, with their scores"""
+        # A few spare in case some were deleted since they were scored
+        scores = dict(self.trending.top('post', limit + 10))
+        posts = self.get_posts_by_ids(list(scores))[:limit]
+        return [(post, scores[post[0]]) for post in posts]
+
+    def get_trending_prompts(self, limit=10):
+        """Prompt leaderboard by decayed recent use, as (prompt, score) pairs"""
+        prompts = []
+        for prompt_id, score in self.trending.top('prompt', limit + 10):
+            prompt = self.reference_cache.get_prompt(prompt_id)
+            if prompt is not None:
+                prompts.append((prompt, score))
+        return prompts[:limit]
+
+    def get_trending_game_types(self, limit=5):
+        """Event game types by decayed recent events and sign-ups, as (game_type, score) pairs"""
+        return self.trending.top('game_type', limit)
+
+    # =============== ANALYTICS METHODS ===============
+
+    def get_last_analytics_run(self):
+        """The latest analytics run as (run_id, snapshot, finished_at, export_seconds, compute_seconds)"""
+        conn = self.get_read_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM analytics_runs ORDER BY run_id DESC LIMIT 1')
+        run = cursor.fetchone()
+        conn.close()
+        return run
+
+    def get_activity_rollup(self, days=30, age_group='all'):
+        """Daily and weekly active users for the last `days` days of the latest run"""
+        conn = self.get_read_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT day, dau, wau FROM analytics_activity
+        WHERE age_group = ? AND day > (SELECT date(MAX(day), ?) FROM analytics_activity)
+        ORDER BY day
+        ''', (age_group, f'-{days} days'))
+        activity = cursor.fetchall()
+        conn.close()
+        return activity
+
+    def get_interaction_matrix(self):
+        """Interactions between age groups as (interaction, from_age_group, to_age_group, count)"""
+        conn = self.get_read_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT interaction, from_age_group, to_age_group, interaction_count
+        FROM analytics_interactions
+        ORDER BY interaction, from_age_group, to_age_group
+        ''')
+        interactions = cursor.fetchall()
+        conn.close()
+        return interactions
+
+    def get_retention_cohorts(self, age_group='all'):
+        """Weekly signup cohorts as (cohort_week, weeks_since, cohort_size, active_users)"""
+        conn = self.get_read_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT cohort_week, weeks_since, cohort_size, active_users
+        FROM analytics_retention
+        WHERE age_group = ?
+        ORDER BY cohort_week, weeks_since
+        ''', (age_group,))
+        cohorts = cursor.fetchall()
+        conn.close()
+        return cohorts
+
+    def get_badge_funnel(self, age_group='all'):
+        """Per badge, users who started, are halfway and earned it, as (badge_id, badge_name, started, halfway, earned)"""
+        conn = self.get_read_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT f.badge_id, b.badge_name, f.started, f.halfway, f.earned
+        FROM analytics_badge_funnel f
+        JOIN badges b ON f.badge_id = b.badge_id
+        WHERE f.age_group = ?
+        ORDER BY f.badge_id
+        ''', (age_group,))
+        funnel = cursor.fetchall()
+        conn.close()
+        return funnel
 
     # =============== BADGE METHODS ===============
 
     def get_badge_by_id(self, badge_id):
         """Retrieve a specific badge by ID"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM badges WHERE badge_id = ?', (badge_id,))
-        badge_data = cursor.fetchone()
-        conn.close()
-        return badge_data
+        return self.reference_cache.get_badge(badge_id)
     
     def get_all_badges(self):
         """Retrieve all badges"""
-        conn = sqlite3.connect(self.db_name)
+        return list(self.reference_cache.get_badges())
+    
+    def insert_badge(self, badge_name, badge_description, badge_type, criteria=None,
+                     progress_required=1, progress_type='count'):
+        """Insert a new badge"""
+        conn = self.get_connection()
         cursor = conn.cursor()
-        cursor.execute('SELECT * FROM badges ORDER BY badge_id')
-        badges = cursor.fetchall()
+        cursor.execute('''
+        INSERT INTO badges (badge_name, badge_description, badge_type, criteria, progress_required, progress_type)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ''', (badge_name, badge_description, badge_type, criteria, progress_required, progress_type))
+        badge_id = cursor.lastrowid
+        conn.commit()
+        conn.close()
+        self.run_after_commit(self.reference_cache.bump)
+        return badge_id
+    
+    def update_badge(self, badge_id, badge_name=None, badge_description=None, criteria=None,
+                     progress_required=None):
+        """Update badge information"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        updates = []
+        params = []
+        
+        if badge_name:
+            updates.append("badge_name = ?")
+            params.append(badge_name)
+        if badge_description is not None:
+            updates.append("badge_description = ?")
+            params.append(badge_description)
+        if criteria is not None:
+            updates.append("criteria = ?")
+            params.append(criteria)
+        if progress_required is not None:
+            updates.append("progress_required = ?")
+            params.append(progress_required)
+        
+        if updates:
+            params.append(badge_id)
+            query = f"UPDATE badges SET {', '.join(updates)} WHERE badge_id = ?"
+            cursor.execute(query, params)
+            conn.commit()
+            self.run_after_commit(self.reference_cache.bump)
+        
         conn.close()
-        return badges
     
     def assign_badge_to_user(self, user_id, badge_id):
         """Assign a badge to a user"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_connection()
         cursor = conn.cursor()
+        shard = self.get_shard(conn, user_id)
         try:
-            cursor.execute('''
-            INSERT INTO user_badges (user_id, badge_id)
+            cursor.execute(f'''
+            INSERT INTO {shard}.user_badges (user_id, badge_id)
             VALUES (?, ?)
             ''', (user_id, badge_id))
             
             # Create notification
-            cursor.execute('SELECT badge_name FROM badges WHERE badge_id = ?', (badge_id,))
-            badge_name = cursor.fetchone()[0]
-            cursor.execute('''
-            INSERT INTO notifications (user_id, notification_type, message, related_id)
+            badge = self.reference_cache.get_badge(badge_id)
+            badge_name = badge[1] if badge else None
+            cursor.execute(f'''
+            INSERT INTO {shard}.notifications (user_id, notification_type, message, related_id)
             VALUES (?, 'badge', 'You earned the ' || ? || ' badge!', ?)
             ''', (user_id, badge_name, badge_id))
+            notification = (user_id, cursor.lastrowid)
             
             conn.commit()
             success = True
         except sqlite3.IntegrityError:
             success = False  # User already has this badge
         conn.close()
+        if success:
+            self.publish_notification(notification)
         return success
     
     def get_user_badges(self, user_id):
         """Get all badges for a user with progress"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_read_connection()
         cursor = conn.cursor()
-        cursor.execute('''
-        SELECT b.*, 
-               ub.current_progress,
-               ub.earned_date,
-               CASE WHEN ub.user_id IS NOT NULL THEN 1 ELSE 0 END as earned
-        FROM badges b
-        LEFT JOIN user_badges ub ON b.badge_id = ub.badge_id AND ub.user_id = ?
-        ORDER BY earned DESC, b.badge_id
+        cursor.execute(f'''
+        SELECT badge_id, current_progress, earned_date
+        FROM {self.get_shard(conn, user_id)}.user_badges
+        WHERE user_id = ?
         ''', (user_id,))
-        
-        badges = cursor.fetchall()
+        progress = {row[0]: row[1:] for row in cursor.fetchall()}
         conn.close()
+        
+        # Badge details come from the reference cache, earned badges first
+        badges = [
+            badge + (progress[badge[0]] + (1,) if badge[0] in progress else (None, None, 0))
+            for badge in self.reference_cache.get_badges()
+        ]
+        badges.sort(key=lambda badge: -badge[-1])
         return badges
     
     def update_badge_progress(self, user_id, badge_id, progress_increment=1):
         """Update progress for a user's badge"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_connection()
         cursor = conn.cursor()
+        shard = self.get_shard(conn, user_id)
         
         # Get current progress
-        cursor.execute('''
-        SELECT current_progress FROM user_badges 
+        cursor.execute(f'''
+        SELECT current_progress FROM {shard}.user_badges 
         WHERE user_id = ? AND badge_id = ?
         ''', (user_id, badge_id))
         
@@ -741,15 +1572,15 @@ class DataBase:
             current_progress = result[0]
             new_progress = current_progress + progress_increment
             
-            cursor.execute('''
-            UPDATE user_badges 
+            cursor.execute(f'''
+            UPDATE {shard}.user_badges 
             SET current_progress = ?
             WHERE user_id = ? AND badge_id = ?
             ''', (new_progress, user_id, badge_id))
         else:
             # First time tracking this badge
-            cursor.execute('''
-            INSERT INTO user_badges (user_id, badge_id, current_progress)
+            cursor.execute(f'''
+            INSERT INTO {shard}.user_badges (user_id, badge_id, current_progress)
             VALUES (?, ?, ?)
             ''', (user_id, badge_id, progress_increment))
         
@@ -760,8 +1591,10 @@ class DataBase:
 
     def create_follow_request(self, requester_id, target_id):
         """Create a follow request (needs approval)"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_connection()
         cursor = conn.cursor()
+        shard = self.get_shard(conn, target_id)
+        self.lock_shards(conn, ['main', shard])
         try:
             cursor.execute('''
             INSERT INTO follow_requests (requester_id, target_id, status)
@@ -769,23 +1602,27 @@ class DataBase:
             ''', (requester_id, target_id))
             
             # Create notification
-            requester_name = self.get_username_by_id(requester_id)
-            cursor.execute('''
-            INSERT INTO notifications (user_id, notification_type, message, related_id)
+            requester_name = self.get_username_by_id(requester_id, cursor)
+            cursor.execute(f'''
+            INSERT INTO {shard}.notifications (user_id, notification_type, message, related_id)
             VALUES (?, 'follow_request', ? || ' sent you a follow request', ?)
             ''', (target_id, requester_name, requester_id))
+            notification = (target_id, cursor.lastrowid)
             
             conn.commit()
             success = True
         except sqlite3.IntegrityError:
             success = False  # Request already exists
         conn.close()
+        if success:
+            self.publish_notification(notification)
         return success
     
     def respond_follow_request(self, request_id, response, target_id):
         """Accept or reject a follow request"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_connection()
         cursor = conn.cursor()
+        notification = None
         
         if response == 'accept':
             # Get the requester_id
@@ -795,6 +1632,8 @@ class DataBase:
             
             if result:
                 requester_id = result[0]
+                shard = self.get_shard(conn, requester_id)
+                self.lock_shards(conn, ['main', shard, self.prepare_track_action(conn, requester_id)])
                 # Add to following table
                 cursor.execute('''
                 INSERT OR IGNORE INTO following (follower_id, followed_id)
@@ -802,10 +1641,7 @@ class DataBase:
                 ''', (requester_id, target_id))
                 
                 # Track action for badges
-                cursor.execute('''
-                INSERT INTO user_actions (user_id, action_type, target_id)
-                VALUES (?, 'follow_user', ?)
-                ''', (requester_id, target_id))
+                self.track_action(requester_id, 'follow_user', target_id, cursor)
                 
                 # Update request status
                 cursor.execute('''
@@ -815,11 +1651,12 @@ class DataBase:
                 ''', (request_id,))
                 
                 # Create notification for requester
-                target_name = self.get_username_by_id(target_id)
-                cursor.execute('''
-                INSERT INTO notifications (user_id, notification_type, message, related_id)
+                target_name = self.get_username_by_id(target_id, cursor)
+                cursor.execute(f'''
+                INSERT INTO {shard}.notifications (user_id, notification_type, message, related_id)
                 VALUES (?, 'follow_accept', ? || ' accepted your follow request', ?)
                 ''', (requester_id, target_name, target_id))
+                notification = (requester_id, cursor.lastrowid)
                 
                 conn.commit()
                 success = True
@@ -835,17 +1672,18 @@ class DataBase:
             success = cursor.rowcount > 0
         
         conn.close()
+        self.publish_notification(notification)
         return success
     
     def get_pending_follow_requests(self, user_id):
         """Get all pending follow requests for a user"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute('''
         SELECT fr.request_id, fr.requester_id, u.username, u.avatar_url, fr.requested_at
         FROM follow_requests fr
         JOIN users u ON fr.requester_id = u.user_id
-        WHERE fr.target_id = ? AND fr.status = 'pending'
+        WHERE fr.target_id = ? AND fr.status = 'pending' AND u.deleted_at IS NULL
         ORDER BY fr.requested_at DESC
         ''', (user_id,))
         requests = cursor.fetchall()
@@ -854,13 +1692,13 @@ class DataBase:
     
     def get_followers(self, user_id):
         """Get all followers of a user"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_read_connection()
         cursor = conn.cursor()
         cursor.execute('''
         SELECT u.user_id, u.username, u.avatar_url, u.age_group, f.follow_date
         FROM following f
         JOIN users u ON f.follower_id = u.user_id
-        WHERE f.followed_id = ?
+        WHERE f.followed_id = ? AND u.deleted_at IS NULL
         ORDER BY f.follow_date DESC
         ''', (user_id,))
         followers = cursor.fetchall()
@@ -869,13 +1707,13 @@ class DataBase:
     
     def get_following(self, user_id):
         """Get all users that a user is following"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_read_connection()
         cursor = conn.cursor()
         cursor.execute('''
         SELECT u.user_id, u.username, u.avatar_url, u.age_group, f.follow_date
         FROM following f
         JOIN users u ON f.followed_id = u.user_id
-        WHERE f.follower_id = ?
+        WHERE f.follower_id = ? AND u.deleted_at IS NULL
         ORDER BY f.follow_date DESC
         ''', (user_id,))
         following = cursor.fetchall()
@@ -884,7 +1722,7 @@ class DataBase:
     
     def unfollow_user(self, follower_id, followed_id):
         """Unfollow a user"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute('''
         DELETE FROM following 
@@ -897,7 +1735,7 @@ class DataBase:
     
     def check_follow_status(self, follower_id, followed_id):
         """Check if one user follows another"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute('''
         SELECT 1 FROM following 
@@ -909,7 +1747,7 @@ class DataBase:
     
     def check_follow_request(self, requester_id, target_id):
         """Check if there's a pending follow request"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute('''
         SELECT request_id, status FROM follow_requests 
@@ -923,53 +1761,109 @@ class DataBase:
 
     def insert_comment(self, post_id, user_id, content):
         """Insert a new comment into the database"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_connection()
         cursor = conn.cursor()
+        # Comments stay in the main database, the post's shard holds its owner's notifications
+        shard = self.get_row_shard(conn, post_id)
+        self.lock_shards(conn, ['main', shard, self.prepare_track_action(conn, user_id)])
         cursor.execute('''
         INSERT INTO comments (post_id, user_id, content)
         VALUES (?, ?, ?)
         ''', (post_id, user_id, content))
         comment_id = cursor.lastrowid
         
+        # Keep the denormalized count on the post in step
+        cursor.execute(f'UPDATE {shard}.posts SET comment_count = comment_count + 1 WHERE post_id = ?', (post_id,))
+        
         # Track action for badges
-        cursor.execute('''
-        INSERT INTO user_actions (user_id, action_type, target_id)
-        VALUES (?, 'comment_post', ?)
-        ''', (user_id, post_id))
+        self.track_action(user_id, 'comment_post', post_id, cursor)
         
         # Create notification for post owner
-        cursor.execute('SELECT user_id FROM posts WHERE post_id = ?', (post_id,))
+        notification = None
+        cursor.execute(f'SELECT user_id FROM {shard}.posts WHERE post_id = ?', (post_id,))
         post_owner = cursor.fetchone()
         if post_owner and post_owner[0] != user_id:
-            cursor.execute('''
-            INSERT INTO notifications (user_id, notification_type, message, related_id)
+            cursor.execute(f'''
+            INSERT INTO {shard}.notifications (user_id, notification_type, message, related_id)
             VALUES (?, 'comment', ? || ' commented on your post', ?)
-            ''', (post_owner[0], self.get_username_by_id(user_id), post_id))
+            ''', (post_owner[0], self.get_username_by_id(user_id, cursor), post_id))
+            notification = (post_owner[0], cursor.lastrowid)
         
         conn.commit()
         conn.close()
+        self.run_after_commit(lambda: self.feed_ranker.record_engagement(post_id, comments=1))
+        self.run_after_commit(lambda: self.trending.record('post', post_id, COMMENT_WEIGHT))
+        self.publish_notification(notification)
         return comment_id
     
     def get_comments_by_post(self, post_id):
         """Get all comments for a post"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_read_connection()
         cursor = conn.cursor()
         cursor.execute('''
         SELECT c.*, u.username, u.avatar_url
         FROM comments c
         JOIN users u ON c.user_id = u.user_id
-        WHERE c.post_id = ?
+        WHERE c.post_id = ? AND u.deleted_at IS NULL
         ORDER BY c.timestamp ASC
         ''', (post_id,))
         comments = cursor.fetchall()
         conn.close()
         return comments
+    
+    def get_recent_comments_for_posts(self, post_ids, per_post=3):
+        """Get the latest comments for many posts in one query, keyed by post_id"""
+        comments = {post_id: [] for post_id in post_ids}
+        if not comments:
+            return comments
+        
+        conn = self.get_read_connection()
+        cursor = conn.cursor()
+        placeholders = ', '.join('?' for _ in comments)
+        cursor.execute(f'''
+        SELECT comment_id, post_id, user_id, content, timestamp, username, avatar_url
+        FROM (
+            SELECT c.*, u.username, u.avatar_url,
+                   ROW_NUMBER() OVER (PARTITION BY c.post_id ORDER BY c.comment_id DESC) AS position
+            FROM comments c
+            JOIN users u ON c.user_id = u.user_id
+            WHERE c.post_id IN ({placeholders}) AND u.deleted_at IS NULL
+        )
+        WHERE position <= ?
+        ORDER BY post_id, comment_id ASC
+        ''', [*comments, per_post])
+        for row in cursor.fetchall():
+            comments[row[1]].append(row)
+        conn.close()
+        return comments
+    
+    def get_comments_page(self, post_id, after_comment_id=None, limit=20):
+        """Get one page of a post's comments, returns (comments, next_cursor)"""
+        conn = self.get_read_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT c.*, u.username, u.avatar_url
+        FROM comments c
+        JOIN users u ON c.user_id = u.user_id
+        WHERE c.post_id = ? AND c.comment_id > ? AND u.deleted_at IS NULL
+        ORDER BY c.comment_id ASC
+        LIMIT ?
+        ''', (post_id, after_comment_id or 0, limit + 1))
+        comments = cursor.fetchall()
+        conn.close()
+        
+        # The extra row only tells us whether another page exists
+        next_cursor = None
+        if len(comments) > limit:
+            comments = comments[:limit]
+            next_cursor = comments[-1][0]
+        return comments, next_cursor
 
     # =============== PROMPT METHODS ===============
 
     def insert_post_prompt(self, prompt_text, category, target_age_group='senior', difficulty_level='easy'):
         """Insert a new post prompt"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute('''
         INSERT INTO post_prompts (prompt_text, category, target_age_group, difficulty_level)
@@ -978,48 +1872,46 @@ class DataBase:
         prompt_id = cursor.lastrowid
         conn.commit()
         conn.close()
+        self.run_after_commit(self.reference_cache.bump)
         return prompt_id
     
     def get_prompts_for_user(self, age_group, limit=5):
-        """Get post prompts suitable for a user's age group"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        cursor.execute('''
-        SELECT * FROM post_prompts 
-        WHERE target_age_group = ? OR target_age_group = 'both'
-        ORDER BY times_used ASC, RANDOM()
-        LIMIT ?
-        ''', (age_group, limit))
-        prompts = cursor.fetchall()
-        conn.close()
-        return prompts
+        """Get post prompts suitable for a user's age group, favouring less used ones"""
+        return self.prompt_selector.select(age_group, limit)
     
     def get_all_prompts(self):
-        """Get all post prompts"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM post_prompts ORDER BY category, target_age_group')
-        prompts = cursor.fetchall()
-        conn.close()
+        """Get all post prompts, with usage counts that include unflushed uses"""
+        prompts = [self.prompt_selector.get_prompt(prompt[0]) or prompt
+                   for prompt in self.reference_cache.get_prompts()]
+        # Same order as ORDER BY category, target_age_group (NULLs first)
+        prompts.sort(key=lambda prompt: (prompt[2] is not None, prompt[2] or '',
+                                         prompt[3] is not None, prompt[3] or ''))
         return prompts
 
     # =============== NOTIFICATION METHODS ===============
 
-    def get_notifications(self, user_id, unread_only=False):
-        """Get notifications for a user"""
-        conn = sqlite3.connect(self.db_name)
+    def get_notifications(self, user_id, unread_only=False, after_id=None, limit=None):
+        """Get notifications for a user, optionally only those newer than `after_id`"""
+        conn = self.get_connection()
         cursor = conn.cursor()
         
-        query = '''
-        SELECT * FROM notifications 
+        query = f'''
+        SELECT * FROM {self.get_shard(conn, user_id)}.notifications 
         WHERE user_id = ?
         '''
         params = [user_id]
         
         if unread_only:
             query += ' AND is_read = 0'
+        if after_id is not None:
+            query += ' AND notification_id > ?'
+            params.append(after_id)
         
-        query += ' ORDER BY created_at DESC'
+        query += ' ORDER BY created_at DESC, notification_id DESC'
+        
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
         
         cursor.execute(query, params)
         notifications = cursor.fetchall()
@@ -1028,33 +1920,235 @@ class DataBase:
     
     def mark_notification_read(self, notification_id):
         """Mark a notification as read"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_connection()
         cursor = conn.cursor()
-        cursor.execute('''
-        UPDATE notifications 
+        shard = self.get_row_shard(conn, notification_id)
+        cursor.execute(f'''
+        UPDATE {shard}.notifications 
         SET is_read = 1 
         WHERE notification_id = ?
         ''', (notification_id,))
+        cursor.execute(f'SELECT user_id FROM {shard}.notifications WHERE notification_id = ?', (notification_id,))
+        owner = cursor.fetchone()
         conn.commit()
         conn.close()
+        if owner:
+            self.publish_unread_count(owner[0])
     
     def mark_all_notifications_read(self, user_id):
         """Mark all notifications as read for a user"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_connection()
         cursor = conn.cursor()
-        cursor.execute('''
-        UPDATE notifications 
+        cursor.execute(f'''
+        UPDATE {self.get_shard(conn, user_id)}.notifications 
         SET is_read = 1 
-        WHERE user_id = ?
+        WHERE user_id = ? AND is_read = 0
         ''', (user_id,))
         conn.commit()
         conn.close()
+        self.publish_unread_count(user_id)
+    
+    def get_unread_notification_count(self, user_id):
+        """Get the number of unread notifications for a user from the maintained counter"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        shard = self.get_shard(conn, user_id)
+        cursor.execute(f'SELECT unread_count FROM {shard}.notification_counters WHERE user_id = ?', (user_id,))
+        result = cursor.fetchone()
+        conn.close()
+        return result[0] if result else 0
+    
+    def publish_notification(self, notification):
+        """Push a committed (user_id, notification_id) to the user's live streams"""
+        if notification is None:
+            return
+        user_id, notification_id = notification
+        # Noted before commit, so the change subscriber never delivers it a second time
+        self.__published_notifications.append(notification_id)
+        
+        def publish():
+            if not self.notification_hub.has_subscribers(user_id):
+                return
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            shard = self.get_shard(conn, user_id)
+            cursor.execute(f'SELECT * FROM {shard}.notifications WHERE notification_id = ?', (notification_id,))
+            row = cursor.fetchone()
+            cursor.execute(f'SELECT unread_count FROM {shard}.notification_counters WHERE user_id = ?', (user_id,))
+            count = cursor.fetchone()
+            conn.close()
+            if row:
+                self.notification_hub.publish(user_id, {
+                    'type': 'notification',
+                    'notification': self.notification_to_dict(row),
+                    'unread_count': count[0] if count else 0
+                })
+        
+        self.run_after_commit(publish)
+    
+    def publish_unread_count(self, user_id):
+        """Push a user's current unread count to their live streams"""
+        def publish():
+            if self.notification_hub.has_subscribers(user_id):
+                self.notification_hub.publish(user_id, {
+                    'type': 'unread_count',
+                    'unread_count': self.get_unread_notification_count(user_id)
+                })
+        
+        self.run_after_commit(publish)
+    
+    def publish_notification_changes(self, changes):
+        """Push notifications written by other processes, and the new counts, to live streams here"""
+        recounted = set()
+        for seq, table_name, op, notification_id, user_id, related_id in changes:
+            if not self.notification_hub.has_subscribers(user_id):
+                continue
+            if op == 'I':
+                if notification_id not in self.__published_notifications:
+                    self.publish_notification((user_id, notification_id))
+            elif user_id not in recounted:
+                recounted.add(user_id)
+                self.publish_unread_count(user_id)
+    
+    def notification_to_dict(self, row):
+        """Turn a notifications row into a JSON friendly dict"""
+        return {
+            'notification_id': row[0],
+            'user_id': row[1],
+            'notification_type': row[2],
+            'message': row[3],
+            'related_id': row[4],
+            'is_read': bool(row[5]),
+            'created_at': row[6]
+        }
+
+    # =============== ACTIVITY METHODS ===============
+
+    def track_action(self, user_id, action_type, target_id=None, cursor=None):
+        """Record a user action for badge tracking.
+        
+        Buffered, the action goes on the activity buffer straight away
+        (held for the surrounding unit of work if there is one, so a badge
+        check later in the unit sees it) and is written in a later batch.
+        Unbuffered, the row is written on the caller's cursor as part of its
+        transaction (see prepare_track_action), or on a connection of its own.
+        """
+        if self.activity_buffer is not None:
+            unit = getattr(self.__local, 'unit_of_work', None)
+            self.activity_buffer.append(user_id, action_type, target_id, unit=unit)
+            return
+        
+        conn = None
+        if cursor is None:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+        shard = self.get_shard(cursor.connection, user_id)
+        cursor.execute(f'''
+        INSERT INTO {shard}.user_actions (user_id, action_type, target_id)
+        VALUES (?, ?, ?)
+        ''', (user_id, action_type, target_id))
+        if conn is not None:
+            conn.commit()
+            conn.close()
+    
+    def prepare_track_action(self, conn, user_id):
+        """Attach the shard an unbuffered track_action on this connection writes to, before its first write.
+
+        Returns that schema for lock_shards, None when actions are buffered.
+        """
+        if self.activity_buffer is None:
+            return self.get_shard(conn, user_id)
+        return None
+    
+    def flush_actions(self):
+        """Write any buffered actions now, for reads that need exact counts"""
+        if self.activity_buffer is not None:
+            self.activity_buffer.flush(getattr(self.__local, 'unit_of_work', None))
+    
+    def get_actions_by_user(self, user_id, limit=50):
+        """Get a user's most recent actions"""
+        self.flush_actions()
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(f'''
+        SELECT * FROM {self.get_shard(conn, user_id)}.user_actions
+        WHERE user_id = ?
+        ORDER BY performed_at DESC, action_id DESC
+        LIMIT ?
+        ''', (user_id, limit))
+        actions = cursor.fetchall()
+        conn.close()
+        return actions
+    
+    def get_recent_actions(self, limit=50):
+        """Get the most recent actions across all users"""
+        self.flush_actions()
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(f'''
+        SELECT * FROM {self.union_shards(conn, 'user_actions')}
+        ORDER BY performed_at DESC, action_id DESC
+        LIMIT ?
+        ''', (limit,))
+        actions = cursor.fetchall()
+        conn.close()
+        return actions
+
+    # =============== DELETION METHODS ===============
+
+    def queue_deletion(self, cursor, entity_type, entity_id):
+        """Queue a tombstoned user or post for purging on the caller's cursor, returns the job id"""
+        cursor.execute('''
+        INSERT INTO deletion_jobs (entity_type, entity_id) VALUES (?, ?)
+        ON CONFLICT (entity_type, entity_id) DO NOTHING
+        ''', (entity_type, entity_id))
+        cursor.execute('SELECT job_id FROM deletion_jobs WHERE entity_type = ? AND entity_id = ?',
+                       (entity_type, entity_id))
+        return cursor.fetchone()[0]
+    
+    def get_deletion_job(self, job_id):
+        """Get a deletion job's status and progress"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM deletion_jobs WHERE job_id = ?', (job_id,))
+        job = cursor.fetchone()
+        conn.close()
+        return job
+    
+    def get_pending_deletion_jobs(self, limit=100):
+        """Get deletion jobs that have not finished, oldest first"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT * FROM deletion_jobs
+        WHERE status != 'done'
+        ORDER BY job_id
+        LIMIT ?
+        ''', (limit,))
+        jobs = cursor.fetchall()
+        conn.close()
+        return jobs
+    
+    def clear_calendar_cache(self):
+        """Drop cached calendar months after events change outside the usual methods"""
+        self.__calendar_cache.clear()
 
     # =============== HELPER METHODS ===============
 
-    def get_username_by_id(self, user_id):
-        """Get username by user ID"""
-        conn = sqlite3.connect(self.db_name)
+    def format_timestamp(self, value):
+        """Format a datetime the way SQLite stores TIMESTAMP columns, strings pass through"""
+        if isinstance(value, datetime):
+            return value.strftime('%Y-%m-%d %H:%M:%S')
+        return value
+
+    def get_username_by_id(self, user_id, cursor=None):
+        """Get username by user ID, on the caller's cursor when one is passed"""
+        if cursor is not None:
+            cursor.execute('SELECT username FROM users WHERE user_id = ?', (user_id,))
+            result = cursor.fetchone()
+            return result[0] if result else None
+        
+        conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute('SELECT username FROM users WHERE user_id = ?', (user_id,))
         result = cursor.fetchone()
@@ -1063,45 +2157,53 @@ class DataBase:
     
     def check_and_award_badges(self, user_id):
         """Check if user has earned any badges based on their actions"""
-        conn = sqlite3.connect(self.db_name)
+        # Get user's actions count for each type, including rolled up history
+        self.flush_actions()
+        conn = self.get_connection()
         cursor = conn.cursor()
-        
-        # Get user's actions count for each type
-        cursor.execute('''
-        SELECT action_type, COUNT(*) as count
-        FROM user_actions
-        WHERE user_id = ?
+        shard = self.get_shard(conn, user_id)
+        cursor.execute(f'''
+        SELECT action_type, SUM(count) as count
+        FROM (
+            SELECT action_type, COUNT(*) as count
+            FROM {shard}.user_actions
+            WHERE user_id = ?
+            GROUP BY action_type
+            UNION ALL
+            SELECT action_type, SUM(action_count) as count
+            FROM {shard}.user_action_daily
+            WHERE user_id = ?
+            GROUP BY action_type
+        )
         GROUP BY action_type
-        ''', (user_id,))
+        ''', (user_id, user_id))
         
         actions = {row[0]: row[1] for row in cursor.fetchall()}
         
-        # Get all badges with their criteria
-        cursor.execute('SELECT badge_id, criteria, progress_required FROM badges')
-        badges = cursor.fetchall()
-        
-        for badge_id, criteria, progress_required in badges:
-            # Check if badge matches user's actions
-            if criteria and criteria in actions:
-                if actions[criteria] >= progress_required:
+        # Only badges whose criteria the user has acted on can be earned
+        for criteria, count in actions.items():
+            for badge in self.reference_cache.get_badges_for_criteria(criteria):
+                badge_id, progress_required = badge[0], badge[5]
+                if count >= progress_required:
                     # Award badge if not already awarded
-                    cursor.execute('''
-                    INSERT OR IGNORE INTO user_badges (user_id, badge_id, current_progress)
+                    cursor.execute(f'''
+                    INSERT OR IGNORE INTO {shard}.user_badges (user_id, badge_id, current_progress)
                     VALUES (?, ?, ?)
-                    ''', (user_id, badge_id, actions[criteria]))
+                    ''', (user_id, badge_id, count))
         
         conn.commit()
         conn.close()
     
     def get_user_stats(self, user_id):
         """Get statistics for a user"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_read_connection()
         cursor = conn.cursor()
+        shard = self.get_shard(conn, user_id)
         
         stats = {}
         
         # Post count
-        cursor.execute('SELECT COUNT(*) FROM posts WHERE user_id = ?', (user_id,))
+        cursor.execute(f'SELECT COUNT(*) FROM {shard}.posts WHERE user_id = ? AND deleted_at IS NULL', (user_id,))
         stats['post_count'] = cursor.fetchone()[0]
         
         # Follower count
@@ -1117,12 +2219,12 @@ class DataBase:
         stats['event_count'] = cursor.fetchone()[0]
         
         # Badge count
-        cursor.execute('SELECT COUNT(*) FROM user_badges WHERE user_id = ?', (user_id,))
+        cursor.execute(f'SELECT COUNT(*) FROM {shard}.user_badges WHERE user_id = ?', (user_id,))
         stats['badge_count'] = cursor.fetchone()[0]
         
         # Total likes received
-        cursor.execute('''
-        SELECT SUM(likes) FROM posts WHERE user_id = ?
+        cursor.execute(f'''
+        SELECT SUM(likes) FROM {shard}.posts WHERE user_id = ? AND deleted_at IS NULL
         ''', (user_id,))
         stats['total_likes'] = cursor.fetchone()[0] or 0
         
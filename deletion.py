@@ -0,0 +1,209 @@
+import sqlite3
+import threading
+from collections import Counter
+
+from sharding import SHARDED_TABLES
+
+# Rows that depend on a user, purged in this order. Each step is
+# (name, table, condition on :id, counter to decrement as (table, column, key) or None).
+# {shard} is the schema holding the user's own rows (see DataBase.get_shard).
+USER_STEPS = [
+    ('post_comments', 'comments', 'post_id IN (SELECT post_id FROM {shard}.posts WHERE user_id = :id)', None),
+    ('posts', '{shard}.posts', 'user_id = :id', None),
+    ('comments', 'comments', 'user_id = :id', ('posts', 'comment_count', 'post_id')),
+    ('event_participants_of_events', 'event_participants',
+     'event_id IN (SELECT event_id FROM events WHERE user_id = :id)', None),
+    ('events', 'events', 'user_id = :id', None),
+    ('event_participants', 'event_participants', 'user_id = :id', ('events', 'participant_count', 'event_id')),
+    ('user_badges', '{shard}.user_badges', 'user_id = :id', None),
+    ('following', 'following', 'follower_id = :id OR followed_id = :id', None),
+    ('follow_requests', 'follow_requests', 'requester_id = :id OR target_id = :id', None),
+    ('notifications', '{shard}.notifications', 'user_id = :id', None),
+    ('user_actions', '{shard}.user_actions', 'user_id = :id', None),
+    ('user_action_daily', '{shard}.user_action_daily', 'user_id = :id', None),
+]
+
+POST_STEPS = [
+    ('comments', 'comments', 'post_id = :id', None),
+]
+
+# Tables created WITHOUT ROWID are batched on their primary key instead
+PRIMARY_KEYS = {
+    'user_action_daily': ('user_id', 'action_type', 'action_day'),
+}
+
+
+class DeletionWorker:
+    """Purges the rows that belong to deleted users and posts.
+
+    delete_user() and delete_post() only tombstone the row (set deleted_at,
+    which every read filters on) and queue a deletion_jobs entry. This worker
+    works through those jobs in transactions of at most `batch_size` rows, so
+    removing a heavy account never holds the writer lock for long. Each batch
+    also records the current step and running total on the job, and an
+    interrupted job simply starts over, skipping what is already gone.
+
+    Steps are repeated until a full pass deletes nothing, so rows added while
+    the purge was running are caught too; the tombstoned row goes last.
+    """
+
+    def __init__(self, database, interval=5, batch_size=500, archiver=None):
+        self.__database = database
+        self.__interval = interval
+        self.__batch_size = batch_size
+        self.__archiver = archiver
+        self.__stop = threading.Event()
+        self.__wake = threading.Event()
+        self.__thread = None
+
+    # =============== BACKGROUND RUNNER ===============
+
+    def start(self):
+        """Poll for deletion jobs every `interval` seconds on a daemon thread"""
+        if self.__thread is not None and self.__thread.is_alive():
+            return
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run, name='deletion-worker', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """Stop the background thread after its current batch"""
+        self.__stop.set()
+        self.__wake.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def wake(self):
+        """Start on newly queued jobs without waiting for the next poll"""
+        self.__wake.set()
+
+    def __run(self):
+        while not self.__stop.is_set():
+            try:
+                self.run_once()
+            except sqlite3.Error as e:
+                print(f"Deletion worker error: {e}")
+            self.__wake.wait(self.__interval)
+            self.__wake.clear()
+
+    def run_once(self):
+        """Work through every unfinished job, returns how many were completed"""
+        completed = 0
+        for job in self.__database.get_pending_deletion_jobs():
+            if self.__stop.is_set():
+                break
+            job_id, entity_type, entity_id = job[0], job[1], job[2]
+            if entity_type == 'user':
+                self.purge_user(job_id, entity_id)
+            else:
+                self.purge_post(job_id, entity_id)
+            completed += 1
+        return completed
+
+    # =============== PURGE STEPS ===============
+
+    def purge_user(self, job_id, user_id):
+        """Remove everything that belongs to a tombstoned user, then the user"""
+        # Anything still buffered for this user has to land before it can be purged
+        self.__database.flush_actions()
+
+        conn = self.__database.get_connection()
+        shard = self.__database.get_shard(conn, user_id)
+        while not self.__stop.is_set():
+            if self.__run_steps(conn, job_id, USER_STEPS, user_id, shard) == 0:
+                break
+
+        if not self.__stop.is_set():
+            cursor = conn.cursor()
+            username = self.__database.get_username_by_id(user_id, cursor)
+            self.__database.lock_shards(conn, ['main', shard])
+            cursor.execute(f'DELETE FROM {shard}.notification_counters WHERE user_id = ?', (user_id,))
+            cursor.execute('DELETE FROM users WHERE user_id = ? AND deleted_at IS NOT NULL', (user_id,))
+            self.__finish(cursor, job_id, cursor.rowcount)
+            conn.commit()
+            if username is not None:
+                self.__database.username_index.remove(username)
+            if self.__archiver is not None:
+                self.__archiver.delete_archived_notifications(user_id)
+            self.__database.clear_calendar_cache()
+        conn.close()
+
+    def purge_post(self, job_id, post_id):
+        """Remove a tombstoned post's comments, then the post"""
+        conn = self.__database.get_connection()
+        while not self.__stop.is_set():
+            if self.__run_steps(conn, job_id, POST_STEPS, post_id) == 0:
+                break
+
+        if not self.__stop.is_set():
+            cursor = conn.cursor()
+            shard = self.__database.get_row_shard(conn, post_id)
+            self.__database.lock_shards(conn, ['main', shard])
+            cursor.execute(f'DELETE FROM {shard}.posts WHERE post_id = ? AND deleted_at IS NOT NULL', (post_id,))
+            self.__finish(cursor, job_id, cursor.rowcount)
+            conn.commit()
+        conn.close()
+
+    def __run_steps(self, conn, job_id, steps, entity_id, shard='main'):
+        """Run each step to completion, one batch per transaction, returns rows removed"""
+        cursor = conn.cursor()
+        total = 0
+        for name, table, condition, counter in steps:
+            table, condition = table.format(shard=shard), condition.format(shard=shard)
+            key = PRIMARY_KEYS.get(table.split('.')[-1], ('rowid',))
+            key_columns = ', '.join(key)
+            key_placeholder = f"({', '.join('?' for _ in key)})"
+            while not self.__stop.is_set():
+                cursor.execute(f'SELECT {key_columns}, * FROM {table} WHERE {condition} LIMIT :limit',
+                               {'id': entity_id, 'limit': self.__batch_size})
+                columns = [column[0] for column in cursor.description]
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+
+                keys = [value for row in rows for value in row[:len(key)]]
+                placeholders = ', '.join(key_placeholder for _ in rows)
+                by_schema = {}
+                if counter is not None:
+                    # Keep denormalized counts on the rows that survive in step
+                    counter_table, counter_column, counter_key = counter
+                    position = columns.index(counter_key)
+                    counts = Counter(row[position] for row in rows)
+                    # Sharded counters (posts.comment_count) are updated in each row's own shard
+                    for key_id, count in counts.items():
+                        schema = 'main'
+                        if counter_table in SHARDED_TABLES:
+                            schema = self.__database.get_row_shard(conn, key_id)
+                        by_schema.setdefault(schema, []).append((count, key_id))
+                # The batch writes its table, the counters' schemas and deletion_jobs in main
+                self.__database.lock_shards(conn, ['main', table.rsplit('.', 1)[0] if '.' in table else 'main',
+                                                   *by_schema])
+                for schema, updates in by_schema.items():
+                    cursor.executemany(f'''
+                    UPDATE {schema}.{counter_table} SET {counter_column} = MAX({counter_column} - ?, 0)
+                    WHERE {counter_key} = ?
+                    ''', updates)
+                cursor.execute(f'DELETE FROM {table} WHERE ({key_columns}) IN (VALUES {placeholders})', keys)
+                total += cursor.rowcount
+
+                if job_id is not None:
+                    self.__record_progress(cursor, job_id, name, cursor.rowcount)
+                conn.commit()
+        return total
+
+    def __record_progress(self, cursor, job_id, step, rows_deleted):
+        cursor.execute('''
+        UPDATE deletion_jobs
+        SET status = 'running', current_step = ?, rows_deleted = rows_deleted + ?,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE job_id = ?
+        ''', (step, rows_deleted, job_id))
+
+    def __finish(self, cursor, job_id, rows_deleted):
+        cursor.execute('''
+        UPDATE deletion_jobs
+        SET status = 'done', current_step = NULL, rows_deleted = rows_deleted + ?,
+            updated_at = CURRENT_TIMESTAMP, finished_at = CURRENT_TIMESTAMP
+        WHERE job_id = ?
+        ''', (rows_deleted, job_id))
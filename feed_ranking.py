@@ -0,0 +1,232 @@
+import math
+import threading
+import time
+
+import numpy as np
+
+AGE_GROUP_CODES = {'youth': 0, 'senior': 1}
+NO_AGE_GROUP = 2  # Score column for viewers without an age group
+
+
+class FeedRanker:
+    """Ranks posts for a "For You" feed with vectorized NumPy scoring.
+
+    The newest `candidate_limit` posts are kept in memory as column arrays
+    (author, likes, comments, category, creation time), together with each
+    post's cached score for youth, senior and other viewers. Likes, comments
+    and new posts update the arrays and rescore only the posts they touch, so
+    rank() just applies the viewer's follow proximity to the cached column.
+    Arrays grow by doubling their capacity. The whole set is reloaded every
+    `refresh_interval` seconds to pick up writes from other processes.
+
+    A post's score for a viewer is
+
+        engagement * time_decay * (1 + cross_age_bonus) * (1 + follow_proximity)
+
+    where engagement = 1 + log1p(likes + 2 * comments), the decay halves every
+    `half_life_hours`, the cross-age bonus applies when the post's category is
+    the other age group from the viewer's, and proximity is `follow_weight` for
+    people the viewer follows or `second_degree_weight` for people they follow.
+    Cached scores use the decay relative to the last reload rather than to
+    now: every post decays by the same factor in between, so the order is
+    unchanged and a score never has to be recomputed just because time passed.
+    """
+
+    def __init__(self, database, candidate_limit=500, refresh_interval=60, half_life_hours=24,
+                 cross_age_bonus=0.5, follow_weight=1.0, second_degree_weight=0.3):
+        self.__database = database
+        self.__candidate_limit = candidate_limit
+        self.__refresh_interval = refresh_interval
+        self.__decay_rate = math.log(2) / (half_life_hours * 3600)
+        self.__cross_age_bonus = cross_age_bonus
+        self.__follow_weight = follow_weight
+        self.__second_degree_weight = second_degree_weight
+        self.__lock = threading.Lock()
+        self.__loaded_at = 0
+        self.__set_candidates([])
+
+    def __set_candidates(self, rows):
+        count = len(rows)
+        capacity = max(2 * count, 64)  # Room for new posts before the first grow
+        self.__post_ids = np.zeros(capacity, dtype=np.int64)
+        self.__authors = np.zeros(capacity, dtype=np.int64)
+        self.__likes = np.zeros(capacity, dtype=np.float64)
+        self.__comments = np.zeros(capacity, dtype=np.float64)
+        self.__categories = np.zeros(capacity, dtype=np.int8)
+        self.__created = np.zeros(capacity, dtype=np.float64)
+        self.__scores = np.zeros((capacity, NO_AGE_GROUP + 1), dtype=np.float64)
+
+        self.__post_ids[:count] = [row[0] for row in rows]
+        self.__authors[:count] = [row[1] for row in rows]
+        self.__likes[:count] = [row[2] or 0 for row in rows]
+        self.__comments[:count] = [row[3] or 0 for row in rows]
+        self.__categories[:count] = [AGE_GROUP_CODES.get(row[4], -1) for row in rows]
+        self.__created[:count] = [row[5] or 0 for row in rows]
+        self.__count = count
+        self.__epoch = time.time()
+        self.__positions = {post_id: i for i, post_id in enumerate(self.__post_ids[:count].tolist())}
+        self.__rescore(slice(0, count))
+
+    def __grow(self):
+        """Double every column's capacity, so adding posts costs amortised O(1)"""
+        def double(column):
+            return np.concatenate((column, np.zeros_like(column)))
+        self.__post_ids = double(self.__post_ids)
+        self.__authors = double(self.__authors)
+        self.__likes = double(self.__likes)
+        self.__comments = double(self.__comments)
+        self.__categories = double(self.__categories)
+        self.__created = double(self.__created)
+        self.__scores = double(self.__scores)
+
+    def __rescore(self, positions):
+        """Recompute the cached scores of the posts at `positions` (an index or slice)"""
+        engagement = 1.0 + np.log1p(self.__likes[positions] + 2.0 * self.__comments[positions])
+        created = self.__created[positions]
+        base = engagement * np.exp(self.__decay_rate * (created - self.__epoch))
+        base = np.where(created < 0, -np.inf, base)
+        categories = self.__categories[positions]
+        for viewer_category in AGE_GROUP_CODES.values():
+            cross_age = (categories >= 0) & (categories != viewer_category)
+            self.__scores[positions, viewer_category] = base * (1.0 + self.__cross_age_bonus * cross_age)
+        self.__scores[positions, NO_AGE_GROUP] = base
+
+    def refresh(self):
+        """Reload the candidate posts from the database"""
+        conn = self.__database.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(f'''
+        SELECT p.post_id, p.user_id, p.likes, p.comment_count, p.post_category,
+               CAST(strftime('%s', p.timestamp) AS INTEGER)
+        FROM {self.__database.union_shards(conn, 'posts')} p
+        JOIN users u ON p.user_id = u.user_id
+        WHERE p.deleted_at IS NULL AND u.deleted_at IS NULL AND p.duplicate_of IS NULL
+        ORDER BY p.timestamp DESC, p.post_id DESC
+        LIMIT ?
+        ''', (self.__candidate_limit,))
+        rows = cursor.fetchall()
+        conn.close()
+
+        with self.__lock:
+            self.__set_candidates(rows)
+            self.__loaded_at = time.monotonic()
+
+    # =============== INCREMENTAL UPDATES ===============
+
+    def record_post(self, post_id, user_id, post_category=None):
+        """Add a newly created post to the candidate set"""
+        with self.__lock:
+            if post_id in self.__positions:
+                return
+            position = self.__count
+            if position == len(self.__post_ids):
+                self.__grow()
+            self.__post_ids[position] = post_id
+            self.__authors[position] = user_id
+            self.__likes[position] = 0.0
+            self.__comments[position] = 0.0
+            self.__categories[position] = AGE_GROUP_CODES.get(post_category, -1)
+            self.__created[position] = time.time()
+            self.__rescore(position)
+            self.__positions[post_id] = position
+            self.__count = position + 1
+
+    def record_engagement(self, post_id, likes=0, comments=0):
+        """Count a like or comment on a candidate post"""
+        with self.__lock:
+            position = self.__positions.get(post_id)
+            if position is not None:
+                self.__likes[position] += likes
+                self.__comments[position] += comments
+                self.__rescore(position)
+
+    def remove_post(self, post_id):
+        """Drop a deleted post from the candidate set"""
+        with self.__lock:
+            position = self.__positions.get(post_id)
+            if position is not None:
+                # Marked rather than removed so positions stay valid until the next refresh
+                self.__created[position] = -1.0
+                self.__rescore(position)
+
+    def apply_changes(self, changes):
+        """Patch the candidates from posts changes in the change log, whichever process made them"""
+        post_ids = list({change[3] for change in changes})
+        inserted = {change[3] for change in changes if change[2] == 'I'}
+        conn = self.__database.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(f'''
+        SELECT post_id, user_id, likes, comment_count, post_category,
+               CAST(strftime('%s', timestamp) AS INTEGER), deleted_at, duplicate_of
+        FROM {self.__database.union_shards(conn, 'posts')}
+        WHERE post_id IN ({', '.join('?' for _ in post_ids)})
+        ''', post_ids)
+        rows = {row[0]: row for row in cursor.fetchall()}
+        conn.close()
+
+        for post_id in post_ids:
+            row = rows.get(post_id)
+            if row is None or row[6] is not None or row[7] is not None:
+                self.remove_post(post_id)
+                continue
+            with self.__lock:
+                position = self.__positions.get(post_id)
+                if position is not None:
+                    # Absolute counts, so engagement already recorded here is not counted twice
+                    self.__likes[position] = row[2] or 0
+                    self.__comments[position] = row[3] or 0
+                    self.__rescore(position)
+                    continue
+            # Older posts outside the candidate window stay out until they would be loaded anyway
+            if post_id in inserted:
+                self.record_post(post_id, row[1], row[4])
+
+    # =============== RANKING ===============
+
+    def rank(self, user_id, limit=20):
+        """Return the ids of the best `limit` posts for a user, best first"""
+        if time.monotonic() - self.__loaded_at >= self.__refresh_interval:
+            self.refresh()
+
+        age_group, followed, second_degree = self.__load_viewer(user_id)
+
+        with self.__lock:
+            count = self.__count
+            if count == 0:
+                return []
+            authors = self.__authors[:count]
+            proximity = np.where(
+                np.isin(authors, followed), self.__follow_weight,
+                np.where(np.isin(authors, second_degree), self.__second_degree_weight, 0.0)
+            )
+
+            viewer_category = AGE_GROUP_CODES.get(age_group, NO_AGE_GROUP)
+            scores = self.__scores[:count, viewer_category] * (1.0 + proximity)
+            scores[authors == user_id] = -np.inf
+            post_ids = self.__post_ids[:count]
+
+        count = min(limit, int(np.isfinite(scores).sum()))
+        if count <= 0:
+            return []
+        top = np.argpartition(-scores, count - 1)[:count]
+        top = top[np.argsort(-scores[top])]
+        return post_ids[top].tolist()
+
+    def __load_viewer(self, user_id):
+        conn = self.__database.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT age_group FROM users WHERE user_id = ?', (user_id,))
+        viewer = cursor.fetchone()
+        cursor.execute('SELECT followed_id FROM following WHERE follower_id = ?', (user_id,))
+        followed = [row[0] for row in cursor.fetchall()]
+        cursor.execute('''
+        SELECT DISTINCT f2.followed_id
+        FROM following f1
+        JOIN following f2 ON f1.followed_id = f2.follower_id
+        WHERE f1.follower_id = ?
+        ''', (user_id,))
+        second_degree = [row[0] for row in cursor.fetchall()]
+        conn.close()
+        return (viewer[0] if viewer else None,
+                np.array(followed, dtype=np.int64),
+                np.array(second_degree, dtype=np.int64))
@@ -0,0 +1,61 @@
+import csv
+import math
+import os
+
+EARTH_RADIUS_KM = 6371.0088
+
+DEFAULT_GAZETTEER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'gazetteer.csv')
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """Great-circle (haversine) distance between two points in kilometres"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def bounding_box(latitude, longitude, radius_km):
+    """(min_lat, max_lat, min_lon, max_lon) of a box that contains the circle around a point"""
+    lat_delta = math.degrees(radius_km / EARTH_RADIUS_KM)
+    # Longitude degrees shrink towards the poles; near them the box spans every longitude
+    cos_lat = math.cos(math.radians(latitude))
+    lon_delta = 180.0 if cos_lat < 1e-6 else min(math.degrees(radius_km / (EARTH_RADIUS_KM * cos_lat)), 180.0)
+    return (max(latitude - lat_delta, -90.0), min(latitude + lat_delta, 90.0),
+            longitude - lon_delta, longitude + lon_delta)
+
+
+class Gazetteer:
+    """Offline place-name lookup from a CSV of name,latitude,longitude rows.
+
+    Names match case-insensitively, and a free-text location like
+    "Tampines Hub, Tampines" is tried as a whole and then part by part, so
+    events only need a recognisable town or area somewhere in the text.
+    """
+
+    def __init__(self, path=DEFAULT_GAZETTEER):
+        self.__places = {}
+        if os.path.exists(path):
+            with open(path, newline='', encoding='utf-8') as gazetteer:
+                for row in csv.DictReader(gazetteer):
+                    self.__places[self.__normalize(row['name'])] = (float(row['latitude']),
+                                                                     float(row['longitude']))
+
+    def get_place_count(self):
+        return len(self.__places)
+
+    def geocode(self, location):
+        """(latitude, longitude) of a location, None if no part of it is known"""
+        if not location:
+            return None
+        name = self.__normalize(location)
+        if name in self.__places:
+            return self.__places[name]
+        for part in location.split(','):
+            coordinates = self.__places.get(self.__normalize(part))
+            if coordinates is not None:
+                return coordinates
+        return None
+
+    def __normalize(self, name):
+        return ' '.join(name.lower().split())
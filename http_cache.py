@@ -0,0 +1,236 @@
+import hashlib
+import os
+import threading
+import time
+import zlib
+from email.utils import formatdate
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # gzip only
+
+# Columns of each captured table's change (seq, table_name, op, row_id, user_id,
+# related_id) naming a user whose pages the change shows up on
+USER_FIELDS = {
+    'users': (4,),
+    'posts': (4,),
+    'following': (4, 5),  # Both the follower's and the followed user's counts move
+    'user_badges': (4,),
+    'events': (4,),
+    'notifications': (4,),
+}
+
+COMPRESSIBLE_TYPES = {'text/html', 'text/plain', 'text/css', 'application/json', 'application/javascript'}
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Posted to, but only read: no versions to bump afterwards
+READ_ENDPOINTS = {'batch'}
+
+
+class VersionTracker:
+    """Version counters per user and per table, bumped by every write.
+
+    Counters live in memory and only go up. Writes made by other processes
+    arrive through the change subscriber; requests that may have written
+    (anything but GET, HEAD and OPTIONS) bump their own user and every table
+    as soon as they finish, so a page reloaded straight after a form post is
+    never answered from an older version. Each process has its own random
+    boot id, so versions from two processes can never be mistaken for each
+    other.
+    """
+
+    def __init__(self, database=None):
+        self.boot_id = os.urandom(4).hex()
+        self.__started = time.time()
+        self.__lock = threading.Lock()
+        self.__users = {}  # user_id -> (version, modified_at)
+        self.__tables = {}  # table_name -> (version, modified_at)
+        if database is not None:
+            for table_name in USER_FIELDS:
+                database.change_subscriber.subscribe(table_name, self.apply_changes)
+            database.change_subscriber.on_reset(self.bump_all)
+
+    def get_user(self, user_id):
+        """(version, modified_at) of everything about a user"""
+        return self.__users.get(user_id, (0, self.__started))
+
+    def get_table(self, table_name):
+        return self.__tables.get(table_name, (0, self.__started))
+
+    def bump_user(self, user_id):
+        now = time.time()
+        with self.__lock:
+            self.__users[user_id] = (self.__users.get(user_id, (0,))[0] + 1, now)
+
+    def bump_table(self, table_name):
+        now = time.time()
+        with self.__lock:
+            self.__tables[table_name] = (self.__tables.get(table_name, (0,))[0] + 1, now)
+
+    def bump_all(self):
+        """Invalidate every version, e.g. after changes were missed"""
+        now = time.time()
+        with self.__lock:
+            self.__users = {user_id: (version + 1, now) for user_id, (version, _) in self.__users.items()}
+            self.__tables = {name: (version + 1, now) for name, (version, _) in self.__tables.items()}
+            self.__started = now
+
+    def apply_changes(self, changes):
+        """Bump the users and table named by a batch of change_log entries"""
+        user_ids = set()
+        for change in changes:
+            for field in USER_FIELDS[change[1]]:
+                if change[field] is not None:
+                    user_ids.add(change[field])
+        for user_id in user_ids:
+            self.bump_user(user_id)
+        self.bump_table(changes[0][1])
+
+
+class HttpCache:
+    """Conditional GET for pages and data endpoints, from version counters.
+
+    Views marked with cached() get a weak ETag built from the boot id, the
+    session's user and the versions the view depends on, plus a Last-Modified
+    of the newest of them. A request whose If-None-Match carries the current
+    ETag is answered 304 from before_request, so neither SQLite nor Jinja is
+    touched. Requests with flash messages pending always render in full,
+    because the browser would otherwise show the old message again.
+    """
+
+    def __init__(self, app=None, database=None):
+        self.versions = VersionTracker(database)
+        self.__not_modified = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.__app = app
+        app.before_request(self.__before_request)
+        app.after_request(self.__after_request)
+        app.teardown_request(self.__teardown_request)
+
+    def cached(self, *tables, per_user=True):
+        """Mark a view as cacheable: it changes only when the user's or the given tables' versions do"""
+        def decorator(view):
+            view.http_cache = (tables, per_user)
+            return view
+        return decorator
+
+    def get_not_modified_count(self):
+        return self.__not_modified
+
+    def __etag(self, path, user_id, tables, per_user):
+        stamps = [self.versions.get_table(table_name) for table_name in tables]
+        if per_user:
+            stamps.append(self.versions.get_user(user_id))
+        key = f'{self.versions.boot_id}|{user_id}|{path}|' + '|'.join(str(version) for version, _ in stamps)
+        modified_at = max((modified for _, modified in stamps), default=None)
+        return hashlib.blake2b(key.encode(), digest_size=12).hexdigest(), modified_at
+
+    def __before_request(self):
+        from flask import g, request, session, Response
+        view = self.__app.view_functions.get(request.endpoint)
+        settings = getattr(view, 'http_cache', None)
+        if settings is None or request.method not in ('GET', 'HEAD') or '_flashes' in session:
+            return None
+        user_id = session.get('user_id') if session.get('logged_in') else None
+        if settings[1] and user_id is None:
+            return None  # Redirected to the login page, nothing to cache
+
+        etag, modified_at = self.__etag(request.full_path, user_id, *settings)
+        g.http_cache = (etag, modified_at)
+        if request.if_none_match.contains_weak(etag):
+            self.__not_modified += 1
+            response = Response(status=304)
+            self.__set_headers(response, etag, modified_at)
+            return response
+        return None
+
+    def __after_request(self, response):
+        from flask import g
+        cache = g.pop('http_cache', None)
+        if cache is not None and response.status_code == 200:
+            self.__set_headers(response, *cache)
+        return response
+
+    def __set_headers(self, response, etag, modified_at):
+        response.set_etag(etag, weak=True)
+        if modified_at is not None:
+            response.headers['Last-Modified'] = formatdate(modified_at, usegmt=True)
+        # Browsers keep the page but must ask every time; proxies must not share it
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Cookie')
+
+    def __teardown_request(self, exc):
+        from flask import request, session
+        if request.method in SAFE_METHODS or request.endpoint in READ_ENDPOINTS:
+            return
+        user_id = session.get('user_id')
+        if user_id is not None:
+            self.versions.bump_user(user_id)
+        for table_name in USER_FIELDS:
+            self.versions.bump_table(table_name)
+
+
+class ResponseCompressor:
+    """gzip (or brotli, when installed) for HTML and JSON bodies of `min_size` bytes or more.
+
+    Bodies are compressed chunk by chunk as they are sent, so a streamed
+    response stays streamed. Server-Sent Events are left alone: each event
+    must reach the browser as soon as it is written.
+    """
+
+    def __init__(self, app=None, min_size=1024, level=6):
+        self.__min_size = min_size
+        self.__level = level
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.after_request(self.__after_request)
+
+    def __after_request(self, response):
+        from flask import request
+        response.vary.add('Accept-Encoding')
+        if (request.method == 'HEAD' or response.status_code != 200 or response.direct_passthrough
+                or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_TYPES):
+            return response
+        if not response.is_streamed and response.content_length is not None \
+                and response.content_length < self.__min_size:
+            return response
+
+        if brotli is not None and request.accept_encodings['br']:
+            encoding = 'br'
+        elif request.accept_encodings['gzip']:
+            encoding = 'gzip'
+        else:
+            return response
+
+        chunks = self.__compress(response.iter_encoded(), encoding, flush=response.is_streamed)
+        response.headers['Content-Encoding'] = encoding
+        if response.is_streamed:
+            response.response = chunks
+            response.headers.pop('Content-Length', None)
+        else:
+            response.set_data(b''.join(chunks))
+        return response
+
+    def __compress(self, chunks, encoding, flush):
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=min(self.__level, 11))
+            compress, sync, finish = compressor.process, compressor.flush, compressor.finish
+        else:
+            compressor = zlib.compressobj(self.__level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip framing
+            compress, finish = compressor.compress, compressor.flush
+            sync = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+        for chunk in chunks:
+            data = compress(chunk)
+            if flush:
+                # Send what the chunk produced now, rather than when the buffer fills
+                data += sync()
+            if data:
+                yield data
+        yield finish()
@@ -0,0 +1,65 @@
+import json
+import queue
+import threading
+
+
+class NotificationHub:
+    """In-process publish/subscribe channel for live notification delivery.
+
+    Each open stream (e.g. a Server-Sent Events response) subscribes with the
+    user's id and gets its own queue. DataBase publishes to the hub once a
+    notification has been committed. A slow client whose queue fills up loses
+    its oldest events rather than blocking the writer.
+    """
+
+    def __init__(self, max_queue=100):
+        self.__max_queue = max_queue
+        self.__lock = threading.Lock()
+        self.__subscribers = {}  # user_id -> list of queues
+
+    def subscribe(self, user_id):
+        """Start listening for a user's events, returns the queue to read from"""
+        subscription = queue.Queue(maxsize=self.__max_queue)
+        with self.__lock:
+            self.__subscribers.setdefault(user_id, []).append(subscription)
+        return subscription
+
+    def unsubscribe(self, user_id, subscription):
+        with self.__lock:
+            subscriptions = self.__subscribers.get(user_id, [])
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+            if not subscriptions:
+                self.__subscribers.pop(user_id, None)
+
+    def has_subscribers(self, user_id):
+        return user_id in self.__subscribers
+
+    def get_subscriber_count(self):
+        with self.__lock:
+            return sum(len(subscriptions) for subscriptions in self.__subscribers.values())
+
+    def publish(self, user_id, event):
+        """Send an event dict to every open subscription of a user"""
+        with self.__lock:
+            subscriptions = list(self.__subscribers.get(user_id, []))
+        for subscription in subscriptions:
+            while True:
+                try:
+                    subscription.put_nowait(event)
+                    break
+                except queue.Full:
+                    try:
+                        subscription.get_nowait()
+                    except queue.Empty:
+                        pass
+
+
+def format_sse(event, event_id=None):
+    """Encode an event dict as one Server-Sent Events message"""
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f"event: {event['type']}")
+    lines.append(f'data: {json.dumps(event)}')
+    return '\n'.join(lines) + '\n\n'
@@ -0,0 +1,148 @@
+import atexit
+import heapq
+import random
+import sqlite3
+import threading
+
+
+class PromptSelector:
+    """Keeps post prompts in memory and picks them without querying the database.
+
+    Prompts come from the database's ReferenceDataCache and are grouped per
+    age group, reloading whenever the cache's version changes. Selection is a weighted
+    reservoir sample (Efraimidis-Spirakis) where a prompt's weight is
+    1 / (1 + times_used), so less used prompts come up more often while every
+    prompt still gets a chance. Usage counts are buffered and written back to
+    post_prompts in one batch by a background thread, once enough uses pile up
+    or every `flush_interval` seconds. A failed write keeps the counts for the
+    next flush.
+    """
+
+    def __init__(self, database, flush_threshold=50, flush_interval=30):
+        self.__database = database
+        self.__flush_threshold = flush_threshold
+        self.__flush_interval = flush_interval
+        self.__lock = threading.Lock()
+        self.__prompts = {}            # prompt_id -> database row
+        self.__times_used = {}         # prompt_id -> usage count incl. unflushed uses
+        self.__prompts_by_age_group = {}  # age group -> list of prompt_ids
+        self.__pending_usage = {}      # prompt_id -> uses not yet written
+        self.__version = None
+        self.__wake = threading.Event()
+        self.__stop = threading.Event()
+        self.load()
+
+        self.__thread = threading.Thread(target=self.__run, name='prompt-usage', daemon=True)
+        self.__thread.start()
+        atexit.register(self.close)
+
+    def load(self):
+        """(Re)build the per age group arrays from the reference data cache"""
+        cache = self.__database.reference_cache
+        version = cache.get_version()
+        rows = cache.get_prompts()
+
+        with self.__lock:
+            self.__version = version
+            self.__prompts = {row[0]: row for row in rows}
+            # Unflushed uses still have to count towards the weights
+            self.__times_used = {
+                row[0]: (row[5] or 0) + self.__pending_usage.get(row[0], 0)
+                for row in rows
+            }
+
+            shared = [row[0] for row in rows if row[3] == 'both']
+            by_age_group = {None: shared}
+            for row in rows:
+                if row[3] != 'both':
+                    by_age_group.setdefault(row[3], list(shared)).append(row[0])
+            self.__prompts_by_age_group = by_age_group
+
+    def select(self, age_group, limit=5):
+        """Pick up to `limit` distinct prompts for an age group, favouring under-used ones"""
+        self.__refresh()
+        with self.__lock:
+            candidates = self.__prompts_by_age_group.get(age_group, self.__prompts_by_age_group[None])
+            keyed = (
+                (random.random() ** (1 + self.__times_used[prompt_id]), prompt_id)
+                for prompt_id in candidates
+            )
+            chosen = heapq.nlargest(limit, keyed)
+            return [self.__row_with_usage(prompt_id) for _, prompt_id in chosen]
+
+    def get_prompt(self, prompt_id):
+        """Return the row for a prompt with its current usage count"""
+        self.__refresh()
+        with self.__lock:
+            if prompt_id not in self.__prompts:
+                return None
+            return self.__row_with_usage(prompt_id)
+
+    def record_use(self, prompt_id):
+        """Count one use of a prompt; written to the database on the next flush"""
+        with self.__lock:
+            if prompt_id in self.__times_used:
+                self.__times_used[prompt_id] += 1
+            self.__pending_usage[prompt_id] = self.__pending_usage.get(prompt_id, 0) + 1
+            full = sum(self.__pending_usage.values()) >= self.__flush_threshold
+        if full:
+            # Never written here: this runs after the caller's transaction has committed
+            self.__wake.set()
+
+    def flush(self):
+        """Write all buffered usage counts to post_prompts in a single transaction"""
+        with self.__lock:
+            pending = self.__pending_usage
+            self.__pending_usage = {}
+        if not pending:
+            return
+
+        conn = self.__database.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.executemany('''
+            UPDATE post_prompts
+            SET times_used = times_used + ?
+            WHERE prompt_id = ?
+            ''', [(count, prompt_id) for prompt_id, count in pending.items()])
+            conn.commit()
+        except sqlite3.Error:
+            # Put the counts back so the next flush retries them
+            with self.__lock:
+                for prompt_id, count in pending.items():
+                    self.__pending_usage[prompt_id] = self.__pending_usage.get(prompt_id, 0) + count
+            raise
+        finally:
+            conn.close()
+
+    def get_pending_count(self):
+        with self.__lock:
+            return sum(self.__pending_usage.values())
+
+    def close(self):
+        """Stop the background thread and flush what is left"""
+        self.__stop.set()
+        self.__wake.set()
+        if self.__thread.is_alive() and self.__thread is not threading.current_thread():
+            self.__thread.join()
+        try:
+            self.flush()
+        except sqlite3.Error as e:
+            print(f"Prompt usage flush failed: {e}")
+
+    def __run(self):
+        while not self.__stop.is_set():
+            self.__wake.wait(self.__flush_interval)
+            self.__wake.clear()
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                print(f"Prompt usage flush failed: {e}")
+
+    def __refresh(self):
+        if self.__database.reference_cache.get_version() != self.__version:
+            self.load()
+
+    def __row_with_usage(self, prompt_id):
+        row = self.__prompts[prompt_id]
+        return row[:5] + (self.__times_used[prompt_id],) + row[6:]
@@ -0,0 +1,111 @@
+import os
+import threading
+import time
+from types import MappingProxyType
+
+
+class ReferenceDataCache:
+    """Badges and post prompts held in memory as read-only, pre-indexed structures.
+
+    Both tables are tiny and change only when an admin adds or edits an entry,
+    so every read is served from memory. Writers call bump(), which stores a
+    new version stamp in a small file next to the database. Every process
+    checks that stamp at most once per `check_interval` seconds (a file read,
+    not a query) and reloads when it has moved.
+    """
+
+    def __init__(self, database, check_interval=1.0):
+        self.__database = database
+        self.__stamp_path = f'{database.db_name}-refversion'
+        self.__check_interval = check_interval
+        self.__lock = threading.Lock()
+        self.__version = None
+        self.__checked_at = 0
+        self.load()
+
+    def load(self):
+        """(Re)load badges and prompts from the database"""
+        version = self.__read_stamp()
+        conn = self.__database.get_connection()
+        cursor = conn.cursor()
+        # Plain tuples, even when loaded inside a unit of work with another row_factory
+        cursor.execute('SELECT * FROM badges ORDER BY badge_id')
+        badges = tuple(tuple(row) for row in cursor.fetchall())
+        cursor.execute('SELECT * FROM post_prompts ORDER BY prompt_id')
+        prompts = tuple(tuple(row) for row in cursor.fetchall())
+        conn.close()
+
+        badges_by_criteria = {}
+        for badge in badges:
+            badges_by_criteria.setdefault(badge[4], []).append(badge)
+
+        prompts_by_age_group = {}
+        for prompt in prompts:
+            prompts_by_age_group.setdefault(prompt[3], []).append(prompt)
+
+        with self.__lock:
+            self.__badges = badges
+            self.__badges_by_id = MappingProxyType({badge[0]: badge for badge in badges})
+            self.__badges_by_criteria = MappingProxyType(
+                {criteria: tuple(rows) for criteria, rows in badges_by_criteria.items()})
+            self.__prompts = prompts
+            self.__prompts_by_id = MappingProxyType({prompt[0]: prompt for prompt in prompts})
+            self.__prompts_by_age_group = MappingProxyType(
+                {age_group: tuple(rows) for age_group, rows in prompts_by_age_group.items()})
+            self.__version = version
+            self.__checked_at = time.monotonic()
+
+    def bump(self):
+        """Record that badges or prompts changed so every process reloads them"""
+        temp_path = f'{self.__stamp_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as stamp:
+            stamp.write(str(time.time_ns()))
+        os.replace(temp_path, self.__stamp_path)
+        self.load()
+
+    def get_version(self):
+        self.__reload_if_stale()
+        return self.__version
+
+    # =============== BADGES ===============
+
+    def get_badges(self):
+        self.__reload_if_stale()
+        return self.__badges
+
+    def get_badge(self, badge_id):
+        self.__reload_if_stale()
+        return self.__badges_by_id.get(badge_id)
+
+    def get_badges_for_criteria(self, criteria):
+        self.__reload_if_stale()
+        return self.__badges_by_criteria.get(criteria, ())
+
+    # =============== PROMPTS ===============
+
+    def get_prompts(self):
+        self.__reload_if_stale()
+        return self.__prompts
+
+    def get_prompt(self, prompt_id):
+        self.__reload_if_stale()
+        return self.__prompts_by_id.get(prompt_id)
+
+    def get_prompts_for_age_group(self, age_group):
+        """Prompts targeted at an age group ('youth', 'senior' or 'both')"""
+        self.__reload_if_stale()
+        return self.__prompts_by_age_group.get(age_group, ())
+
+    def __reload_if_stale(self):
+        if time.monotonic() - self.__checked_at < self.__check_interval:
+            return
+        self.__checked_at = time.monotonic()
+        if self.__read_stamp() != self.__version:
+            self.load()
+
+    def __read_stamp(self):
+        try:
+            with open(self.__stamp_path) as stamp:
+                return stamp.read()
+        except FileNotFoundError:
+            return None
@@ -0,0 +1,388 @@
+"""Trigger-fed replication of the BondBuddies database to read replicas.
+
+On the primary, triggers record every row change in replication_log and a
+ChangeShipper moves those rows into JSON-lines segment files in a shared
+directory (the transport; any synced or network directory will do). On each
+follower node a ReplicaFollower applies the segments, in order, to its own
+copy of the database. DataBase routes read-only methods to that copy through
+a ReplicaRouter as long as it is no staler than the configured bound.
+
+    python replication.py follow --primary BondBuddies.db --ship-dir /shared/replication --replica replica.db
+"""
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from change_capture import remove_change_capture
+
+# Kept up to date by triggers on the replica itself, or never read from one
+EXCLUDED_TABLES = {'replication_log', 'change_log', 'notification_counters', 'user_actions', 'user_action_daily'}
+
+HEARTBEAT_FILE = 'heartbeat.json'
+
+
+def get_replicated_tables(cursor):
+    """Tables whose row changes are shipped to replicas"""
+    cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")
+    tables = cursor.fetchall()
+    # Virtual tables (the R*Tree) and their shadow tables are rebuilt by triggers on the replica
+    virtual = [name for name, sql in tables if sql and sql.upper().startswith('CREATE VIRTUAL')]
+    return [name for name, sql in tables
+            if name not in EXCLUDED_TABLES and name not in virtual
+            and not any(name.startswith(f'{table}_') for table in virtual)]
+
+
+def install_changelog(cursor):
+    """Create replication_log and (re)create the triggers that feed it.
+
+    Triggers list every column, so this runs after migrations on each start.
+    """
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS replication_log (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        table_name TEXT NOT NULL,
+        op TEXT NOT NULL CHECK(op IN ('I', 'U', 'D')),
+        row_id INTEGER NOT NULL,
+        row_data TEXT,
+        changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    remove_changelog(cursor)
+
+    for table in get_replicated_tables(cursor):
+        cursor.execute(f'PRAGMA table_info("{table}")')
+        columns = [row[1] for row in cursor.fetchall()]
+        row_json = 'json_object(' + ', '.join(f"'{column}', NEW.\"{column}\"" for column in columns) + ')'
+        cursor.execute(f'''
+        CREATE TRIGGER trg_replication_{table}_insert AFTER INSERT ON "{table}"
+        BEGIN
+            INSERT INTO replication_log (table_name, op, row_id, row_data)
+            VALUES ('{table}', 'I', NEW.rowid, {row_json});
+        END
+        ''')
+        cursor.execute(f'''
+        CREATE TRIGGER trg_replication_{table}_update AFTER UPDATE ON "{table}"
+        BEGIN
+            INSERT INTO replication_log (table_name, op, row_id, row_data)
+            VALUES ('{table}', 'U', OLD.rowid, {row_json});
+        END
+        ''')
+        cursor.execute(f'''
+        CREATE TRIGGER trg_replication_{table}_delete AFTER DELETE ON "{table}"
+        BEGIN
+            INSERT INTO replication_log (table_name, op, row_id) VALUES ('{table}', 'D', OLD.rowid);
+        END
+        ''')
+
+
+def remove_changelog(cursor):
+    """Drop every changelog trigger (replicas must not log the changes they apply)"""
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'trg\\_replication\\_%' ESCAPE '\\'")
+    for (name,) in cursor.fetchall():
+        cursor.execute(f'DROP TRIGGER "{name}"')
+
+
+class ChangeShipper:
+    """Moves replication_log rows from the primary into segment files.
+
+    Every `interval` seconds the unshipped rows are written (via a temp file
+    and rename, so followers never see half a segment) to
+    <ship_dir>/<first seq>-<last seq>.jsonl and deleted from the log. A
+    heartbeat file then records that every change committed before its
+    timestamp is in a segment up to its seq, which is what followers measure
+    their lag against. Segments older than `retention` seconds are removed;
+    a follower further behind than that has to bootstrap again.
+    """
+
+    def __init__(self, database, ship_dir, interval=0.5, batch_size=5000, retention=3600):
+        self.__database = database
+        self.__ship_dir = ship_dir
+        self.__interval = interval
+        self.__batch_size = batch_size
+        self.__retention = retention
+        self.__stop = threading.Event()
+        self.__thread = None
+        os.makedirs(ship_dir, exist_ok=True)
+
+    def start(self):
+        if self.__thread is not None and self.__thread.is_alive():
+            return
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run, name='change-shipper', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def __run(self):
+        while not self.__stop.is_set():
+            try:
+                self.ship()
+                self.prune()
+            except (sqlite3.Error, OSError) as e:
+                print(f"Change shipper error: {e}")
+            self.__stop.wait(self.__interval)
+
+    def ship(self):
+        """Write every unshipped change to segments, returns how many were shipped"""
+        # Taken before reading, so everything committed by then is covered by this pass
+        heartbeat_at = time.time()
+        conn = self.__database.get_connection()
+        cursor = conn.cursor()
+        shipped = 0
+        last_seq = None
+        while True:
+            cursor.execute('''
+            SELECT seq, table_name, op, row_id, row_data FROM replication_log
+            ORDER BY seq
+            LIMIT ?
+            ''', (self.__batch_size,))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+
+            segment = os.path.join(self.__ship_dir, f'{rows[0][0]:020d}-{rows[-1][0]:020d}.jsonl')
+            with open(f'{segment}.tmp', 'w', encoding='utf-8') as output:
+                for seq, table, op, row_id, row_data in rows:
+                    output.write(json.dumps({'seq': seq, 'table': table, 'op': op, 'rowid': row_id,
+                                             'row': json.loads(row_data) if row_data else None}) + '\n')
+                output.flush()
+                os.fsync(output.fileno())
+            os.replace(f'{segment}.tmp', segment)
+
+            # A crash before this delete ships the rows again; followers skip seqs they have
+            last_seq = rows[-1][0]
+            cursor.execute('DELETE FROM replication_log WHERE seq <= ?', (last_seq,))
+            conn.commit()
+            shipped += len(rows)
+
+        if last_seq is None:
+            cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'replication_log'")
+            row = cursor.fetchone()
+            last_seq = row[0] if row else 0
+        conn.close()
+
+        temp_path = os.path.join(self.__ship_dir, f'.{HEARTBEAT_FILE}.tmp')
+        with open(temp_path, 'w') as heartbeat:
+            json.dump({'seq': last_seq, 'at': heartbeat_at}, heartbeat)
+        os.replace(temp_path, os.path.join(self.__ship_dir, HEARTBEAT_FILE))
+        return shipped
+
+    def prune(self):
+        """Delete segments older than the retention period, returns how many"""
+        cutoff = time.time() - self.__retention
+        removed = 0
+        for entry in os.listdir(self.__ship_dir):
+            path = os.path.join(self.__ship_dir, entry)
+            if entry.endswith('.jsonl') and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+        return removed
+
+
+class ReplicaFollower:
+    """Keeps a replica database file up to date from shipped segments.
+
+    A missing replica is bootstrapped with the online backup API from the
+    primary (standing in for copying a BackupManager snapshot across nodes).
+    Segments are applied in seq order, one transaction each, together with
+    the replica_state row recording the last seq applied and the primary time
+    the replica is known to be current as of. The replica runs in WAL mode so
+    readers are never blocked by the follower.
+    """
+
+    def __init__(self, replica_name, ship_dir, primary_name=None, interval=0.5):
+        self.__replica_name = replica_name
+        self.__ship_dir = ship_dir
+        self.__primary_name = primary_name
+        self.__interval = interval
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def start(self):
+        if self.__thread is not None and self.__thread.is_alive():
+            return
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run, name='replica-follower', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def __run(self):
+        while not self.__stop.is_set():
+            try:
+                self.catch_up()
+            except (sqlite3.Error, OSError, ValueError) as e:
+                print(f"Replica follower error: {e}")
+            self.__stop.wait(self.__interval)
+
+    def bootstrap(self):
+        """Copy the primary into a new replica file"""
+        if self.__primary_name is None:
+            raise ValueError('A primary database is needed to bootstrap a replica')
+        copied_at = time.time()
+        primary = sqlite3.connect(self.__primary_name)
+        replica = sqlite3.connect(self.__replica_name)
+        primary.backup(replica, pages=1024)
+        primary.close()
+
+        cursor = replica.cursor()
+        # Every change up to the last seq handed out is part of the copy
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'replication_log'")
+        row = cursor.fetchone()
+        applied_seq = row[0] if row else 0
+        remove_changelog(cursor)
+        remove_change_capture(cursor)
+        cursor.execute('DELETE FROM replication_log')
+        cursor.execute('DELETE FROM change_log')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS replica_state (
+            id INTEGER PRIMARY KEY CHECK(id = 1),
+            applied_seq INTEGER NOT NULL,
+            synced_at REAL NOT NULL
+        )
+        ''')
+        cursor.execute('INSERT OR REPLACE INTO replica_state (id, applied_seq, synced_at) VALUES (1, ?, ?)',
+                       (applied_seq, copied_at))
+        replica.commit()
+        cursor.execute('PRAGMA journal_mode = WAL')
+        replica.close()
+
+    def catch_up(self):
+        """Apply every new segment, returns how many changes were applied"""
+        if not os.path.exists(self.__replica_name):
+            self.bootstrap()
+
+        replica = sqlite3.connect(self.__replica_name)
+        cursor = replica.cursor()
+        cursor.execute('SELECT applied_seq FROM replica_state WHERE id = 1')
+        applied_seq = cursor.fetchone()[0]
+
+        # Read before listing segments, so it never claims more than what gets applied
+        heartbeat = self.__read_heartbeat()
+
+        applied = 0
+        segments = sorted(entry for entry in os.listdir(self.__ship_dir) if entry.endswith('.jsonl'))
+        for segment in segments:
+            first_seq, last_seq = (int(part) for part in segment[:-len('.jsonl')].split('-'))
+            if last_seq <= applied_seq:
+                continue
+            if first_seq > applied_seq + 1:
+                raise ValueError(f'Replica is missing changes {applied_seq + 1}-{first_seq - 1}, '
+                                 f'delete {self.__replica_name} to bootstrap it again')
+
+            with open(os.path.join(self.__ship_dir, segment), encoding='utf-8') as changes:
+                for line in changes:
+                    change = json.loads(line)
+                    if change['seq'] > applied_seq:
+                        self.__apply(cursor, change)
+                        applied_seq = change['seq']
+                        applied += 1
+            cursor.execute('UPDATE replica_state SET applied_seq = ? WHERE id = 1', (applied_seq,))
+            replica.commit()
+
+        if heartbeat is not None and heartbeat['seq'] <= applied_seq:
+            cursor.execute('UPDATE replica_state SET synced_at = MAX(synced_at, ?) WHERE id = 1',
+                           (heartbeat['at'],))
+            replica.commit()
+        replica.close()
+        return applied
+
+    def __apply(self, cursor, change):
+        table, row = change['table'], change['row']
+        if change['op'] == 'D':
+            cursor.execute(f'DELETE FROM "{table}" WHERE rowid = ?', (change['rowid'],))
+        elif change['op'] == 'I':
+            columns = ', '.join(f'"{column}"' for column in row)
+            placeholders = ', '.join('?' for _ in row)
+            cursor.execute(f'INSERT INTO "{table}" ({columns}) VALUES ({placeholders})', list(row.values()))
+        else:
+            # A real UPDATE, not REPLACE, so the replica's own triggers see the same change
+            assignments = ', '.join(f'"{column}" = ?' for column in row)
+            cursor.execute(f'UPDATE "{table}" SET {assignments} WHERE rowid = ?',
+                           [*row.values(), change['rowid']])
+
+    def __read_heartbeat(self):
+        try:
+            with open(os.path.join(self.__ship_dir, HEARTBEAT_FILE)) as heartbeat:
+                return json.load(heartbeat)
+        except FileNotFoundError:
+            return None
+
+
+class ReplicaRouter:
+    """Hands out read-only replica connections while the replica is fresh enough.
+
+    The replica's staleness is now minus the primary time it is known to be
+    current as of; it is re-read at most every `check_interval` seconds.
+    connect() returns None once it exceeds `max_staleness`, and the caller
+    reads from the primary instead.
+    """
+
+    def __init__(self, replica_name, max_staleness=5.0, check_interval=0.25):
+        self.__replica_name = replica_name
+        self.__max_staleness = max_staleness
+        self.__check_interval = check_interval
+        self.__synced_at = None
+        self.__checked_at = 0
+
+    def get_lag(self):
+        """Seconds the replica is behind the primary, None if it has not synced yet"""
+        if time.monotonic() - self.__checked_at >= self.__check_interval:
+            self.__synced_at = self.__read_synced_at()
+            self.__checked_at = time.monotonic()
+        if self.__synced_at is None:
+            return None
+        return max(time.time() - self.__synced_at, 0.0)
+
+    def connect(self):
+        """A read-only connection to the replica, None when it is too stale to use"""
+        lag = self.get_lag()
+        if lag is None or lag > self.__max_staleness:
+            return None
+        return sqlite3.connect(f'file:{self.__replica_name}?mode=ro', uri=True)
+
+    def __read_synced_at(self):
+        if not os.path.exists(self.__replica_name):
+            return None
+        try:
+            conn = sqlite3.connect(f'file:{self.__replica_name}?mode=ro', uri=True)
+            try:
+                row = conn.execute('SELECT synced_at FROM replica_state WHERE id = 1').fetchone()
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            return None
+        return row[0] if row else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a read replica of the BondBuddies database')
+    parser.add_argument('command', choices=['follow'])
+    parser.add_argument('--primary', default='BondBuddies.db', help='primary database, used to bootstrap')
+    parser.add_argument('--ship-dir', required=True)
+    parser.add_argument('--replica', required=True)
+    parser.add_argument('--interval', type=float, default=0.5)
+    args = parser.parse_args()
+
+    follower = ReplicaFollower(args.replica, args.ship_dir, args.primary, args.interval)
+    follower.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        follower.stop()
+
+
+if __name__ == '__main__':
+    main()
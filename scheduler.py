@@ -0,0 +1,92 @@
+"""Background jobs that must run in exactly one process per database.
+
+    python scheduler.py [--db BondBuddies.db] [--replication-dir DIR]
+                        [--backup-interval 86400] [--analytics-interval 86400]
+
+Every web worker imports the app, so a job started there runs once per
+worker: the copies repeat each other's work and queue behind each other on
+the write lock. The app only serves requests and keeps its own in-memory
+caches up to date; run this next to it, once, to do everything else. Give
+it the same --replication-dir as the app's BONDBUDDIES_REPLICATION_DIR.
+"""
+import argparse
+import time
+
+from analytics import AnalyticsJob
+from archival import DataArchiver
+from backup import BackupManager
+from database import DataBase
+from deletion import DeletionWorker
+from replication import ChangeShipper
+
+
+class Scheduler:
+    """Starts and stops the jobs that have to run in a single process.
+
+    - DataArchiver rolls up old activity and moves old notifications to the
+      archive database every hour.
+    - DeletionWorker purges the rows of deleted users and posts in small
+      batches, checking for new deletion jobs every few seconds.
+    - BackupManager snapshots the database and its archive every
+      `backup_interval` seconds, keeping the last week of them.
+    - AnalyticsJob computes the engagement rollups the dashboard reads
+      every `analytics_interval` seconds.
+
+    - ChangeShipper moves logged row changes into the replication directory
+      for read replicas, when the database has one.
+
+    Backups and analytics take their first run straight away when they have
+    none yet.
+    """
+
+    def __init__(self, database, backup_interval=86400, analytics_interval=86400):
+        self.__backup_interval = backup_interval
+        self.__analytics_interval = analytics_interval
+        self.archiver = DataArchiver(database)
+        self.deletions = DeletionWorker(database, archiver=self.archiver)
+        self.backups = BackupManager(database.db_name, archive_name=self.archiver.get_archive_name())
+        self.analytics = AnalyticsJob(database.db_name)
+        self.shipper = None
+        if database.replication_dir:
+            self.shipper = ChangeShipper(database, database.replication_dir)
+
+    def start(self):
+        self.archiver.start()
+        self.deletions.start()
+        self.backups.start(self.__backup_interval)
+        self.analytics.start(self.__analytics_interval)
+        if self.shipper is not None:
+            self.shipper.start()
+
+    def stop(self):
+        """Stop every job after the work it is doing now"""
+        if self.shipper is not None:
+            self.shipper.stop()
+        self.analytics.stop()
+        self.backups.stop()
+        self.deletions.stop()
+        self.archiver.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the BondBuddies background jobs')
+    parser.add_argument('--db', default='BondBuddies.db')
+    parser.add_argument('--replication-dir', help='ship row changes here for read replicas')
+    parser.add_argument('--backup-interval', type=int, default=86400,
+                        help='seconds between backups')
+    parser.add_argument('--analytics-interval', type=int, default=86400,
+                        help='seconds between analytics runs')
+    args = parser.parse_args()
+
+    scheduler = Scheduler(DataBase(args.db, replication_dir=args.replication_dir), backup_interval=args.backup_interval,
+                          analytics_interval=args.analytics_interval)
+    scheduler.start()
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        scheduler.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import os
+import sqlite3
+
+# The user-owned tables, split across the shard files by user_id
+SHARDED_TABLES = ('posts', 'user_actions', 'user_action_daily', 'notifications', 'notification_counters',
+                  'user_badges')
+
+# Tables whose AUTOINCREMENT ids carry their shard in the high bits
+SHARDED_ID_TABLES = ('posts', 'user_actions', 'notifications', 'user_badges')
+
+# Row ids of shard i start at i << ID_BITS, room for a trillion rows per shard
+ID_BITS = 40
+
+# SQLite attaches at most 10 databases to a connection; archiving needs one more
+MAX_SHARDS = 8
+
+
+def get_shard_names(db_name, shard_count):
+    """File names of a database's shards, next to it: BondBuddies_shard0.db, ..."""
+    root, ext = os.path.splitext(db_name)
+    return [f'{root}_shard{index}{ext}' for index in range(shard_count)]
+
+
+def read_shard_names(db_name):
+    """Paths of the shard files a database was created with, from its shards table; [] when unsharded"""
+    # sqlite3.connect() would quietly create an empty database in its place
+    if not os.path.exists(db_name):
+        return []
+    conn = sqlite3.connect(db_name)
+    try:
+        rows = conn.execute('SELECT file_name FROM shards ORDER BY shard_id').fetchall()
+    except sqlite3.OperationalError:
+        rows = []  # Never opened by a DataBase that knows about shards
+    finally:
+        conn.close()
+    return [os.path.join(os.path.dirname(db_name), file_name) for (file_name,) in rows]
+
+
+class ShardRouter:
+    """Maps users and row ids to the shard files holding their rows.
+
+    A user's posts, actions, notifications and badges all live in shard
+    user_id % shard_count, each shard a database file of its own, so writes
+    for users on different shards take different write locks. Ids are
+    handed out per shard from index << ID_BITS up, which keeps them unique
+    across shards and tells which shard holds a post or notification from
+    its id alone.
+
+    Shards are ATTACHed to the main database's connection as shard0,
+    shard1, ... so one statement can join them with users and one
+    transaction can span several of them (committed atomically through
+    SQLite's super-journal outside WAL mode). ATTACH is not allowed inside a
+    transaction, so methods attach the shards they need before they write.
+    """
+
+    def __init__(self, db_name, shard_count):
+        if not 1 <= shard_count <= MAX_SHARDS:
+            raise ValueError(f'shard_count must be between 1 and {MAX_SHARDS}, got {shard_count}')
+        self.shard_count = shard_count
+        self.shard_names = get_shard_names(db_name, shard_count)
+
+    def get_schema(self, index):
+        return f'shard{index}'
+
+    def get_schemas(self):
+        return [self.get_schema(index) for index in range(self.shard_count)]
+
+    def shard_for_user(self, user_id):
+        return user_id % self.shard_count
+
+    def shard_for_id(self, row_id):
+        """Shard of a sharded row by its id; ids no shard handed out map to one without that row"""
+        return min(max(row_id >> ID_BITS, 0), self.shard_count - 1)
+
+    def get_id_base(self, index):
+        """First id minus one of the rows a shard creates"""
+        return index << ID_BITS
+
+    def attach(self, conn, indexes=None):
+        """ATTACH the given shards (all by default) that the connection does not have yet"""
+        attached = {row[1] for row in conn.execute('PRAGMA database_list')}
+        for index in range(self.shard_count) if indexes is None else indexes:
+            schema = self.get_schema(index)
+            if schema not in attached:
+                conn.execute(f'ATTACH DATABASE ? AS {schema}', (self.shard_names[index],))
+                attached.add(schema)
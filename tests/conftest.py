@@ -0,0 +1,80 @@
+import os
+import sqlite3
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from database import DataBase
+from traffic import load_app, stop_app
+
+
+class PlainRootDirectory:
+    """Collects the repository root as a plain directory.
+
+    The root is also the app's package, and pytest imports a package's
+    __init__.py before running tests under it, which would start the app
+    (and its background workers) in the current directory.
+    """
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_collect_directory(self, path, parent):
+        if path == ROOT:
+            return pytest.Dir.from_parent(parent, path=path)
+        return None
+
+
+def pytest_configure(config):
+    config.pluginmanager.register(PlainRootDirectory())
+
+
+@pytest.fixture
+def make_db(tmp_path):
+    """Build DataBase instances on a fresh file under tmp_path, closed again afterwards"""
+    created = []
+
+    def make(name='test.db', **kwargs):
+        database = DataBase(str(tmp_path / name), **kwargs)
+        created.append(database)
+        return database
+
+    yield make
+    for database in created:
+        database.prompt_selector.close()
+        if database.activity_buffer is not None:
+            database.activity_buffer.close()
+
+
+@pytest.fixture
+def db(make_db):
+    return make_db()
+
+
+@pytest.fixture
+def app_module(tmp_path, monkeypatch):
+    """The app imported against a database under tmp_path"""
+    monkeypatch.chdir(tmp_path)
+    # Set by load_app(), put back afterwards
+    monkeypatch.setenv('BONDBUDDIES_DB', '')
+    module = load_app(str(tmp_path / 'app.db'))
+    yield module
+    stop_app(module)
+
+
+def login(client, database, username, user_type='S'):
+    """Create a user and log the client in as them, returns the user_id"""
+    user_id = database.insert_user(username, 'pw', user_type)
+    with client.session_transaction() as session:
+        session.update({'user_id': user_id, 'username': username, 'user_type': user_type, 'logged_in': True})
+    return user_id
+
+
+def query(database, sql, params=()):
+    """Run a query on a connection of its own, so only committed rows are seen"""
+    conn = sqlite3.connect(database.db_name)
+    rows = conn.execute(sql, params).fetchall()
+    conn.close()
+    return rows
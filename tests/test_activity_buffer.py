@@ -0,0 +1,143 @@
+import subprocess
+import sys
+import time
+
+import pytest
+
+from conftest import ROOT, query
+
+
+def actions(database):
+    return query(database, 'SELECT user_id, action_type FROM user_actions ORDER BY action_id')
+
+
+@pytest.fixture(params=[True, False], ids=['buffered', 'unbuffered'])
+def any_db(request, make_db):
+    return make_db(buffer_actions=request.param)
+
+
+def test_badge_check_in_unit_of_work_sees_its_own_action(any_db):
+    author = any_db.insert_user('author', 'pw', 'S')
+    commenter = any_db.insert_user('commenter', 'pw', 'Y')
+    post_id = any_db.insert_post('hello', author)
+
+    with any_db.unit_of_work():
+        any_db.insert_comment(post_id, commenter, 'nice')
+        any_db.check_and_award_badges(commenter)
+
+    # Badge 1 is earned by a first comment
+    assert query(any_db, 'SELECT badge_id FROM user_badges WHERE user_id = ?', (commenter,)) == [(1,)]
+
+
+def test_flush_in_unit_of_work_uses_its_connection(db):
+    author = db.insert_user('author', 'pw', 'S')
+    db.insert_post('queued before the unit', author)
+    assert db.activity_buffer.get_pending_count() == 1
+
+    started = time.monotonic()
+    with db.unit_of_work(immediate=True):
+        db.insert_post('inside the unit', author)
+        db.flush_actions()
+    assert time.monotonic() - started < 1  # A second connection would wait out the busy timeout
+
+    assert actions(db) == [(author, 'create_post'), (author, 'create_post')]
+
+
+def test_rolled_back_unit_drops_its_actions_and_requeues_others(db):
+    author = db.insert_user('author', 'pw', 'S')
+    other = db.insert_user('other', 'pw', 'Y')
+    db.insert_post('queued', other)
+
+    with pytest.raises(RuntimeError):
+        with db.unit_of_work():
+            db.insert_post('rolled back', author)
+            db.flush_actions()
+            raise RuntimeError
+
+    assert actions(db) == []
+    assert db.activity_buffer.get_pending_count() == 1
+    db.flush_actions()
+    assert actions(db) == [(other, 'create_post')]
+
+
+def test_inner_rollback_only_drops_the_inner_actions(db):
+    author = db.insert_user('author', 'pw', 'S')
+    post_id = db.insert_post('hello', author)
+    liker = db.insert_user('liker', 'pw', 'Y')
+
+    with db.unit_of_work():
+        db.like_post(post_id, liker)
+        with pytest.raises(RuntimeError):
+            with db.unit_of_work():
+                db.insert_comment(post_id, liker, 'gone')
+                db.flush_actions()
+                raise RuntimeError
+    db.flush_actions()
+
+    assert actions(db) == [(author, 'create_post'), (liker, 'like_post')]
+
+
+def test_unflushed_actions_are_queued_when_the_unit_commits(db):
+    author = db.insert_user('author', 'pw', 'S')
+    with db.unit_of_work():
+        db.insert_post('hello', author)
+        assert db.activity_buffer.get_pending_count() == 0
+    assert db.activity_buffer.get_pending_count() == 1
+    db.flush_actions()
+    assert actions(db) == [(author, 'create_post')]
+
+
+CHILD = '''
+import os, sys
+sys.path.insert(0, {root!r})
+from database import DataBase
+db = DataBase({db_name!r})
+user_id = db.insert_user('child', 'pw', 'S')
+db.flush_actions()
+db.insert_post('logged, not flushed', user_id)
+print('ready', flush=True)
+sys.stdin.readline()
+os._exit(0)  # No atexit flush, as if the process had crashed
+'''
+
+
+def start_child(db_name):
+    child = subprocess.Popen([sys.executable, '-c', CHILD.format(root=str(ROOT), db_name=db_name)],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    assert child.stdout.readline().strip() == 'ready'
+    return child
+
+
+def log_segments(tmp_path):
+    return sorted(path.name for path in tmp_path.iterdir() if '_activity.log.' in path.name)
+
+
+def test_live_process_log_is_not_replayed(tmp_path, make_db):
+    child = start_child(str(tmp_path / 'test.db'))
+    try:
+        db = make_db()
+        assert actions(db) == []  # The child's queued post stays its own
+        assert len(log_segments(tmp_path)) == 2
+    finally:
+        child.stdin.close()
+        child.wait()
+
+
+def test_dead_process_log_is_replayed_once(tmp_path, make_db):
+    child = start_child(str(tmp_path / 'test.db'))
+    child.stdin.close()
+    child.wait()
+
+    first = make_db()
+    second = make_db()
+    assert [action for _, action in actions(second)] == ['create_post']
+    first.activity_buffer.close()
+    second.activity_buffer.close()
+    assert log_segments(tmp_path) == []
+
+
+def test_partly_written_line_is_skipped(tmp_path, make_db):
+    (tmp_path / 'test_activity.log.99999.1').write_text(
+        '[1, "create_post", 5, null, "2024-01-01 00:00:00"]\n[1, "like_po', encoding='utf-8')
+    db = make_db()
+    assert actions(db) == [(1, 'create_post')]
@@ -0,0 +1,86 @@
+import threading
+import time
+
+from flask import Flask
+
+from admission import AdmissionController, classify
+
+CLASSES = {
+    'read': {'priority': 0, 'limit': 1, 'max_queue': 2, 'max_wait': 1.0},
+    'write': {'priority': 1, 'limit': 1, 'max_queue': 1, 'max_wait': 1.0},
+}
+
+
+def wait_for_queue(controller, depth):
+    deadline = time.monotonic() + 2
+    while controller.get_metrics()['queued'] < depth and time.monotonic() < deadline:
+        time.sleep(0.005)
+
+
+def test_classify():
+    assert classify('login', 'POST') == 'hash'
+    assert classify('login', 'GET') == 'read'
+    assert classify('batch', 'POST') == 'read'
+    assert classify('create_post', 'POST') == 'write'
+
+
+def test_freed_slot_goes_to_the_more_urgent_class():
+    controller = AdmissionController(max_in_flight=1, classes=CLASSES)
+    assert controller.acquire('write') is None
+    order = []
+
+    def request(route_class):
+        assert controller.acquire(route_class) is None
+        order.append(route_class)
+        controller.release(route_class, 0.001)
+
+    writer = threading.Thread(target=request, args=('write',))
+    writer.start()
+    wait_for_queue(controller, 1)
+    reader = threading.Thread(target=request, args=('read',))
+    reader.start()
+    wait_for_queue(controller, 2)
+
+    controller.release('write', 0.001)
+    writer.join()
+    reader.join()
+    assert order == ['read', 'write']
+
+
+def test_request_over_its_latency_budget_is_shed_straight_away():
+    controller = AdmissionController(max_in_flight=1, classes=CLASSES)
+    assert controller.acquire('write') is None
+    controller.release('write', 5.0)  # Each write now expected to take 5 s
+    assert controller.acquire('write') is None
+
+    started = time.monotonic()
+    assert controller.acquire('write')[0] == 'over_budget'
+    assert time.monotonic() - started < 0.5
+    metrics = controller.get_metrics()['classes']['write']
+    assert metrics['shed_over_budget'] == 1
+
+
+def test_request_not_admitted_within_max_wait_is_shed():
+    classes = dict(CLASSES, read=dict(CLASSES['read'], max_wait=0.05))
+    controller = AdmissionController(max_in_flight=1, classes=classes)
+    assert controller.acquire('read') is None
+    assert controller.acquire('read')[0] == 'deadline'
+    assert controller.get_metrics()['queued'] == 0
+
+
+def test_shed_request_gets_503_with_retry_after():
+    app = Flask(__name__)
+    classes = dict(CLASSES, write=dict(CLASSES['write'], max_queue=0))
+    controller = AdmissionController(app, max_in_flight=1, classes=classes)
+
+    @app.route('/posts', methods=['POST'])
+    def create_post():
+        return 'ok'
+
+    client = app.test_client()
+    assert client.post('/posts').status_code == 200
+    assert controller.acquire('write') is None
+    response = client.post('/posts')
+    assert response.status_code == 503
+    assert response.get_json()['reason'] == 'queue_full'
+    assert int(response.headers['Retry-After']) >= 1
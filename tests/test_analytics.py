@@ -0,0 +1,33 @@
+import os
+
+import pytest
+
+from analytics import AnalyticsJob
+from conftest import login
+
+
+def test_export_snapshot_without_database(tmp_path):
+    job = AnalyticsJob(str(tmp_path / 'missing.db'))
+    with pytest.raises(FileNotFoundError):
+        job.export_snapshot()
+    assert not os.path.exists(tmp_path / 'missing.db')
+    assert job.list_snapshots() == []
+
+
+def test_run_once_stores_rollups(db, tmp_path):
+    senior = db.insert_user('sam', 'pw', 'S')
+    db.insert_post('hello from the community centre', senior)
+    job = AnalyticsJob(db.db_name, snapshot_dir=str(tmp_path / 'snapshots'))
+    name = job.run_once()
+    assert job.list_snapshots() == [name]
+    assert db.get_last_analytics_run() is not None
+
+
+def test_analytics_route_is_for_admins_only(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'ADMIN_USERNAMES', {'boss'})
+    client = app_module.app.test_client()
+    assert client.get('/api/analytics').status_code == 401
+    login(client, app_module.db, 'sam')
+    assert client.get('/api/analytics').status_code == 403
+    login(client, app_module.db, 'Boss')
+    assert client.get('/api/analytics').status_code == 200
@@ -0,0 +1,61 @@
+import sqlite3
+
+from archival import DataArchiver, enable_incremental_vacuum
+from conftest import query
+
+
+def auto_vacuum(database):
+    return query(database, 'PRAGMA auto_vacuum')[0][0]
+
+
+def make_legacy_db(make_db, tmp_path):
+    """A database created before incremental auto-vacuum, with free pages"""
+    conn = sqlite3.connect(tmp_path / 'legacy.db')
+    conn.execute('CREATE TABLE filler (data BLOB)')
+    conn.executemany('INSERT INTO filler VALUES (?)', [(bytes(4000),)] * 200)
+    conn.commit()
+    conn.execute('DELETE FROM filler')
+    conn.commit()
+    conn.close()
+    return make_db('legacy.db')
+
+
+def test_vacuum_leaves_a_legacy_database_alone(make_db, tmp_path):
+    database = make_legacy_db(make_db, tmp_path)
+    assert DataArchiver(database).vacuum() == 0
+    assert auto_vacuum(database) == 0
+
+
+def test_offline_switch_then_incremental_vacuum(make_db, tmp_path):
+    database = make_legacy_db(make_db, tmp_path)
+    assert enable_incremental_vacuum(database.db_name)
+    assert not enable_incremental_vacuum(database.db_name)
+    assert auto_vacuum(database) == 2
+
+    conn = sqlite3.connect(database.db_name)
+    conn.executemany('INSERT INTO filler VALUES (?)', [(bytes(4000),)] * 50)
+    conn.commit()
+    conn.execute('DELETE FROM filler')
+    conn.commit()
+    conn.close()
+    free_pages = query(database, 'PRAGMA freelist_count')[0][0]
+    assert free_pages > 0
+    assert DataArchiver(database).vacuum() == free_pages
+    assert query(database, 'PRAGMA freelist_count') == [(0,)]
+
+
+def test_old_read_notifications_move_to_the_archive(db):
+    user_id = db.insert_user('sam', 'pw', 'S')
+    conn = sqlite3.connect(db.db_name)
+    conn.executemany('''
+    INSERT INTO notifications (user_id, notification_type, message, is_read, created_at)
+    VALUES (?, 'like', ?, ?, datetime('now', ?))
+    ''', [(user_id, 'old read', 1, '-40 days'), (user_id, 'old unread', 0, '-40 days'),
+          (user_id, 'new read', 1, '-1 days')])
+    conn.commit()
+    conn.close()
+
+    archiver = DataArchiver(db)
+    assert archiver.archive_notifications() == 1
+    assert [row[3] for row in archiver.get_archived_notifications(user_id)] == ['old read']
+    assert query(db, 'SELECT message FROM notifications ORDER BY notification_id') == [('old unread',), ('new read',)]
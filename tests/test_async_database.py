@@ -0,0 +1,23 @@
+import asyncio
+import threading
+
+from async_database import AsyncDataBase
+
+
+def test_calls_run_off_the_event_loop_and_gather_together(db):
+    async_db = AsyncDataBase(db, max_workers=2)
+    user_id = db.insert_user('sam', 'pw', 'S')
+
+    async def main():
+        post_id = await async_db.insert_post('hello', user_id)
+        user, posts, thread_name = await asyncio.gather(
+            async_db.get_user_by_id(user_id),
+            async_db.get_posts_by_user(user_id),
+            async_db.run(lambda: threading.current_thread().name))
+        return post_id, user, posts, thread_name
+
+    post_id, user, posts, thread_name = asyncio.run(main())
+    async_db.shutdown()
+    assert user[1] == 'sam'
+    assert [post[0] for post in posts] == [post_id]
+    assert thread_name.startswith('async-db')
@@ -0,0 +1,25 @@
+import io
+
+import pytest
+
+from avatars import AvatarPipeline, AvatarTooLarge
+
+
+@pytest.fixture
+def pipeline(db, tmp_path):
+    pipeline = AvatarPipeline(db, static_dir=str(tmp_path / 'static'), chunk_size=4, max_bytes=10)
+    yield pipeline
+    pipeline.shutdown()
+
+
+def test_empty_upload_is_not_reported_as_too_large(pipeline, tmp_path):
+    with pytest.raises(ValueError) as raised:
+        pipeline.save_upload(1, io.BytesIO(b''))
+    assert not isinstance(raised.value, AvatarTooLarge)
+    assert not list((tmp_path / 'static' / 'avatars' / 'uploads').iterdir())
+
+
+def test_upload_over_max_bytes_is_rejected_while_streaming(pipeline, tmp_path):
+    with pytest.raises(AvatarTooLarge):
+        pipeline.save_upload(1, io.BytesIO(b'x' * 11))
+    assert not list((tmp_path / 'static' / 'avatars' / 'uploads').iterdir())
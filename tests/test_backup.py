@@ -0,0 +1,47 @@
+import os
+import sqlite3
+
+from archival import DataArchiver
+from backup import BackupManager
+from conftest import query
+
+
+def test_backup_verify_and_restore(db, tmp_path):
+    user_id = db.insert_user('sam', 'pw', 'S')
+    db.insert_post('kept', user_id)
+    manager = BackupManager(db.db_name, backup_dir=str(tmp_path / 'backups'), pages_per_step=1, keep=2)
+    name = manager.backup()
+    assert manager.list_snapshots() == [name]
+    assert manager.verify(name) == {'test.db.gz': 'ok'}
+
+    db.insert_post('after the backup', user_id)
+    assert manager.restore(name) == [db.db_name]
+    assert query(db, 'SELECT content FROM posts') == [('kept',)]
+
+
+def test_only_the_newest_snapshots_are_kept(db, tmp_path):
+    manager = BackupManager(db.db_name, backup_dir=str(tmp_path / 'backups'), compress=False, keep=2)
+    names = [manager.backup() for _ in range(3)]
+    assert manager.list_snapshots() == names[1:]
+    assert os.path.exists(tmp_path / 'backups' / names[2] / 'test.db')
+
+
+def test_snapshots_include_the_archive(db, tmp_path):
+    user_id = db.insert_user('sam', 'pw', 'S')
+    conn = sqlite3.connect(db.db_name)
+    conn.execute('''
+    INSERT INTO notifications (user_id, notification_type, message, is_read, created_at)
+    VALUES (?, 'like', 'old read', 1, datetime('now', '-40 days'))
+    ''', (user_id,))
+    conn.commit()
+    conn.close()
+    archiver = DataArchiver(db)
+    assert archiver.archive_notifications() == 1
+
+    manager = BackupManager(db.db_name, backup_dir=str(tmp_path / 'backups'))
+    name = manager.backup()
+    assert manager.verify(name) == {'test.db.gz': 'ok', 'test_archive.db.gz': 'ok'}
+
+    os.remove(archiver.get_archive_name())
+    assert manager.restore(name) == [db.db_name, archiver.get_archive_name()]
+    assert [row[3] for row in archiver.get_archived_notifications(user_id)] == ['old read']
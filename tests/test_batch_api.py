@@ -0,0 +1,50 @@
+import pytest
+
+from batch_api import MAX_QUERIES, BatchExecutor, parse_batch
+from conftest import login
+
+
+@pytest.mark.parametrize('body, message', [
+    (None, 'queries'),
+    ({'queries': []}, 'between 1'),
+    ({'queries': [{'query': 'feed'}] * (MAX_QUERIES + 1)}, 'between 1'),
+    ({'queries': [{'query': 'drop_tables'}]}, 'Unknown query'),
+    ({'queries': [{'query': 'feed'}, {'query': 'feed'}]}, 'Duplicate'),
+    ({'queries': [{'query': 'feed', 'params': {'user_id': 2}}]}, 'unknown parameter'),
+    ({'queries': [{'query': 'feed', 'params': {'limit': -1}}]}, 'non-negative'),
+    ({'queries': [{'query': 'feed', 'fields': 'content'}]}, 'fields'),
+])
+def test_parse_batch_rejects(body, message):
+    with pytest.raises(ValueError, match=message):
+        parse_batch(body)
+
+
+def test_parse_batch_caps_numbers():
+    [(query_id, name, params, fields)] = parse_batch(
+        {'queries': [{'id': 'f', 'query': 'feed', 'params': {'limit': 10 ** 6}, 'fields': ['content']}]})
+    assert (query_id, name, params, fields) == ('f', 'feed', {'limit': 50}, {'content'})
+
+
+def test_queries_run_together_with_fields_selected_and_secrets_hidden(db):
+    user_id = db.insert_user('sam', 'pw', 'S')
+    db.insert_post('hello', user_id)
+    results = BatchExecutor(db).run(user_id, parse_batch({'queries': [
+        {'query': 'user'},
+        {'query': 'my_posts', 'fields': ['content']},
+        {'query': 'badges', 'fields': ['badge_name', 'earned']},
+    ]}))
+
+    assert results['user']['data']['username'] == 'sam'
+    assert 'password' not in results['user']['data']
+    assert results['my_posts']['data'] == [{'content': 'hello'}]
+    assert set(results['badges']['data'][0]) == {'badge_name', 'earned'}
+
+
+def test_batch_route(app_module):
+    client = app_module.app.test_client()
+    assert client.post('/api/batch', json={'queries': [{'query': 'stats'}]}).status_code == 401
+    login(client, app_module.db, 'sam')
+    assert client.post('/api/batch', json={'queries': []}).status_code == 400
+    response = client.post('/api/batch', json={'queries': [{'query': 'unread_count'}]})
+    assert response.status_code == 200
+    assert response.get_json()['results'] == {'unread_count': {'data': 0}}
@@ -0,0 +1,49 @@
+from change_capture import ChangeSubscriber
+
+
+def test_subscriber_dispatches_other_connections_changes_by_table(db, make_db):
+    other = make_db()
+    subscriber = ChangeSubscriber(db)
+    posts, follows = [], []
+    subscriber.subscribe('posts', posts.extend)
+    subscriber.subscribe('following', follows.extend)
+    assert subscriber.poll() == 0
+
+    sam = other.insert_user('sam', 'pw', 'S')
+    amy = other.insert_user('amy', 'pw', 'Y')
+    post_id = other.insert_post('hello', sam)
+    other.create_follow_request(amy, sam)
+    request_id = other.get_pending_follow_requests(sam)[0][0]
+    other.respond_follow_request(request_id, 'accept', sam)
+
+    assert subscriber.poll() > 0
+    assert [(op, row_id, user_id) for _, _, op, row_id, user_id, _ in posts] == [('I', post_id, sam)]
+    assert [(user_id, related_id) for *_, user_id, related_id in follows] == [(amy, sam)]
+    # Nothing new committed, so not even change_log is read
+    assert subscriber.poll() == 0
+    subscriber.stop()
+
+
+def test_subscriber_that_fell_behind_compaction_resets(db, make_db):
+    other = make_db()
+    subscriber = ChangeSubscriber(db, retention=0)
+    resets = []
+    subscriber.on_reset(lambda: resets.append(True))
+    subscriber.poll()
+
+    other.insert_user('sam', 'pw', 'S')
+    subscriber.compact()
+    other.insert_user('amy', 'pw', 'Y')
+    subscriber.poll()
+    assert resets == [True]
+    subscriber.stop()
+
+
+def test_caches_follow_writes_from_another_process(db, make_db):
+    other = make_db()
+    db.change_subscriber.poll()
+    other.insert_user('sam', 'pw', 'S')
+    assert db.username_index.is_available('Sam')
+
+    db.change_subscriber.poll()
+    assert not db.username_index.is_available('Sam')
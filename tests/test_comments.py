@@ -0,0 +1,80 @@
+import sqlite3
+
+from conftest import query
+from deletion import DeletionWorker
+
+
+def comment_count(database, post_id):
+    return query(database, 'SELECT comment_count FROM posts WHERE post_id = ?', (post_id,))[0][0]
+
+
+def test_recent_comments_come_back_per_post(db):
+    user_id = db.insert_user('sam', 'pw', 'S')
+    busy = db.insert_post('busy', user_id)
+    quiet = db.insert_post('quiet', user_id)
+    silent = db.insert_post('silent', user_id)
+    for i in range(5):
+        db.insert_comment(busy, user_id, f'busy {i}')
+    db.insert_comment(quiet, user_id, 'quiet 0')
+
+    comments = db.get_recent_comments_for_posts([busy, quiet, silent], per_post=3)
+    # The newest three, oldest first, and an empty list rather than a missing key
+    assert [row[3] for row in comments[busy]] == ['busy 2', 'busy 3', 'busy 4']
+    assert [row[3] for row in comments[quiet]] == ['quiet 0']
+    assert comments[silent] == []
+    assert comments[busy][0][5] == 'sam'
+    assert db.get_recent_comments_for_posts([]) == {}
+
+
+def test_comment_count_follows_inserts_and_purges(db):
+    author = db.insert_user('sam', 'pw', 'S')
+    commenter = db.insert_user('amy', 'pw', 'Y')
+    post_id = db.insert_post('hello', author)
+    db.insert_comment(post_id, author, 'first')
+    db.insert_comment(post_id, commenter, 'second')
+    db.insert_comment(post_id, commenter, 'third')
+    assert comment_count(db, post_id) == 3
+
+    db.delete_user(commenter)
+    DeletionWorker(db).run_once()
+    assert comment_count(db, post_id) == 1
+
+
+def test_missing_comment_count_column_is_backfilled(make_db):
+    db = make_db()
+    user_id = db.insert_user('sam', 'pw', 'S')
+    post_id = db.insert_post('hello', user_id)
+    db.insert_comment(post_id, user_id, 'first')
+    db.insert_comment(post_id, user_id, 'second')
+    conn = sqlite3.connect(db.db_name)
+    conn.execute('ALTER TABLE posts DROP COLUMN comment_count')
+    conn.commit()
+    conn.close()
+
+    assert comment_count(make_db(), post_id) == 2
+
+
+def test_comment_pages_follow_the_cursor(db):
+    user_id = db.insert_user('sam', 'pw', 'S')
+    post_id = db.insert_post('hello', user_id)
+    for i in range(5):
+        db.insert_comment(post_id, user_id, f'comment {i}')
+
+    seen = []
+    cursor = None
+    pages = 0
+    while True:
+        comments, cursor = db.get_comments_page(post_id, after_comment_id=cursor, limit=2)
+        seen += [row[3] for row in comments]
+        pages += 1
+        if cursor is None:
+            break
+    assert seen == [f'comment {i}' for i in range(5)]
+    assert pages == 3
+
+    # A comment added after the first page still shows up on a later one
+    first, cursor = db.get_comments_page(post_id, limit=4)
+    db.insert_comment(post_id, user_id, 'late')
+    rest, last_cursor = db.get_comments_page(post_id, after_comment_id=cursor, limit=4)
+    assert [row[3] for row in rest] == ['comment 4', 'late']
+    assert last_cursor is None
@@ -0,0 +1,37 @@
+from conftest import query
+from deletion import DeletionWorker
+
+
+def test_deleted_user_is_hidden_at_once_and_purged_in_batches(db):
+    leaving = db.insert_user('sam', 'pw', 'S')
+    staying = db.insert_user('amy', 'pw', 'Y')
+    post_id = db.insert_post('mine', leaving)
+    other_post = db.insert_post('theirs', staying)
+    for i in range(5):
+        db.insert_comment(other_post, leaving, f'comment {i}')
+    db.insert_comment(post_id, staying, 'on a post that goes away')
+
+    db.delete_user(leaving)
+    assert db.get_user_by_id(leaving) is None
+    assert query(db, 'SELECT COUNT(*) FROM users') == [(2,)]
+
+    assert DeletionWorker(db, batch_size=2).run_once() == 1
+    assert query(db, 'SELECT user_id FROM users') == [(staying,)]
+    assert query(db, 'SELECT post_id FROM posts') == [(other_post,)]
+    assert query(db, 'SELECT COUNT(*) FROM comments') == [(0,)]
+    # Counts on surviving rows follow the purge
+    assert query(db, 'SELECT comment_count FROM posts WHERE post_id = ?', (other_post,)) == [(0,)]
+    assert db.username_index.is_available('sam')
+
+
+def test_deleted_post_loses_its_comments(db):
+    user_id = db.insert_user('sam', 'pw', 'S')
+    post_id = db.insert_post('hello', user_id)
+    db.insert_comment(post_id, user_id, 'first')
+    db.delete_post(post_id)
+    assert db.get_post_by_id(post_id) is None
+
+    DeletionWorker(db).run_once()
+    assert query(db, 'SELECT COUNT(*) FROM posts') == [(0,)]
+    assert query(db, 'SELECT COUNT(*) FROM comments') == [(0,)]
+    assert DeletionWorker(db).run_once() == 0
@@ -0,0 +1,61 @@
+from datetime import datetime, timedelta
+
+
+def add_event(database, organizer, name, when, game_type='chess', location='Community Centre'):
+    return database.insert_event(name, 'itinerary', 60, when.strftime('%Y-%m-%d %H:%M:%S'),
+                                 location, 10, organizer, game_type=game_type, latitude=0.0, longitude=0.0)
+
+
+def names(events):
+    return [event[1] for event in events]
+
+
+def test_upcoming_events_filter_by_range_game_type_and_location(db):
+    organizer = db.insert_user('sam', 'pw', 'S')
+    now = datetime.now()
+    add_event(db, organizer, 'past', now - timedelta(days=1))
+    add_event(db, organizer, 'soon', now + timedelta(days=1))
+    add_event(db, organizer, 'later', now + timedelta(days=10), game_type='mahjong')
+    add_event(db, organizer, 'elsewhere', now + timedelta(days=2), location='Library')
+
+    assert names(db.get_upcoming_events()) == ['soon', 'elsewhere', 'later']
+    assert names(db.get_upcoming_events(end=now + timedelta(days=5))) == ['soon', 'elsewhere']
+    assert names(db.get_upcoming_events(start=now - timedelta(days=2), limit=2)) == ['past', 'soon']
+    assert names(db.get_upcoming_events(game_type='mahjong')) == ['later']
+    assert names(db.get_upcoming_events(location='Library')) == ['elsewhere']
+
+
+def test_participant_count_is_kept_on_the_event(db):
+    organizer = db.insert_user('sam', 'pw', 'S')
+    event_id = add_event(db, organizer, 'soon', datetime.now() + timedelta(days=1))
+    for username in ('amy', 'bo'):
+        assert db.add_event_participant(event_id, db.insert_user(username, 'pw', 'Y'))
+    # Joining twice is refused and not counted
+    assert not db.add_event_participant(event_id, db.get_user_by_username('amy')[0])
+
+    [event] = db.get_upcoming_events()
+    assert event[11] == 2
+    assert len(db.get_event_participants(event_id)) == 2
+
+
+def test_month_view_is_cached_until_an_event_write(db, make_db):
+    organizer = db.insert_user('sam', 'pw', 'S')
+    when = (datetime.now().replace(day=1) + timedelta(days=62)).replace(day=15, hour=12)
+    add_event(db, organizer, 'first', when)
+    days = db.get_events_for_month(when.year, when.month)
+    assert names(days[15]) == ['first']
+    assert db.get_events_for_month(when.year, when.month) is days
+
+    # Writes through this instance drop the cache straight away
+    event_id = add_event(db, organizer, 'second', when)
+    assert names(db.get_events_for_month(when.year, when.month)[15]) == ['first', 'second']
+    db.add_event_participant(event_id, db.insert_user('amy', 'pw', 'Y'))
+    assert db.get_events_for_month(when.year, when.month)[15][1][11] == 1
+
+    # Another process's writes arrive through the change log
+    other = make_db()
+    db.change_subscriber.poll()
+    add_event(other, organizer, 'third', when)
+    assert len(db.get_events_for_month(when.year, when.month)[15]) == 2
+    db.change_subscriber.poll()
+    assert names(db.get_events_for_month(when.year, when.month)[15]) == ['first', 'second', 'third']
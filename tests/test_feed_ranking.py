@@ -0,0 +1,33 @@
+from feed_ranking import FeedRanker
+
+
+def test_incremental_updates_match_a_reload(db):
+    author = db.insert_user('sam', 'pw', 'S')
+    viewer = db.insert_user('amy', 'pw', 'Y')
+    db.feed_ranker.refresh()
+
+    # More posts than the initial capacity, so the arrays have to grow
+    post_ids = [db.insert_post(f'post {i}', author) for i in range(150)]
+    own_post = db.insert_post('by the viewer', viewer)
+    db.like_post(post_ids[0], viewer)
+    db.insert_comment(post_ids[1], viewer, 'nice')
+    db.delete_post(post_ids[2])
+
+    ranked = db.feed_ranker.rank(viewer, limit=200)
+    reloaded = FeedRanker(db).rank(viewer, limit=200)
+    assert set(ranked) == set(reloaded) == set(post_ids) - {post_ids[2]}
+    assert own_post not in ranked
+    # A comment counts double, then the like; everything else only decays
+    assert ranked[:2] == reloaded[:2] == [post_ids[1], post_ids[0]]
+
+
+def test_followed_authors_rank_first(db):
+    author = db.insert_user('sam', 'pw', 'S')
+    friend = db.insert_user('ben', 'pw', 'S')
+    viewer = db.insert_user('amy', 'pw', 'Y')
+    friend_post = db.insert_post('from a friend', friend)
+    newer_post = db.insert_post('from a stranger', author)
+    db.create_follow_request(viewer, friend)
+    db.respond_follow_request(db.get_pending_follow_requests(friend)[0][0], 'accept', friend)
+
+    assert FeedRanker(db).rank(viewer) == [friend_post, newer_post]
@@ -0,0 +1,23 @@
+import numpy as np
+
+import fingerprint
+from conftest import query
+from fingerprint import popcount
+
+
+def test_popcount_without_bitwise_count_matches_numpy(monkeypatch):
+    values = np.random.default_rng(1).integers(0, 2 ** 63, size=1000, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    expected = np.bitwise_count(values)
+    monkeypatch.delattr(fingerprint.np, 'bitwise_count')
+    assert (popcount(values) == expected).all()
+
+
+def test_edited_post_is_flagged_as_duplicate(db):
+    user_id = db.insert_user('sam', 'pw', 'S')
+    text = ('Forward this message to ten friends and good luck will come to you within seven days, '
+            'do not break the chain or bad luck follows')
+    original = db.insert_post(text, user_id)
+    copy = db.insert_post(text.replace('ten', '10'), user_id)
+    other = db.insert_post('we played mahjong at the community centre after a long walk in the park', user_id)
+    rows = query(db, 'SELECT post_id, duplicate_of FROM posts ORDER BY post_id')
+    assert rows == [(original, None), (copy, original), (other, None)]
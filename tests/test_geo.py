@@ -0,0 +1,33 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from geo import Gazetteer, bounding_box, distance_km
+
+
+def test_distance_and_box():
+    # One degree of latitude is about 111 km anywhere
+    assert distance_km(1.0, 103.0, 2.0, 103.0) == pytest.approx(111.2, abs=0.1)
+    min_lat, max_lat, min_lon, max_lon = bounding_box(1.35, 103.8, 5)
+    assert distance_km(1.35, 103.8, max_lat, 103.8) == pytest.approx(5)
+    assert distance_km(1.35, 103.8, 1.35, max_lon) >= 5 - 1e-9
+
+
+def test_gazetteer_finds_a_known_part_of_the_location():
+    gazetteer = Gazetteer()
+    assert gazetteer.geocode('Community Hall, bedok ') == gazetteer.geocode('Bedok')
+    assert gazetteer.geocode('Somewhere else entirely') is None
+
+
+def test_nearby_events_closest_first_within_the_radius(db):
+    user_id = db.insert_user('sam', 'pw', 'S')
+    when = (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S')
+    near = db.insert_event('Near', '', 60, when, 'here', 10, user_id, latitude=1.3500, longitude=103.8000)
+    nearer = db.insert_event('Nearer', '', 60, when, 'here', 10, user_id, latitude=1.3510, longitude=103.8000)
+    db.insert_event('Far', '', 60, when, 'there', 10, user_id, latitude=1.4500, longitude=103.8000)
+
+    events = db.get_nearby_events(1.3515, 103.8000, radius_km=2)
+    assert [event[0] for event in events] == [nearer, near]
+    assert events[0][-1] < events[1][-1] <= 2
+    # Without a radius the search widens until it has enough events
+    assert len(db.get_nearby_events(1.3515, 103.8000, limit=3)) == 3
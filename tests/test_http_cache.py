@@ -0,0 +1,77 @@
+import gzip
+
+import pytest
+from flask import Flask, Response, jsonify, session
+
+from http_cache import HttpCache, ResponseCompressor
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'test'
+    app.http_cache = HttpCache(app)
+    ResponseCompressor(app)
+
+    @app.route('/profile')
+    @app.http_cache.cached('posts')
+    def profile():
+        return jsonify({'user_id': session['user_id'], 'padding': 'x' * 2000})
+
+    @app.route('/posts', methods=['POST'])
+    def create_post():
+        return 'ok'
+
+    @app.route('/small')
+    def small():
+        return jsonify({'ok': True})
+
+    @app.route('/stream')
+    def stream():
+        return Response(iter(['data: 1\n\n']), mimetype='text/event-stream')
+
+    return app
+
+
+def logged_in(app, user_id):
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess.update({'user_id': user_id, 'logged_in': True})
+    return client
+
+
+def test_unchanged_page_is_answered_304(app):
+    client = logged_in(app, 1)
+    first = client.get('/profile')
+    assert first.status_code == 200 and first.headers['Cache-Control'] == 'private, no-cache'
+    etag = first.headers['ETag']
+
+    again = client.get('/profile', headers={'If-None-Match': etag})
+    assert again.status_code == 304 and again.headers['ETag'] == etag
+    assert app.http_cache.get_not_modified_count() == 1
+
+    # Another user never gets the first user's version
+    assert logged_in(app, 2).get('/profile', headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_write_or_captured_change_gives_a_new_etag(app):
+    client = logged_in(app, 1)
+    etag = client.get('/profile').headers['ETag']
+    client.post('/posts')
+    response = client.get('/profile', headers={'If-None-Match': etag})
+    assert response.status_code == 200 and response.headers['ETag'] != etag
+
+    # A post by user 3 in another process, as the change subscriber hands it over
+    etag = response.headers['ETag']
+    app.http_cache.versions.apply_changes([(1, 'posts', 'I', 10, 3, None)])
+    assert client.get('/profile', headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_large_json_is_gzipped_small_and_streams_are_not(app):
+    client = logged_in(app, 1)
+    response = client.get('/profile', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert b'x' * 2000 in gzip.decompress(response.data)
+
+    assert 'Content-Encoding' not in client.get('/small', headers={'Accept-Encoding': 'gzip'}).headers
+    assert 'Content-Encoding' not in client.get('/stream', headers={'Accept-Encoding': 'gzip'}).headers
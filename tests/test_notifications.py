@@ -0,0 +1,41 @@
+from conftest import query
+from notification_hub import NotificationHub
+
+
+def test_unread_counter_follows_inserts_reads_and_deletes(db):
+    author = db.insert_user('sam', 'pw', 'S')
+    fan = db.insert_user('amy', 'pw', 'Y')
+    post_id = db.insert_post('hello', author)
+    db.like_post(post_id, fan)
+    db.insert_comment(post_id, fan, 'nice')
+    assert db.get_unread_notification_count(author) == 2
+
+    db.mark_notification_read(db.get_notifications(author)[0][0])
+    assert db.get_unread_notification_count(author) == 1
+    db.mark_all_notifications_read(author)
+    assert db.get_unread_notification_count(author) == 0
+    # The counter agrees with a full count
+    assert query(db, 'SELECT COUNT(*) FROM notifications WHERE user_id = ? AND is_read = 0', (author,)) == [(0,)]
+
+
+def test_committed_notification_reaches_open_streams(db):
+    author = db.insert_user('sam', 'pw', 'S')
+    fan = db.insert_user('amy', 'pw', 'Y')
+    post_id = db.insert_post('hello', author)
+    stream = db.notification_hub.subscribe(author)
+
+    with db.unit_of_work():
+        db.like_post(post_id, fan)
+        assert stream.empty()
+    event = stream.get(timeout=1)
+    assert event['type'] == 'notification' and event['unread_count'] == 1
+
+
+def test_slow_subscriber_loses_its_oldest_events():
+    hub = NotificationHub(max_queue=2)
+    subscription = hub.subscribe(1)
+    for number in range(3):
+        hub.publish(1, {'number': number})
+    assert [subscription.get_nowait()['number'] for _ in range(2)] == [1, 2]
+    hub.unsubscribe(1, subscription)
+    assert hub.get_subscriber_count() == 0
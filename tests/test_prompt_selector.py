@@ -0,0 +1,96 @@
+import random
+import sqlite3
+import time
+
+import pytest
+
+from conftest import query
+from prompt_selector import PromptSelector
+
+
+def stored_uses(database, prompt_id):
+    return query(database, 'SELECT times_used FROM post_prompts WHERE prompt_id = ?', (prompt_id,))[0][0]
+
+
+def rename_table(database, old, new):
+    conn = sqlite3.connect(database.db_name)
+    conn.execute(f'ALTER TABLE {old} RENAME TO {new}')
+    conn.commit()
+    conn.close()
+
+
+def test_less_used_prompts_come_up_more_often(db):
+    fresh = db.insert_post_prompt('What made you smile today?', 'daily')
+    conn = sqlite3.connect(db.db_name)
+    conn.execute('UPDATE post_prompts SET times_used = 99 WHERE prompt_id != ?', (fresh,))
+    count = conn.execute('SELECT COUNT(*) FROM post_prompts').fetchone()[0]
+    conn.commit()
+    conn.close()
+    db.reference_cache.bump()
+
+    random.seed(7)
+    picks = [db.get_prompts_for_user('senior', limit=1)[0][0] for _ in range(500)]
+    # Weight 1 against 1/100 for each of the others
+    expected = 500 / (1 + (count - 1) / 100)
+    assert picks.count(fresh) > expected * 0.8
+    assert len(set(picks)) > 1
+
+
+def test_usage_is_buffered_and_written_in_one_batch(db):
+    user_id = db.insert_user('sam', 'pw', 'S')
+    prompt_id = db.insert_post_prompt('What made you smile today?', 'daily')
+    for i in range(3):
+        db.insert_post(f'post {i}', user_id, post_prompt_id=prompt_id)
+
+    assert stored_uses(db, prompt_id) == 0
+    assert db.prompt_selector.get_pending_count() == 3
+    assert [row[5] for row in db.get_all_prompts() if row[0] == prompt_id] == [3]
+
+    db.prompt_selector.flush()
+    assert stored_uses(db, prompt_id) == 3
+    assert db.prompt_selector.get_pending_count() == 0
+
+
+def test_background_thread_flushes_once_the_threshold_is_reached(db):
+    prompt_id = db.insert_post_prompt('What made you smile today?', 'daily')
+    selector = PromptSelector(db, flush_threshold=2, flush_interval=60)
+    try:
+        selector.record_use(prompt_id)
+        selector.record_use(prompt_id)
+        deadline = time.monotonic() + 5
+        while stored_uses(db, prompt_id) != 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert stored_uses(db, prompt_id) == 2
+    finally:
+        selector.close()
+
+
+def test_failed_flush_keeps_the_counts(db):
+    prompt_id = db.insert_post_prompt('What made you smile today?', 'daily')
+    db.prompt_selector.record_use(prompt_id)
+    rename_table(db, 'post_prompts', 'post_prompts_moved')
+    with pytest.raises(sqlite3.OperationalError):
+        db.prompt_selector.flush()
+    assert db.prompt_selector.get_pending_count() == 1
+
+    rename_table(db, 'post_prompts_moved', 'post_prompts')
+    db.prompt_selector.flush()
+    assert stored_uses(db, prompt_id) == 1
+
+
+def test_failing_flush_never_reaches_the_committed_post(db, capsys):
+    user_id = db.insert_user('sam', 'pw', 'S')
+    prompt_id = db.insert_post_prompt('What made you smile today?', 'daily')
+    db.prompt_selector.close()
+    db.prompt_selector = PromptSelector(db, flush_threshold=1, flush_interval=60)
+    rename_table(db, 'post_prompts', 'post_prompts_moved')
+
+    with db.unit_of_work():
+        post_id = db.insert_post('hello', user_id, post_prompt_id=prompt_id)
+    assert db.get_post_by_id(post_id) is not None
+    # The callbacks queued after record_use still ran
+    assert db.trending.get_score('prompt', prompt_id) > 0
+
+    rename_table(db, 'post_prompts_moved', 'post_prompts')
+    db.prompt_selector.flush()
+    assert stored_uses(db, prompt_id) == 1
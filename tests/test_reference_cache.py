@@ -0,0 +1,31 @@
+import reference_cache
+
+
+def test_other_instances_reload_once_the_stamp_moves(make_db, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(reference_cache.time, 'monotonic', lambda: now[0])
+    writer = make_db()
+    reader = make_db()
+
+    prompt_id = writer.insert_post_prompt('What made you smile today?', 'daily')
+    # The writer reloads at once, other instances within one check interval
+    assert writer.reference_cache.get_prompt(prompt_id) is not None
+    assert reader.reference_cache.get_prompt(prompt_id) is None
+
+    now[0] += 1.5
+    assert reader.reference_cache.get_prompt(prompt_id)[1] == 'What made you smile today?'
+    assert prompt_id in [prompt[0] for prompt in reader.get_all_prompts()]
+    assert reader.reference_cache.get_version() == writer.reference_cache.get_version()
+
+
+def test_nothing_is_reloaded_while_the_stamp_stays(db, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(reference_cache.time, 'monotonic', lambda: now[0])
+    db.reference_cache.bump()
+    loads = []
+    monkeypatch.setattr(db.reference_cache, 'load', lambda: loads.append(True))
+
+    for _ in range(3):
+        now[0] += 5
+        db.reference_cache.get_prompts()
+    assert loads == []
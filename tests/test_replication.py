@@ -0,0 +1,73 @@
+import os
+import sqlite3
+
+import pytest
+
+from conftest import query
+from replication import ChangeShipper, ReplicaFollower
+
+
+@pytest.fixture
+def primary(make_db, tmp_path):
+    return make_db('primary.db', replication_dir=str(tmp_path / 'ship'))
+
+
+def test_follower_bootstraps_then_applies_shipped_changes(primary, tmp_path):
+    ship_dir = primary.replication_dir
+    replica_name = str(tmp_path / 'replica.db')
+    shipper = ChangeShipper(primary, ship_dir)
+    follower = ReplicaFollower(replica_name, ship_dir, primary.db_name)
+
+    user_id = primary.insert_user('sam', 'pw', 'S')
+    post_id = primary.insert_post('before the copy', user_id)
+    shipper.ship()
+    follower.catch_up()
+
+    primary.update_post(post_id, content='edited')
+    primary.insert_post('after the copy', user_id)
+    assert shipper.ship() > 0
+    assert follower.catch_up() > 0
+
+    sql = 'SELECT post_id, content FROM posts ORDER BY post_id'
+    assert query(primary, sql) == sqlite3.connect(replica_name).execute(sql).fetchall()
+    # Nothing logged on the primary stays behind once shipped
+    assert query(primary, 'SELECT COUNT(*) FROM replication_log') == [(0,)]
+
+
+def test_follower_refuses_to_skip_missing_changes(primary, tmp_path):
+    ship_dir = primary.replication_dir
+    shipper = ChangeShipper(primary, ship_dir)
+    follower = ReplicaFollower(str(tmp_path / 'replica.db'), ship_dir, primary.db_name)
+    user_id = primary.insert_user('sam', 'pw', 'S')
+    follower.catch_up()
+
+    primary.insert_post('lost', user_id)
+    shipper.ship()
+    for entry in os.listdir(ship_dir):
+        if entry.endswith('.jsonl'):
+            os.remove(os.path.join(ship_dir, entry))
+    primary.insert_post('shipped', user_id)
+    shipper.ship()
+
+    with pytest.raises(ValueError, match='missing changes'):
+        follower.catch_up()
+
+
+def test_reads_use_the_replica_only_while_it_is_fresh(primary, make_db, tmp_path):
+    ship_dir = primary.replication_dir
+    replica_name = str(tmp_path / 'replica.db')
+    user_id = primary.insert_user('sam', 'pw', 'S')
+    primary.insert_post('hello', user_id)
+    ChangeShipper(primary, ship_dir).ship()
+    ReplicaFollower(replica_name, ship_dir, primary.db_name).catch_up()
+
+    reader = make_db('primary.db', replica_name=replica_name, max_staleness=60)
+    # Written to the replica only, so a read that finds it went to the replica
+    replica = sqlite3.connect(replica_name)
+    replica.execute("UPDATE posts SET content = 'from the replica'")
+    replica.commit()
+    replica.close()
+    assert reader.get_posts_by_user(user_id)[0][1] == 'from the replica'
+
+    stale = make_db('primary.db', replica_name=replica_name, max_staleness=0)
+    assert stale.get_posts_by_user(user_id)[0][1] == 'hello'
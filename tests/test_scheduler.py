@@ -0,0 +1,53 @@
+import os
+import sqlite3
+import time
+
+from conftest import query
+from scheduler import Scheduler
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+def test_first_runs_do_not_wait_for_the_interval(db):
+    user_id = db.insert_user('sam', 'pw', 'S')
+    db.insert_post('hello from the community centre', user_id)
+    leaving = db.insert_user('amy', 'pw', 'Y')
+    db.insert_post('goodbye', leaving)
+    db.delete_user(leaving)
+    conn = sqlite3.connect(db.db_name)
+    conn.execute('''
+    INSERT INTO notifications (user_id, notification_type, message, is_read, created_at)
+    VALUES (?, 'like', 'old read', 1, datetime('now', '-40 days'))
+    ''', (user_id,))
+    conn.commit()
+    conn.close()
+
+    scheduler = Scheduler(db, backup_interval=3600, analytics_interval=3600)
+    scheduler.start()
+    try:
+        assert wait_for(lambda: db.get_last_analytics_run() is not None)
+        assert wait_for(lambda: scheduler.backups.list_snapshots())
+        assert wait_for(lambda: query(db, 'SELECT COUNT(*) FROM notifications') == [(0,)])
+        assert wait_for(lambda: query(db, 'SELECT user_id FROM users') == [(user_id,)])
+    finally:
+        scheduler.stop()
+    assert len(scheduler.analytics.list_snapshots()) == 1
+    assert len(scheduler.backups.list_snapshots()) == 1
+    assert [row[3] for row in scheduler.archiver.get_archived_notifications(user_id)] == ['old read']
+
+
+def test_changes_are_shipped_when_replicating(make_db, tmp_path):
+    primary = make_db('primary.db', replication_dir=str(tmp_path / 'ship'))
+    primary.insert_user('sam', 'pw', 'S')
+    scheduler = Scheduler(primary, backup_interval=3600, analytics_interval=3600)
+    scheduler.start()
+    try:
+        assert wait_for(lambda: query(primary, 'SELECT COUNT(*) FROM replication_log') == [(0,)])
+    finally:
+        scheduler.stop()
+    assert any(name.endswith('.jsonl') for name in os.listdir(tmp_path / 'ship'))
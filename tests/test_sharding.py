@@ -0,0 +1,151 @@
+import os
+import sqlite3
+
+import pytest
+
+from backup import BackupManager
+from change_capture import ChangeSubscriber
+from conftest import query
+from deletion import DeletionWorker
+from sharding import ID_BITS, get_shard_names
+
+
+def shard_query(database, index, sql, params=()):
+    """Run a query on one shard file by itself"""
+    conn = sqlite3.connect(database.shards.shard_names[index])
+    rows = conn.execute(sql, params).fetchall()
+    conn.close()
+    return rows
+
+
+def test_rows_live_in_their_users_shard(make_db):
+    db = make_db(shard_count=4, buffer_actions=False)
+    users = [db.insert_user(f'user{i}', 'pw', 'S') for i in range(4)]
+    post_ids = [db.insert_post(f'post by {user_id}', user_id) for user_id in users]
+
+    assert db.get_database_files() == [db.db_name, *get_shard_names(db.db_name, 4)]
+    for user_id, post_id in zip(users, post_ids):
+        index = user_id % 4
+        assert post_id >> ID_BITS == index
+        assert shard_query(db, index, 'SELECT user_id FROM posts') == [(user_id,)]
+        assert shard_query(db, index, 'SELECT user_id, action_type FROM user_actions') == [(user_id, 'create_post')]
+        assert db.get_post_by_id(post_id)[1] == f'post by {user_id}'
+        assert [post[0] for post in db.get_posts_by_user(user_id)] == [post_id]
+    assert query(db, "SELECT name FROM sqlite_master WHERE name = 'posts'") == []
+
+    # Reopened without a count, the database finds its shards again
+    reopened = make_db()
+    assert reopened.shards.shard_count == 4
+    assert reopened.get_post_by_id(post_ids[2])[0] == post_ids[2]
+
+
+def test_feeds_merge_every_shard(make_db):
+    db = make_db(shard_count=3)
+    users = [db.insert_user(f'user{i}', 'pw', 'S') for i in range(3)]
+    post_ids = []
+    for i in range(6):
+        post_ids.append(db.insert_post(f'post {i}', users[i % 3]))
+        conn = sqlite3.connect(db.shards.shard_names[users[i % 3] % 3])
+        conn.execute("UPDATE posts SET timestamp = datetime('now', ?) WHERE post_id = ?",
+                     (f'-{10 - i} minutes', post_ids[-1]))
+        conn.commit()
+        conn.close()
+
+    assert [post[0] for post in db.get_all_posts(limit=4)] == post_ids[:1:-1]
+    assert [post[0] for post in db.get_posts_by_ids(post_ids[::-1])] == post_ids[::-1]
+    db.create_follow_request(users[0], users[1])
+    db.respond_follow_request(db.get_pending_follow_requests(users[1])[0][0], 'accept', users[1])
+    assert [post[0] for post in db.get_followed_posts(users[0])] == [post_ids[4], post_ids[1]]
+
+
+def test_like_across_shards_commits_to_both(make_db):
+    db = make_db(shard_count=2, buffer_actions=False)
+    owner = db.insert_user('owner', 'pw', 'S')
+    liker = db.insert_user('liker', 'pw', 'S')
+    assert owner % 2 != liker % 2
+    post_id = db.insert_post('like me', owner)
+
+    db.like_post(post_id, liker)
+    assert db.get_post_by_id(post_id)[4] == 1
+    assert [row[3] for row in db.get_notifications(owner)] == ['liker liked your post']
+    assert [row[2] for row in db.get_actions_by_user(liker)] == ['like_post']
+    assert shard_query(db, owner % 2, "SELECT COUNT(*) FROM user_actions WHERE action_type = 'like_post'") == [(0,)]
+
+
+def test_unit_of_work_rolls_back_every_shard(make_db):
+    db = make_db(shard_count=2, buffer_actions=False)
+    first = db.insert_user('first', 'pw', 'S')
+    second = db.insert_user('second', 'pw', 'S')
+    with pytest.raises(RuntimeError):
+        with db.unit_of_work():
+            db.insert_post('one', first)
+            db.insert_post('two', second)
+            raise RuntimeError
+    assert db.get_all_posts() == []
+
+    with db.unit_of_work():
+        db.insert_post('one', first)
+        db.insert_post('two', second)
+    assert sorted(post[1] for post in db.get_all_posts()) == ['one', 'two']
+
+
+def test_purge_removes_rows_from_the_users_shard(make_db):
+    db = make_db(shard_count=2)
+    leaving = db.insert_user('sam', 'pw', 'S')
+    staying = db.insert_user('amy', 'pw', 'Y')
+    db.insert_post('mine', leaving)
+    other_post = db.insert_post('theirs', staying)
+    db.insert_comment(other_post, leaving, 'bye')
+    db.like_post(other_post, leaving)
+
+    db.delete_user(leaving)
+    assert DeletionWorker(db, batch_size=1).run_once() == 1
+    assert shard_query(db, leaving % 2, 'SELECT COUNT(*) FROM posts') == [(0,)]
+    assert shard_query(db, leaving % 2, 'SELECT COUNT(*) FROM user_actions') == [(0,)]
+    assert query(db, 'SELECT COUNT(*) FROM comments') == [(0,)]
+    assert shard_query(db, staying % 2, 'SELECT comment_count FROM posts') == [(0,)]
+
+
+def test_backups_copy_every_shard(make_db, tmp_path):
+    db = make_db(shard_count=2)
+    user_id = db.insert_user('sam', 'pw', 'S')
+    db.insert_post('kept', user_id)
+    manager = BackupManager(db.db_name, backup_dir=str(tmp_path / 'backups'))
+    name = manager.backup()
+    assert manager.verify(name) == {'test.db.gz': 'ok', 'test_shard0.db.gz': 'ok', 'test_shard1.db.gz': 'ok'}
+
+    db.insert_post('after the backup', user_id)
+    os.remove(db.shards.shard_names[user_id % 2])
+    assert sorted(manager.restore(name)) == sorted(db.get_database_files())
+    assert [post[1] for post in db.get_posts_by_user(user_id)] == ['kept']
+
+
+def test_subscriber_tails_every_shard(make_db):
+    db = make_db(shard_count=2)
+    other = make_db()
+    subscriber = ChangeSubscriber(db)
+    posts = []
+    subscriber.subscribe('posts', posts.extend)
+    subscriber.poll()
+
+    users = [other.insert_user(f'user{i}', 'pw', 'S') for i in range(2)]
+    post_ids = [other.insert_post('hello', user_id) for user_id in users]
+    assert subscriber.poll() > 0
+    assert sorted(row_id for _, _, op, row_id, _, _ in posts) == sorted(post_ids)
+    subscriber.stop()
+
+
+def test_shard_count_is_fixed_when_the_database_is_created(make_db):
+    make_db(shard_count=2)
+    with pytest.raises(ValueError):
+        make_db(shard_count=3)
+    make_db('plain.db')
+    with pytest.raises(ValueError):
+        make_db('plain.db', shard_count=2)
+    with pytest.raises(ValueError):
+        make_db('too_many.db', shard_count=9)
+
+
+def test_sharded_databases_have_no_replicas(make_db, tmp_path):
+    with pytest.raises(ValueError):
+        make_db(shard_count=2, replication_dir=str(tmp_path / 'replication'))
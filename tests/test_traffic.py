@@ -0,0 +1,41 @@
+import gzip
+import json
+
+from flask import Flask, jsonify, request
+
+from traffic import MAGIC, TrafficRecorder, TrafficReplayer, encode_record, read_trace
+
+
+def test_json_bodies_are_recorded_scrubbed(db, tmp_path):
+    app = Flask(__name__)
+
+    @app.route('/api/batch', methods=['POST'])
+    def batch():
+        return jsonify(request.get_json())
+
+    trace_path = str(tmp_path / 'app.trace')
+    recorder = TrafficRecorder(app, db, trace_path, key='k', flush_interval=0.01)
+    body = {'queries': [{'id': 'feed', 'query': 'feed', 'params': {'limit': 10}, 'fields': ['content']}],
+            'note': 'private words', 'password': 'hunter2'}
+    assert app.test_client().post('/api/batch', json=body).status_code == 200
+    recorder.close()
+
+    [record] = read_trace(trace_path)
+    assert json.loads(record['body']) == dict(body, note='x' * 13, password='')
+
+
+def test_replayed_batch_requests_keep_their_body(db, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # Set by load_app(), put back afterwards
+    monkeypatch.setenv('BONDBUDDIES_DB', db.db_name)
+    user_id = db.insert_user('sam', 'pw', 'S')
+    db.insert_post('hello', user_id)
+    body = json.dumps({'queries': [{'query': 'my_posts', 'fields': ['content']}]})
+    trace_path = tmp_path / 'app.trace'
+    with gzip.open(trace_path, 'wb') as trace:
+        trace.write(MAGIC + encode_record({
+            'started': 0.0, 'duration_ms': 1.0, 'status': 200, 'method': 'POST', 'user_id': user_id,
+            'route': '/api/batch', 'path': '/api/batch', 'params': [], 'body': body, 'db_calls': []}))
+
+    report = TrafficReplayer(str(trace_path), db.db_name, speed=None, concurrency=1).run()
+    assert report['routes']['POST /api/batch']['status_changed'] == 0
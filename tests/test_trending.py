@@ -0,0 +1,32 @@
+import pytest
+
+import trending
+from trending import TrendingEngine
+
+
+def test_scores_halve_every_half_life(db, monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(trending.time, 'time', lambda: now[0])
+    engine = TrendingEngine(db, half_life_hours=1)
+    engine.record('post', 1, 4.0)
+    engine.record('post', 2, 1.0)
+    now[0] += 3600
+    engine.record('post', 2, 2.0)
+
+    assert engine.top('post') == [(2, pytest.approx(2.5)), (1, pytest.approx(2.0))]
+    engine.remove('post', 2)
+    assert [key for key, _ in engine.top('post')] == [1]
+
+
+def test_checkpoints_merge_other_processes_increments(db, make_db):
+    here = TrendingEngine(db)
+    there = TrendingEngine(make_db())
+    here.record('game_type', 'mahjong', 2.0)
+    there.record('game_type', 'mahjong', 1.0)
+    there.record('game_type', 'chess', 1.0)
+
+    here.checkpoint()
+    there.checkpoint()
+    here.load()
+    assert [key for key, _ in here.top('game_type')] == ['mahjong', 'chess']
+    assert here.get_score('game_type', 'mahjong') == pytest.approx(3.0, rel=1e-3)
@@ -0,0 +1,96 @@
+import pytest
+
+from conftest import query
+from unit_of_work import UnitOfWork
+
+
+def post_contents(database):
+    return [row[0] for row in query(database, 'SELECT content FROM posts ORDER BY post_id')]
+
+
+def test_writes_commit_together_at_the_end(db):
+    user_id = db.insert_user('sam', 'pw', 'S')
+    with db.unit_of_work():
+        db.insert_post('first', user_id)
+        db.insert_post('second', user_id)
+        # Another connection sees nothing until the block ends
+        assert post_contents(db) == []
+    assert post_contents(db) == ['first', 'second']
+
+
+def test_error_rolls_back_every_write(db):
+    user_id = db.insert_user('sam', 'pw', 'S')
+    with pytest.raises(RuntimeError):
+        with db.unit_of_work():
+            db.insert_post('first', user_id)
+            db.insert_post('second', user_id)
+            raise RuntimeError
+    assert post_contents(db) == []
+
+
+def test_failed_inner_block_only_undoes_its_own_writes(db):
+    user_id = db.insert_user('sam', 'pw', 'S')
+    with db.unit_of_work():
+        db.insert_post('outer', user_id)
+        with pytest.raises(RuntimeError):
+            with db.unit_of_work():
+                db.insert_post('inner', user_id)
+                raise RuntimeError
+        db.insert_post('after', user_id)
+    assert post_contents(db) == ['outer', 'after']
+
+
+def test_after_commit_callbacks_wait_for_the_commit(db):
+    ran = []
+    with db.unit_of_work():
+        db.run_after_commit(lambda: ran.append('committed'))
+        assert ran == []
+    assert ran == ['committed']
+
+    with pytest.raises(RuntimeError):
+        with db.unit_of_work():
+            db.run_after_commit(lambda: ran.append('rolled back'))
+            raise RuntimeError
+    assert ran == ['committed']
+
+
+def test_callbacks_of_a_rolled_back_savepoint_are_dropped(db):
+    ran = []
+    with db.unit_of_work():
+        db.run_after_commit(lambda: ran.append('outer'))
+        with pytest.raises(RuntimeError):
+            with db.unit_of_work():
+                db.run_after_commit(lambda: ran.append('inner'))
+                raise RuntimeError
+    assert ran == ['outer']
+
+
+def test_a_failing_callback_does_not_skip_the_rest(db, capsys):
+    user_id = db.insert_user('sam', 'pw', 'S')
+    ran = []
+
+    def fail():
+        raise RuntimeError('cache refresh failed')
+
+    with db.unit_of_work():
+        db.insert_post('first', user_id)
+        db.run_after_commit(fail)
+        db.run_after_commit(lambda: ran.append('committed'))
+    assert ran == ['committed']
+    assert post_contents(db) == ['first']
+    assert 'cache refresh failed' in capsys.readouterr().out
+
+
+
+def test_a_failing_rollback_callback_does_not_skip_the_rest(tmp_path, capsys):
+    unit = UnitOfWork(str(tmp_path / 'plain.db'))
+    ran = []
+
+    def fail():
+        raise RuntimeError('undo failed')
+
+    unit.after_rollback(lambda: ran.append('first queued'))
+    unit.after_rollback(fail)
+    unit.rollback()
+    assert ran == ['first queued']
+    assert 'undo failed' in capsys.readouterr().out
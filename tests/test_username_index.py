@@ -0,0 +1,61 @@
+import sqlite3
+
+import pytest
+
+from username_index import rename_case_clashes
+
+
+def test_index_folds_case_like_the_unique_index(db):
+    assert db.insert_user('Élise', 'pw', 'S') is not None
+
+    # Each check agrees with what the unique index on lower(username) then does
+    for username in ('Élise', 'éLISE', 'ÉLISE', 'élise'):
+        available = db.username_index.is_available(username)
+        assert available == (db.insert_user(username, 'pw', 'S') is not None), username
+
+    db.username_index.load()
+    assert not db.username_index.is_available('élise')
+    assert db.username_index.is_available('Elise')
+
+
+def test_index_matches_after_reload(db):
+    db.insert_user('Zoë', 'pw', 'Y')
+    before = [db.username_index.is_available(name) for name in ('zoë', 'ZOË', 'ZOë')]
+    db.username_index.load()
+    assert [db.username_index.is_available(name) for name in ('zoë', 'ZOË', 'ZOë')] == before == [False, True, False]
+
+
+def add_case_clashes(database, usernames):
+    conn = sqlite3.connect(database.db_name)
+    conn.execute('DROP INDEX idx_users_username_lower')
+    conn.executemany("INSERT INTO users (username, password, user_type) VALUES (?, 'pw', 'S')",
+                     [(username,) for username in usernames])
+    conn.commit()
+    conn.close()
+
+
+def test_case_clashes_leave_the_app_starting_without_the_index(make_db, capsys):
+    db = make_db(buffer_actions=False)
+    add_case_clashes(db, ['Sam', 'sam'])
+
+    reopened = make_db(buffer_actions=False)
+    assert 'rename-case-clashes' in capsys.readouterr().out
+    assert reopened.get_user_by_username('sam') is not None
+
+
+def test_migration_renames_all_but_the_oldest_account(make_db):
+    db = make_db(buffer_actions=False)
+    add_case_clashes(db, ['Sam', 'sam', 'SAM', 'sam_3'])
+
+    renames = rename_case_clashes(db.db_name)
+    assert renames == [('sam', 'sam_2'), ('SAM', 'SAM_3_')]
+    reopened = make_db(buffer_actions=False)
+    assert reopened.insert_user('sAm', 'pw', 'S') is None
+    assert rename_case_clashes(db.db_name) == []
+
+
+def test_other_constraint_failures_are_not_reported_as_taken(db):
+    with pytest.raises(sqlite3.IntegrityError, match='CHECK'):
+        db.insert_user('sam', 'pw', 'S', age_group='toddler')
+    assert db.insert_user('sam', 'pw', 'S') is not None
+    assert db.insert_user('SAM', 'pw', 'S') is None
@@ -0,0 +1,533 @@
+"""Record real traffic to the BondBuddies app and replay it against a copy of the database.
+
+Recording is switched on by setting BONDBUDDIES_TRACE to a log path before
+starting the app. To replay a log:
+
+    python traffic.py replay BondBuddies.trace --db BondBuddies.db --speed 10 --concurrency 8
+    python traffic.py show BondBuddies.trace
+"""
+import argparse
+import atexit
+import contextvars
+import gzip
+import hashlib
+import hmac
+import importlib.util
+import inspect
+import io
+import json
+import os
+import queue
+import shutil
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sharding import read_shard_names
+
+MAGIC = b'BBTRACE2'
+# Traces written before request bodies were recorded
+OLD_MAGIC = b'BBTRACE1'
+METHODS = ('GET', 'POST', 'PUT', 'PATCH', 'DELETE', 'HEAD', 'OPTIONS')
+
+# started, duration_ms, status, method, session user_id (-1 when logged out)
+RECORD_HEADER = struct.Struct('<dfHBi')
+LENGTH = struct.Struct('<H')
+BODY_LENGTH = struct.Struct('<I')
+CALL_DURATION = struct.Struct('<f')
+
+# Form and query fields whose values are never written to a trace
+SECRET_FIELDS = {'password', 'confirm_password'}
+# Replaced by a keyed pseudonym, so replay can map them back to rows in the copy
+IDENTITY_FIELDS = {'username'}
+# Kept as they are; any other non-numeric value is masked to the same length
+PUBLIC_FIELDS = {'user_type', 'game_type', 'location', 'category', 'radius_km', 'limit', 'lat', 'lon',
+                 'id', 'query', 'fields'}
+
+# DataBase helpers that are plumbing rather than queries
+UNTRACED_METHODS = {'get_connection', 'get_read_connection', 'pin_connection', 'unit_of_work', 'run_after_commit',
+                    'format_timestamp', 'notification_to_dict'}
+
+REPLAY_PASSWORD = 'replay-password'
+
+_calls = contextvars.ContextVar('traffic_calls', default=None)
+_depth = contextvars.ContextVar('traffic_depth', default=0)
+
+
+def pseudonymize(key, value):
+    """Stable keyed pseudonym for an identifying value, e.g. a username"""
+    digest = hmac.new(key.encode(), value.lower().encode(), hashlib.sha256).hexdigest()
+    return f'u_{digest[:12]}'
+
+
+def anonymize_params(key, params):
+    """Scrub request fields for a trace, returns a list of (name, value)"""
+    scrubbed = []
+    for name, value in params:
+        if name in SECRET_FIELDS:
+            value = ''
+        elif name in IDENTITY_FIELDS:
+            value = pseudonymize(key, value)
+        elif name == 'email':
+            value = f'{pseudonymize(key, value)}@example.invalid'
+        elif name not in PUBLIC_FIELDS:
+            try:
+                float(value)
+            except ValueError:
+                value = 'x' * len(value)
+        scrubbed.append((name, value))
+    return scrubbed
+
+
+def anonymize_json(key, value, name=None):
+    """Scrub a decoded JSON body, strings by the same rules as the field (or key) holding them"""
+    if isinstance(value, dict):
+        return {field: anonymize_json(key, item, field) for field, item in value.items()}
+    if isinstance(value, list):
+        return [anonymize_json(key, item, name) for item in value]
+    if isinstance(value, str):
+        return anonymize_params(key, [(name, value)])[0][1]
+    return value
+
+
+# =============== BINARY FORMAT ===============
+
+def _pack_str(value):
+    data = value.encode('utf-8')[:65535]
+    return LENGTH.pack(len(data)) + data
+
+
+def _read_str(stream):
+    (length,) = LENGTH.unpack(stream.read(LENGTH.size))
+    return stream.read(length).decode('utf-8')
+
+
+def encode_record(record):
+    parts = [RECORD_HEADER.pack(record['started'], record['duration_ms'], record['status'],
+                                METHODS.index(record['method']),
+                                record['user_id'] if record['user_id'] is not None else -1),
+             _pack_str(record['route']), _pack_str(record['path']),
+             LENGTH.pack(len(record['params']))]
+    for name, value in record['params']:
+        parts.append(_pack_str(name))
+        parts.append(_pack_str(value))
+    parts.append(LENGTH.pack(len(record['db_calls'])))
+    for name, duration_ms in record['db_calls']:
+        parts.append(_pack_str(name))
+        parts.append(CALL_DURATION.pack(duration_ms))
+    body = record['body'].encode('utf-8')
+    parts.append(BODY_LENGTH.pack(len(body)))
+    parts.append(body)
+    return b''.join(parts)
+
+
+def read_trace(path):
+    """Yield every record of a trace log as a dict, oldest first"""
+    with gzip.open(path, 'rb') as trace:
+        stream = io.BufferedReader(trace)
+        magic = stream.read(len(MAGIC))
+        if magic not in (MAGIC, OLD_MAGIC):
+            raise ValueError(f'{path} is not a BondBuddies trace')
+        while True:
+            header = stream.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            started, duration_ms, status, method, user_id = RECORD_HEADER.unpack(header)
+            route = _read_str(stream)
+            path_ = _read_str(stream)
+            (param_count,) = LENGTH.unpack(stream.read(LENGTH.size))
+            params = [(_read_str(stream), _read_str(stream)) for _ in range(param_count)]
+            (call_count,) = LENGTH.unpack(stream.read(LENGTH.size))
+            db_calls = []
+            for _ in range(call_count):
+                name = _read_str(stream)
+                db_calls.append((name, CALL_DURATION.unpack(stream.read(CALL_DURATION.size))[0]))
+            body = ''
+            if magic == MAGIC:
+                (body_length,) = BODY_LENGTH.unpack(stream.read(BODY_LENGTH.size))
+                body = stream.read(body_length).decode('utf-8')
+            yield {'started': started, 'duration_ms': duration_ms, 'status': status, 'method': METHODS[method],
+                   'user_id': user_id if user_id >= 0 else None, 'route': route, 'path': path_,
+                   'params': params, 'body': body, 'db_calls': db_calls}
+
+
+# =============== RECORDING ===============
+
+class TrafficRecorder:
+    """Flask hooks that write an anonymized trace of every request.
+
+    Each record holds the route, the method and path, the scrubbed query and
+    form fields, the scrubbed body of JSON requests, the session's user_id, the status, how long the view took,
+    and the DataBase calls it made with their timings. Passwords are dropped,
+    usernames and emails become keyed pseudonyms (HMAC with `key`), and other
+    free text is masked to its length. User ids are kept; they only mean
+    something next to a copy of the database.
+
+    Records are encoded in a compact binary layout and appended to a gzip log
+    by a writer thread, flushed every `flush_interval` seconds, so a request
+    only pays for putting its record on a queue. `sample_rate` records that
+    fraction of requests.
+    """
+
+    def __init__(self, app, database, log_path, key, sample_rate=1.0, flush_interval=1.0):
+        self.__log_path = log_path
+        self.__key = key
+        self.__sample_rate = sample_rate
+        self.__flush_interval = flush_interval
+        self.__queue = queue.SimpleQueue()
+        self.__stop = threading.Event()
+        self.__recorded = 0
+        if os.path.exists(log_path) and os.path.getsize(log_path):
+            with gzip.open(log_path, 'rb') as log:
+                if log.read(len(MAGIC)) != MAGIC:
+                    raise ValueError(f'{log_path} is not a trace of this version, move it away first')
+        self.__trace_database(database)
+
+        app.before_request(self.__before_request)
+        app.after_request(self.__after_request)
+        app.teardown_request(self.__teardown_request)
+
+        self.__thread = threading.Thread(target=self.__run, name='traffic-recorder', daemon=True)
+        self.__thread.start()
+        atexit.register(self.close)
+
+    def get_recorded_count(self):
+        return self.__recorded
+
+    def close(self):
+        """Write out every queued record and stop the writer"""
+        if not self.__stop.is_set():
+            self.__stop.set()
+            self.__thread.join()
+
+    def __trace_database(self, database):
+        # Instance attributes shadow the class methods, AsyncDataBase picks them up too
+        for name, method in inspect.getmembers(type(database), inspect.isfunction):
+            if not name.startswith('_') and name not in UNTRACED_METHODS:
+                setattr(database, name, self.__traced(name, getattr(database, name)))
+
+    def __traced(self, name, method):
+        def traced(*args, **kwargs):
+            calls = _calls.get()
+            # Only the calls a view makes itself, not the ones DataBase makes internally
+            if calls is None or _depth.get():
+                return method(*args, **kwargs)
+            token = _depth.set(1)
+            started = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                calls.append((name, (time.perf_counter() - started) * 1000))
+                _depth.reset(token)
+        return traced
+
+    def __before_request(self):
+        from flask import g, request, session
+        if request.endpoint == 'static' or (self.__sample_rate < 1 and
+                                            int.from_bytes(os.urandom(2), 'big') / 65536 >= self.__sample_rate):
+            return
+        g.traffic_started = time.time()
+        g.traffic_timer = time.perf_counter()
+        g.traffic_token = _calls.set([])
+        # Who made the request, not who it logged in
+        g.traffic_user_id = session.get('user_id')
+
+    def __after_request(self, response):
+        from flask import g, request
+        if 'traffic_timer' not in g:
+            return response
+        duration_ms = (time.perf_counter() - g.traffic_timer) * 1000
+        params = list(request.args.items(multi=True)) + list(request.form.items(multi=True))
+        params += [(name, f'<file {file.content_length or 0} bytes>')
+                   for name, file in request.files.items(multi=True)]
+        # JSON bodies (e.g. /api/batch) are kept whole, scrubbed value by value
+        body = ''
+        if request.is_json:
+            try:
+                body = json.dumps(anonymize_json(self.__key, json.loads(request.get_data())))
+            except ValueError:
+                body = ''  # Not valid JSON, so nothing the app would have read either
+        user_id = g.traffic_user_id
+        self.__queue.put({
+            'started': g.traffic_started,
+            'duration_ms': duration_ms,
+            'status': response.status_code,
+            'method': request.method if request.method in METHODS else 'GET',
+            'user_id': user_id if isinstance(user_id, int) else None,
+            'route': request.url_rule.rule if request.url_rule else request.path,
+            'path': request.path,
+            'params': anonymize_params(self.__key, params),
+            'body': body,
+            'db_calls': list(_calls.get() or []),
+        })
+        return response
+
+    def __teardown_request(self, exc):
+        from flask import g
+        token = g.pop('traffic_token', None)
+        if token is not None:
+            _calls.reset(token)
+
+    def __run(self):
+        new_file = not os.path.exists(self.__log_path) or os.path.getsize(self.__log_path) == 0
+        with gzip.open(self.__log_path, 'ab') as log:
+            if new_file:
+                log.write(MAGIC)
+            while not self.__stop.is_set() or not self.__queue.empty():
+                deadline = time.monotonic() + self.__flush_interval
+                wrote = False
+                while time.monotonic() < deadline:
+                    try:
+                        record = self.__queue.get(timeout=max(deadline - time.monotonic(), 0.001))
+                    except queue.Empty:
+                        if self.__stop.is_set():
+                            break
+                        continue
+                    try:
+                        log.write(encode_record(record))
+                        self.__recorded += 1
+                        wrote = True
+                    except (struct.error, ValueError) as e:
+                        print(f"Traffic recorder error: {e}")
+                if wrote:
+                    log.flush()
+
+
+# =============== REPLAY ===============
+
+def load_app(db_path):
+    """Import the app against another database file, returns its module"""
+    os.environ['BONDBUDDIES_DB'] = db_path
+    # A replay must not record itself into a trace, ship changes to real replicas,
+    # or read from a replica instead of the copy; the copy keeps the shards it has
+    for name in ('BONDBUDDIES_TRACE', 'BONDBUDDIES_REPLICATION_DIR', 'BONDBUDDIES_REPLICA', 'BONDBUDDIES_SHARDS'):
+        os.environ.pop(name, None)
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__init__.py')
+    spec = importlib.util.spec_from_file_location('bondbuddies_app', app_path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['bondbuddies_app'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def stop_app(module):
+    """Stop the workers of an app from load_app(), e.g. before its database file is removed"""
+    module.avatar_pipeline.shutdown()
+    module.db.change_subscriber.stop()
+    module.db.trending.stop()
+    module.db.prompt_selector.close()
+    if module.db.activity_buffer is not None:
+        module.db.activity_buffer.close()
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+class TrafficReplayer:
+    """Re-drives a trace against an app bound to a copy of the database.
+
+    The database (and nothing else) is copied with the backup API into a
+    temp directory and the app is imported against the copy, so the real
+    file is never written to. Pseudonymous usernames are mapped back to the
+    copy's users by recomputing their pseudonyms with the same key, and those
+    users get REPLAY_PASSWORD so logins take the same path as in production.
+
+    Requests keep their original spacing divided by `speed` (None for as fast
+    as possible) and run on `concurrency` threads, each with its own client.
+    """
+
+    def __init__(self, trace_path, db_name, speed=1.0, concurrency=4, key=None):
+        self.__trace_path = trace_path
+        self.__db_name = db_name
+        self.__speed = speed
+        self.__concurrency = concurrency
+        self.__key = key
+        self.__local = threading.local()
+
+    def run(self):
+        """Replay the whole trace, returns a report dict"""
+        records = list(read_trace(self.__trace_path))
+        work_dir = tempfile.mkdtemp(prefix='bondbuddies-replay-')
+        try:
+            copy_path = os.path.join(work_dir, os.path.basename(self.__db_name))
+            # Shards keep their names next to the copy, where its DataBase looks for them
+            for source_name in (self.__db_name, *read_shard_names(self.__db_name)):
+                source = sqlite3.connect(source_name)
+                target = sqlite3.connect(os.path.join(work_dir, os.path.basename(source_name)))
+                source.backup(target)
+                target.close()
+                source.close()
+
+            module = load_app(copy_path)
+            try:
+                self.__app = module.app
+                key = self.__key or self.__app.config['SECRET_KEY']
+                self.__users = self.__prepare_users(module.db, key, records)
+                return self.__replay(records)
+            finally:
+                stop_app(module)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def __prepare_users(self, database, key, records):
+        from werkzeug.security import generate_password_hash
+        pseudonyms = {value for record in records for name, value in record['params'] if name in IDENTITY_FIELDS}
+        user_ids = {record['user_id'] for record in records if record['user_id'] is not None}
+
+        conn = sqlite3.connect(database.db_name)
+        cursor = conn.cursor()
+        cursor.execute('SELECT user_id, username, user_type FROM users WHERE deleted_at IS NULL')
+        users = {}
+        by_pseudonym = {}
+        for user_id, username, user_type in cursor.fetchall():
+            users[user_id] = (username, user_type)
+            pseudonym = pseudonymize(key, username)
+            if pseudonym in pseudonyms:
+                by_pseudonym[pseudonym] = username
+                user_ids.add(user_id)
+
+        # One hash for everyone, so preparing the copy is not thousands of PBKDF2 runs
+        replay_hash = generate_password_hash(REPLAY_PASSWORD)
+        cursor.executemany('UPDATE users SET password = ? WHERE user_id = ?',
+                           [(replay_hash, user_id) for user_id in user_ids if user_id in users])
+        conn.commit()
+        conn.close()
+        return {'by_id': users, 'by_pseudonym': by_pseudonym}
+
+    def __client(self):
+        client = getattr(self.__local, 'client', None)
+        if client is None:
+            client = self.__local.client = self.__app.test_client()
+        return client
+
+    def __send(self, record, due):
+        delay = due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        client = self.__client()
+
+        with client.session_transaction() as session:
+            session.clear()
+            user = self.__users['by_id'].get(record['user_id'])
+            if user is not None:
+                session.update({'user_id': record['user_id'], 'username': user[0],
+                                'user_type': user[1], 'logged_in': True})
+
+        params = []
+        for name, value in record['params']:
+            if name in SECRET_FIELDS:
+                value = REPLAY_PASSWORD
+            elif name in IDENTITY_FIELDS:
+                # Unknown pseudonyms are new accounts, the pseudonym is a fine username
+                value = self.__users['by_pseudonym'].get(value, value)
+            params.append((name, value))
+
+        kwargs = {}
+        if record['method'] in ('GET', 'HEAD', 'DELETE'):
+            kwargs['query_string'] = params
+        elif record['body']:
+            kwargs['query_string'] = params
+            kwargs['data'] = record['body']
+            kwargs['content_type'] = 'application/json'
+        else:
+            kwargs['data'] = {name: (io.BytesIO(bytes(int(value.split()[1]))), 'upload')
+                              if value.startswith('<file ') else value for name, value in params}
+
+        started = time.perf_counter()
+        response = client.open(record['path'], method=record['method'], **kwargs)
+        if response.is_streamed:
+            response.close()  # Live streams never end by themselves
+        else:
+            response.get_data()
+        return (time.perf_counter() - started) * 1000, response.status_code
+
+    def __replay(self, records):
+        if not records:
+            return {'requests': 0}
+        first = records[0]['started']
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.__concurrency) as pool:
+            futures = [pool.submit(self.__send, record,
+                                   start + (record['started'] - first) / self.__speed if self.__speed else 0)
+                       for record in records]
+            results = [future.result() for future in futures]
+        elapsed = time.perf_counter() - start
+
+        routes = {}
+        for record, (latency, status) in zip(records, results):
+            route = routes.setdefault(f"{record['method']} {record['route']}",
+                                      {'latencies': [], 'recorded': [], 'errors': 0, 'status_changed': 0})
+            route['latencies'].append(latency)
+            route['recorded'].append(record['duration_ms'])
+            route['errors'] += status >= 500
+            route['status_changed'] += status != record['status']
+
+        latencies = [latency for latency, _ in results]
+        return {
+            'requests': len(records),
+            'elapsed_s': round(elapsed, 3),
+            'throughput_rps': round(len(records) / elapsed, 1) if elapsed else None,
+            'p50_ms': percentile(latencies, 0.50),
+            'p90_ms': percentile(latencies, 0.90),
+            'p99_ms': percentile(latencies, 0.99),
+            'max_ms': max(latencies),
+            'routes': {name: {
+                'requests': len(route['latencies']),
+                'p50_ms': percentile(route['latencies'], 0.50),
+                'p99_ms': percentile(route['latencies'], 0.99),
+                'recorded_p50_ms': percentile(route['recorded'], 0.50),
+                'errors': route['errors'],
+                'status_changed': route['status_changed'],
+            } for name, route in sorted(routes.items())},
+        }
+
+
+def print_report(report):
+    print(f"{report['requests']} requests in {report.get('elapsed_s', 0)}s "
+          f"({report.get('throughput_rps')} req/s)")
+    if not report['requests']:
+        return
+    print(f"latency  p50 {report['p50_ms']:.1f} ms  p90 {report['p90_ms']:.1f} ms  "
+          f"p99 {report['p99_ms']:.1f} ms  max {report['max_ms']:.1f} ms")
+    print(f"{'route':<40} {'count':>6} {'p50':>9} {'p99':>9} {'recorded p50':>13} {'5xx':>5} {'changed':>8}")
+    for name, route in report['routes'].items():
+        print(f"{name:<40} {route['requests']:>6} {route['p50_ms']:>7.1f}ms {route['p99_ms']:>7.1f}ms "
+              f"{route['recorded_p50_ms']:>11.1f}ms {route['errors']:>5} {route['status_changed']:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded BondBuddies traffic')
+    parser.add_argument('command', choices=['replay', 'show'])
+    parser.add_argument('trace')
+    parser.add_argument('--db', default='BondBuddies.db', help='database to copy for the replay')
+    parser.add_argument('--speed', default='1', help="1, 10, ... times real time, or 'max'")
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--key', help="pseudonym key, the app's SECRET_KEY by default")
+    parser.add_argument('--output', help='also write the report as JSON, e.g. to compare releases')
+    args = parser.parse_args()
+
+    if args.command == 'show':
+        for record in read_trace(args.trace):
+            calls = ', '.join(name for name, _ in record['db_calls'])
+            print(f"{record['method']} {record['path']} {record['status']} "
+                  f"{record['duration_ms']:.1f}ms user={record['user_id']} [{calls}]")
+        return
+
+    speed = None if args.speed == 'max' else float(args.speed)
+    report = TrafficReplayer(args.trace, args.db, speed, args.concurrency, args.key).run()
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
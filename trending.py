@@ -0,0 +1,202 @@
+import atexit
+import bisect
+import math
+import sqlite3
+import threading
+import time
+
+KINDS = ('post', 'prompt', 'game_type')
+
+# Score added per interaction, before decay
+POST_WEIGHT = 1.0
+LIKE_WEIGHT = 1.0
+COMMENT_WEIGHT = 2.0
+PROMPT_USE_WEIGHT = 1.0
+EVENT_WEIGHT = 1.0
+PARTICIPANT_WEIGHT = 1.0
+
+# Forward-decayed scores are rebased before exp() gets anywhere near overflowing
+MAX_EXPONENT = 500
+
+
+class TrendingEngine:
+    """Exponentially time-decayed popularity of posts, prompts and event game types.
+
+    Every item's score halves each `half_life_hours`. Scores are kept in
+    forward-decayed form: an interaction at time t adds weight * e^(λ(t - epoch))
+    and nothing is ever decayed in place, because dividing every score by the
+    same e^(λ(now - epoch)) does not change their order. Each kind is held as
+    a list sorted by score, so an interaction is a binary search plus an
+    insert and a top-k query reads the first k entries.
+
+    Interactions are also collected as pending increments, and every
+    `checkpoint_interval` seconds they are merged into trending_scores by
+    decaying the stored score to now and adding them. The table is then
+    re-read, which brings in the increments other processes checkpointed.
+    Items that have decayed below `min_score` are pruned, and only the best
+    `max_items` of each kind are held in memory.
+    """
+
+    def __init__(self, database, half_life_hours=6, checkpoint_interval=60, max_items=5000, min_score=0.01):
+        self.__database = database
+        self.__rate = math.log(2) / (half_life_hours * 3600)
+        self.__checkpoint_interval = checkpoint_interval
+        self.__max_items = max_items
+        self.__min_score = min_score
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.__epoch = time.time()
+        self.__scores = {kind: {} for kind in KINDS}  # key -> forward-decayed score
+        self.__ranked = {kind: [] for kind in KINDS}  # sorted (-score, key)
+        self.__pending = {kind: {} for kind in KINDS}  # key -> forward-decayed increment not yet checkpointed
+        self.__removed = {kind: set() for kind in KINDS}
+        self.load()
+
+    # =============== BACKGROUND RUNNER ===============
+
+    def start(self):
+        """Checkpoint every `checkpoint_interval` seconds on a daemon thread"""
+        if self.__thread is not None and self.__thread.is_alive():
+            return
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run, name='trending-checkpoint', daemon=True)
+        self.__thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Stop the background thread and write a last checkpoint"""
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+            self.checkpoint()
+
+    def __run(self):
+        while not self.__stop.wait(self.__checkpoint_interval):
+            try:
+                self.checkpoint()
+            except sqlite3.Error as e:
+                print(f"Trending checkpoint error: {e}")
+
+    # =============== SCORES ===============
+
+    def record(self, kind, key, weight=1.0):
+        """Add an interaction with an item, e.g. record('post', post_id, LIKE_WEIGHT)"""
+        if key is None:
+            return
+        now = time.time()
+        with self.__lock:
+            if self.__rate * (now - self.__epoch) > MAX_EXPONENT:
+                self.__rebase(now)
+            increment = weight * math.exp(self.__rate * (now - self.__epoch))
+            self.__set_score(kind, key, self.__scores[kind].get(key, 0.0) + increment)
+            self.__pending[kind][key] = self.__pending[kind].get(key, 0.0) + increment
+
+    def remove(self, kind, key):
+        """Stop ranking an item, e.g. a deleted post"""
+        with self.__lock:
+            self.__set_score(kind, key, None)
+            self.__pending[kind].pop(key, None)
+            self.__removed[kind].add(key)
+
+    def top(self, kind, k=10):
+        """The k highest scoring items of a kind as [(key, current score)], best first"""
+        with self.__lock:
+            factor = math.exp(-self.__rate * (time.time() - self.__epoch))
+            return [(key, -negative_score * factor) for negative_score, key in self.__ranked[kind][:k]]
+
+    def get_score(self, kind, key):
+        with self.__lock:
+            score = self.__scores[kind].get(key)
+            if score is None:
+                return 0.0
+            return score * math.exp(-self.__rate * (time.time() - self.__epoch))
+
+    def __set_score(self, kind, key, score):
+        ranked = self.__ranked[kind]
+        old = self.__scores[kind].get(key)
+        if old is not None:
+            del ranked[bisect.bisect_left(ranked, (-old, key))]
+        if score is None:
+            self.__scores[kind].pop(key, None)
+        else:
+            self.__scores[kind][key] = score
+            bisect.insort(ranked, (-score, key))
+
+    def __rebase(self, now):
+        factor = math.exp(-self.__rate * (now - self.__epoch))
+        for kind in KINDS:
+            self.__scores[kind] = {key: score * factor for key, score in self.__scores[kind].items()}
+            self.__ranked[kind] = sorted((-score, key) for key, score in self.__scores[kind].items())
+            self.__pending[kind] = {key: score * factor for key, score in self.__pending[kind].items()}
+        self.__epoch = now
+
+    # =============== CHECKPOINTS ===============
+
+    def checkpoint(self):
+        """Merge pending increments into trending_scores and reload, returns items written"""
+        now = time.time()
+        with self.__lock:
+            factor = math.exp(-self.__rate * (now - self.__epoch))
+            pending = [(kind, str(key), increment * factor, now)
+                       for kind in KINDS for key, increment in self.__pending[kind].items()]
+            removed = [(kind, str(key)) for kind in KINDS for key in self.__removed[kind]]
+            self.__pending = {kind: {} for kind in KINDS}
+            self.__removed = {kind: set() for kind in KINDS}
+
+        conn = self.__connect()
+        cursor = conn.cursor()
+        cursor.executemany('''
+        INSERT INTO trending_scores (kind, item_key, score, scored_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT(kind, item_key) DO UPDATE
+        SET score = decayed(score, scored_at, excluded.scored_at) + excluded.score,
+            scored_at = excluded.scored_at
+        ''', pending)
+        cursor.executemany('DELETE FROM trending_scores WHERE kind = ? AND item_key = ?', removed)
+        cursor.execute('DELETE FROM trending_scores WHERE decayed(score, scored_at, ?) < ?',
+                       (now, self.__min_score))
+        conn.commit()
+        conn.close()
+
+        self.load()
+        return len(pending)
+
+    def load(self):
+        """Rebuild the in-memory scores from trending_scores, keeping pending increments"""
+        now = time.time()
+        conn = self.__connect()
+        cursor = conn.cursor()
+        rows = {}
+        for kind in KINDS:
+            cursor.execute('''
+            SELECT item_key, decayed(score, scored_at, ?) AS current
+            FROM trending_scores
+            WHERE kind = ?
+            ORDER BY current DESC
+            LIMIT ?
+            ''', (now, kind, self.__max_items))
+            rows[kind] = cursor.fetchall()
+        conn.close()
+
+        with self.__lock:
+            factor = math.exp(-self.__rate * (now - self.__epoch))
+            for kind in KINDS:
+                key_type = str if kind == 'game_type' else int
+                scores = {key_type(key): score for key, score in rows[kind]}
+                # Increments recorded since the checkpoint are not in the table yet
+                for key, increment in self.__pending[kind].items():
+                    scores[key] = scores.get(key, 0.0) + increment * factor
+                for key in self.__removed[kind]:
+                    scores.pop(key, None)
+                self.__scores[kind] = scores
+                self.__ranked[kind] = sorted((-score, key) for key, score in scores.items())
+                self.__pending[kind] = {key: increment * factor for key, increment in self.__pending[kind].items()}
+            self.__epoch = now
+
+    def __connect(self):
+        conn = sqlite3.connect(self.__database.db_name)
+        rate = self.__rate
+        conn.create_function('decayed', 3, lambda score, scored_at, at: score * math.exp(-rate * (at - scored_at)),
+                             deterministic=True)
+        return conn
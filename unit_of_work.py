@@ -0,0 +1,167 @@
+import sqlite3
+
+
+class UnitOfWork:
+    """One connection and one transaction shared by a sequence of DataBase calls.
+
+    DataBase methods written as connect / execute / commit / close keep working
+    unchanged: inside a unit of work they are handed a JoinedConnection, where
+    commit() and close() act on a savepoint instead of the real transaction.
+    The real COMMIT happens once, when the outermost unit of work finishes.
+
+    Callbacks queued with after_commit() run once that COMMIT is done, and
+    those queued with after_rollback() run, newest first, if it rolls back.
+    Rolling back to a savepoint does the same for the callbacks queued since
+    it was opened. A callback that raises is reported and skipped, so the ones
+    after it still run and the caller still sees the outcome of the transaction.
+
+    `attach(conn)`, when given, is called before BEGIN to ATTACH the other
+    databases (shards) the unit may write to, since that can't be done later.
+    """
+
+    def __init__(self, db_name, immediate=False, row_factory=None, attach=None):
+        # Autocommit mode so BEGIN/SAVEPOINT/COMMIT are entirely under our control
+        self.__conn = sqlite3.connect(db_name, isolation_level=None)
+        if attach is not None:
+            attach(self.__conn)
+        if row_factory is not None:
+            self.__conn.row_factory = row_factory
+        self.__conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+        self.__savepoint_count = 0
+        self.__marks = {}  # savepoint -> how many callbacks were queued when it opened
+        self.__after_commit = []
+        self.__after_rollback = []
+
+    def get_connection(self):
+        return self.__conn
+
+    def join(self):
+        """Hand a DataBase method a connection scoped to a fresh savepoint"""
+        return JoinedConnection(self.__conn, self.__open_savepoint())
+
+    def savepoint(self):
+        """Open a new savepoint and return its name"""
+        name = self.__open_savepoint()
+        self.__marks[name] = (len(self.__after_commit), len(self.__after_rollback))
+        return name
+
+    def __open_savepoint(self):
+        self.__savepoint_count += 1
+        name = f'uow_{self.__savepoint_count}'
+        self.__conn.execute(f'SAVEPOINT {name}')
+        return name
+
+    def release(self, name):
+        self.__conn.execute(f'RELEASE {name}')
+        self.__marks.pop(name, None)
+
+    def rollback_to(self, name):
+        self.__conn.execute(f'ROLLBACK TO {name}')
+        self.__conn.execute(f'RELEASE {name}')
+        commit_mark, rollback_mark = self.__marks.pop(name)
+        del self.__after_commit[commit_mark:]
+        callbacks = self.__after_rollback[rollback_mark:]
+        del self.__after_rollback[rollback_mark:]
+        run_callbacks(reversed(callbacks))
+
+    def after_commit(self, callback):
+        """Queue a callback that only runs if the whole unit of work commits"""
+        self.__after_commit.append(callback)
+
+    def after_rollback(self, callback):
+        """Queue a callback that undoes in-memory work if the unit of work rolls back"""
+        self.__after_rollback.append(callback)
+
+    def commit(self):
+        self.__conn.execute('COMMIT')
+        self.__conn.close()
+        callbacks, self.__after_commit = self.__after_commit, []
+        self.__after_rollback = []
+        run_callbacks(callbacks)
+
+    def rollback(self):
+        self.__conn.execute('ROLLBACK')
+        self.__conn.close()
+        self.__after_commit = []
+        callbacks, self.__after_rollback = self.__after_rollback, []
+        run_callbacks(reversed(callbacks))
+
+
+def run_callbacks(callbacks):
+    # The transaction has already ended, so one failing callback must not stop
+    # the rest from bringing in-memory state up to date
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception as e:
+            print(f"Unit of work callback error: {e}")
+
+
+class JoinedConnection:
+    """Connection stand-in given to DataBase methods running inside a unit of work.
+
+    commit() keeps the method's changes (releases and re-opens its savepoint),
+    close() throws away anything not committed, the same as closing a plain
+    sqlite3 connection would.
+    """
+
+    def __init__(self, conn, savepoint):
+        self.__conn = conn
+        self.__savepoint = savepoint
+        self.__open = True
+
+    def cursor(self):
+        return self.__conn.cursor()
+
+    def execute(self, *args):
+        return self.__conn.execute(*args)
+
+    def executemany(self, *args):
+        return self.__conn.executemany(*args)
+
+    def commit(self):
+        if self.__open:
+            self.__conn.execute(f'RELEASE {self.__savepoint}')
+            self.__conn.execute(f'SAVEPOINT {self.__savepoint}')
+
+    def rollback(self):
+        if self.__open:
+            self.__conn.execute(f'ROLLBACK TO {self.__savepoint}')
+
+    def close(self):
+        if self.__open:
+            self.__conn.execute(f'ROLLBACK TO {self.__savepoint}')
+            self.__conn.execute(f'RELEASE {self.__savepoint}')
+            self.__open = False
+
+
+class PersistentConnection:
+    """Connection kept open for the life of a thread (see DataBase.pin_connection).
+
+    commit() commits as usual; close() only rolls back whatever the method left
+    uncommitted, so the next DataBase call on this thread reuses the connection.
+    `attach(conn)` ATTACHes other databases (shards) once, up front.
+    """
+
+    def __init__(self, db_name, attach=None):
+        self.__conn = sqlite3.connect(db_name)
+        if attach is not None:
+            attach(self.__conn)
+
+    def cursor(self):
+        return self.__conn.cursor()
+
+    def execute(self, *args):
+        return self.__conn.execute(*args)
+
+    def executemany(self, *args):
+        return self.__conn.executemany(*args)
+
+    def commit(self):
+        self.__conn.commit()
+
+    def rollback(self):
+        self.__conn.rollback()
+
+    def close(self):
+        self.__conn.rollback()
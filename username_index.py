@@ -0,0 +1,184 @@
+"""In-memory username availability, and the case-insensitive unique index behind it.
+
+    python username_index.py rename-case-clashes [--db BondBuddies.db]
+
+Databases from before usernames were unique regardless of case may hold
+names that differ only by case, and the unique index on lower(username)
+cannot be built until they are renamed. The app starts without the index
+and says so; run this one-time migration while it is stopped. In each group
+the oldest account keeps its name and the others get their user_id
+appended, e.g. "sam" becomes "sam_17". The renames are printed so the
+users can be told.
+"""
+import argparse
+import bisect
+import sqlite3
+import string
+import threading
+import time
+
+# SQLite's lower() only folds A-Z, so the index folds exactly the same way as
+# the unique index on lower(username); str.lower() would also fold "É" to "é"
+ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def fold_case(username):
+    """A username as lower(username) stores it in the unique index"""
+    return username.translate(ASCII_LOWER)
+
+
+def install_username_index(cursor):
+    """Enforce unique usernames regardless of case, returns False if existing names clash"""
+    try:
+        cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_users_username_lower ON users(lower(username))')
+    except sqlite3.IntegrityError:
+        return False
+    return True
+
+
+def is_username_taken(error):
+    """True if an IntegrityError came from one of the username unique constraints"""
+    message = str(error)
+    return 'idx_users_username_lower' in message or 'users.username' in message
+
+
+def rename_case_clashes(db_name):
+    """Rename usernames that differ only by case, then build the index; returns [(old, new)]"""
+    conn = sqlite3.connect(db_name)
+    cursor = conn.cursor()
+    cursor.execute('SELECT user_id, username FROM users ORDER BY user_id')
+    rows = cursor.fetchall()
+
+    taken = {fold_case(username) for _, username in rows}
+    seen = set()
+    renames = []
+    for user_id, username in rows:
+        folded = fold_case(username)
+        if folded not in seen:
+            seen.add(folded)  # The oldest account keeps the name
+            continue
+        new_username = f'{username}_{user_id}'
+        while fold_case(new_username) in taken:
+            new_username += '_'
+        taken.add(fold_case(new_username))
+        cursor.execute('UPDATE users SET username = ? WHERE user_id = ?', (new_username, user_id))
+        renames.append((username, new_username))
+
+    if not install_username_index(cursor):
+        # Only possible if the app is still running and took one of the new names
+        conn.rollback()
+        conn.close()
+        raise sqlite3.IntegrityError('Usernames changed during the migration, stop the app and run it again')
+    conn.commit()
+    conn.close()
+    return renames
+
+
+class UsernameIndex:
+    """Sorted in-memory array of every case-folded username, for availability checks.
+
+    Answers "is this name free?" with a binary search instead of a query, so
+    a signup form can check on every keystroke. Inserts, renames and deletes
+    made through this process update the array directly; users added by other
+    processes are picked up every `refresh_interval` seconds by reading only
+    rows newer than the last user_id seen, and the whole array is rebuilt every
+    `reload_interval` seconds to catch their renames and deletes. With the
+    change subscriber running, apply_changes() picks them up within moments.
+
+    The index is only advisory: the unique index on lower(username) is what
+    actually rejects a taken name.
+    """
+
+    def __init__(self, database, refresh_interval=5, reload_interval=600):
+        self.__database = database
+        self.__refresh_interval = refresh_interval
+        self.__reload_interval = reload_interval
+        self.__lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """Rebuild the index from the users table"""
+        conn = self.__database.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT username, user_id FROM users')
+        rows = cursor.fetchall()
+        conn.close()
+
+        with self.__lock:
+            self.__usernames = sorted(fold_case(row[0]) for row in rows)
+            self.__last_user_id = max((row[1] for row in rows), default=0)
+            self.__loaded_at = self.__refreshed_at = time.monotonic()
+
+    def refresh(self):
+        """Add users created since the last load or refresh"""
+        conn = self.__database.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT username, user_id FROM users WHERE user_id > ?', (self.__last_user_id,))
+        rows = cursor.fetchall()
+        conn.close()
+
+        with self.__lock:
+            for username, user_id in rows:
+                self.__insert(fold_case(username))
+                self.__last_user_id = max(self.__last_user_id, user_id)
+            self.__refreshed_at = time.monotonic()
+
+    def is_available(self, username):
+        """True if nobody has taken this username, ignoring the case of A-Z"""
+        now = time.monotonic()
+        if now - self.__loaded_at >= self.__reload_interval:
+            self.load()
+        elif now - self.__refreshed_at >= self.__refresh_interval:
+            self.refresh()
+
+        username = fold_case(username)
+        with self.__lock:
+            position = bisect.bisect_left(self.__usernames, username)
+            return position == len(self.__usernames) or self.__usernames[position] != username
+
+    def add(self, username, user_id=None):
+        """Record a username taken by this process"""
+        with self.__lock:
+            self.__insert(fold_case(username))
+            if user_id is not None:
+                self.__last_user_id = max(self.__last_user_id, user_id)
+
+    def remove(self, username):
+        """Free a username after a rename or once its user is purged"""
+        username = fold_case(username)
+        with self.__lock:
+            position = bisect.bisect_left(self.__usernames, username)
+            if position < len(self.__usernames) and self.__usernames[position] == username:
+                del self.__usernames[position]
+
+    def apply_changes(self, changes):
+        """Follow users changes from the change log: new users are read in, renames and purges reload"""
+        ops = {change[2] for change in changes}
+        if ops & {'R', 'D'}:
+            self.load()
+        elif 'I' in ops:
+            self.refresh()
+
+    def get_count(self):
+        return len(self.__usernames)
+
+    def __insert(self, username):
+        position = bisect.bisect_left(self.__usernames, username)
+        if position == len(self.__usernames) or self.__usernames[position] != username:
+            self.__usernames.insert(position, username)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline migration for case-insensitive usernames')
+    parser.add_argument('command', choices=['rename-case-clashes'])
+    parser.add_argument('--db', default='BondBuddies.db')
+    args = parser.parse_args()
+
+    renames = rename_case_clashes(args.db)
+    for old, new in renames:
+        print(f'{old} -> {new}')
+    print(f'Renamed {len(renames)} usernames; {args.db} now enforces unique usernames regardless of case')
+
+
+if __name__ == '__main__':
+    main()